@@ -1,13 +1,14 @@
 import os
 import platform
-from typing import Optional, Union
-from transformers import AutoModel, AutoTokenizer, LogitsProcessorList
+import torch
+from typing import Iterator, Optional, Tuple, Union
+from transformers import AutoModel, AutoTokenizer, LogitsProcessorList, TemperatureLogitsWarper, TopPLogitsWarper
 
 MODEL_PATH = os.environ.get('MODEL_PATH', 'THUDM/chatglm3-6b')
 TOKENIZER_PATH = os.environ.get("TOKENIZER_PATH", MODEL_PATH)
 
-tokenizer = AutoTokenizer.from_pretrained(TOKENIZER_PATH, trust_remote_code=True)
-model = AutoModel.from_pretrained(MODEL_PATH, trust_remote_code=True, device_map="auto").eval()
+# ChatGLM3 KV cache layout: [seq_len, batch, num_kv_heads, head_dim]
+KV_BATCH_DIM = 1
 
 
 os_name = platform.system()
@@ -25,14 +26,136 @@ def build_prompt(history):
     return prompt
 
 
-def process_model_outputs(outputs, tokenizer):
-    responses = []
-    for output in outputs:
-        response = tokenizer.decode(output, skip_special_tokens=True)
-        response = response.replace("[gMASK]sop", "").strip()
-        batch_responses.append(response)
+def process_model_outputs(outputs, prompt_length, tokenizer):
+    # Prompts are left-padded to the same length, so the generated tokens of every row start at the same column.
+    responses = tokenizer.batch_decode(outputs[:, prompt_length:], skip_special_tokens=True)
+    return [response.replace("[gMASK]sop", "").strip() for response in responses]
 
-    return responses
+
+def bucket_by_length(lengths: list[int], max_tokens_per_batch: int) -> list[list[int]]:
+    """
+    Group prompt indices by token length so that each group pads to at most `max_tokens_per_batch` prompt tokens.
+    The API server has the same grouping in `openai_api_demo/utils.py`, this demo runs on its own.
+    """
+    buckets, bucket = [], []
+    for index in sorted(range(len(lengths)), key=lambda i: lengths[i]):
+        # Sorted by length, the prompt being added is the longest of its bucket.
+        if bucket and (len(bucket) + 1) * lengths[index] > max_tokens_per_batch:
+            buckets.append(bucket)
+            bucket = []
+        bucket.append(index)
+    if bucket:
+        buckets.append(bucket)
+    return buckets
+
+
+def eos_token_ids(tokenizer) -> list[int]:
+    return [
+        tokenizer.eos_token_id,
+        tokenizer.get_command("<|user|>"),
+        tokenizer.get_command("<|assistant|>"),
+    ]
+
+
+@torch.inference_mode()
+def generate_bucket(
+        model,
+        tokenizer,
+        prompts: list[str],
+        max_length: int,
+        logits_processor: LogitsProcessorList,
+        logits_warper: Optional[LogitsProcessorList],
+) -> Iterator[Tuple[int, str]]:
+    """
+    Decode one batch of prompts and yield `(row, response)` for every row as soon as it reaches EOS.
+    Finished rows leave the batch: their input ids, attention mask and KV cache are dropped, so the
+    remaining steps only run the rows that are still generating.
+    """
+    eos_token_id = torch.tensor(eos_token_ids(tokenizer), device=model.device)
+    inputs = tokenizer(prompts, return_tensors="pt", padding="longest").to(model.device)
+    input_ids, attention_mask = inputs["input_ids"], inputs["attention_mask"]
+    prompt_length = input_ids.shape[1]
+    # Left padding: every row counts its positions from its first real token.
+    position_ids = (attention_mask.cumsum(dim=-1) - 1).clamp(min=0)
+    rows = torch.arange(len(prompts), device=model.device)
+    step_ids, past_key_values = input_ids, None
+
+    max_new_tokens = max_length - prompt_length
+    if max_new_tokens < 1:
+        raise ValueError(f"Prompts of {prompt_length} tokens leave no room for new tokens "
+                         f"within max_length {max_length}")
+    for step in range(max_new_tokens):
+        outputs = model(
+            input_ids=step_ids,
+            position_ids=position_ids,
+            attention_mask=attention_mask,
+            past_key_values=past_key_values,
+            use_cache=True,
+            return_dict=True,
+        )
+        past_key_values = outputs.past_key_values
+        # The repetition penalty must not see the left padding, pad positions repeat the row's last token
+        # instead, which is penalized anyway.
+        penalty_ids = torch.where(attention_mask.bool(), input_ids, input_ids[:, -1:])
+        scores = logits_processor(penalty_ids, outputs.logits[:, -1, :].float())
+        if logits_warper is not None:
+            scores = logits_warper(penalty_ids, scores)
+            next_tokens = torch.multinomial(torch.softmax(scores, dim=-1), num_samples=1).squeeze(1)
+        else:
+            next_tokens = torch.argmax(scores, dim=-1)
+        input_ids = torch.cat((input_ids, next_tokens[:, None]), dim=1)
+
+        finished = torch.isin(next_tokens, eos_token_id)
+        if step == max_new_tokens - 1:
+            finished[:] = True
+        if finished.any():
+            responses = process_model_outputs(input_ids[finished], prompt_length, tokenizer)
+            yield from zip(rows[finished].tolist(), responses)
+            keep = (~finished).nonzero().squeeze(1)
+            if len(keep) == 0:
+                return
+            input_ids, attention_mask = input_ids[keep], attention_mask[keep]
+            position_ids, next_tokens, rows = position_ids[keep], next_tokens[keep], rows[keep]
+            # Columns that are padding in every remaining row can go too.
+            start = int(attention_mask.any(dim=0).nonzero()[0])
+            attention_mask = attention_mask[:, start:]
+            past_key_values = tuple(
+                tuple(tensor.index_select(KV_BATCH_DIM, keep)[start:] for tensor in layer)
+                for layer in past_key_values
+            )
+            input_ids, prompt_length = input_ids[:, start:], prompt_length - start
+
+        step_ids = next_tokens[:, None]
+        position_ids = position_ids[:, -1:] + 1
+        attention_mask = torch.cat((attention_mask, attention_mask.new_ones((len(rows), 1))), dim=1)
+
+
+def batch_stream(
+        model,
+        tokenizer,
+        prompts: Union[str, list[str]],
+        max_length: int = 8192,
+        do_sample: bool = True,
+        top_p: float = 0.8,
+        temperature: float = 0.8,
+        logits_processor: Optional[LogitsProcessorList] = LogitsProcessorList(),
+        max_tokens_per_batch: int = 8192,
+) -> Iterator[Tuple[int, str]]:
+    """
+    Yield `(index, response)` for every prompt as soon as its response is complete, in completion order.
+    """
+    tokenizer.encode_special_tokens = True
+    if isinstance(prompts, str):
+        prompts = [prompts]
+    lengths = [len(input_ids) for input_ids in tokenizer(prompts)["input_ids"]]
+
+    logits_warper = None
+    if do_sample:
+        logits_warper = LogitsProcessorList([TemperatureLogitsWarper(temperature), TopPLogitsWarper(top_p)])
+    for bucket in bucket_by_length(lengths, max_tokens_per_batch):
+        for row, response in generate_bucket(model, tokenizer, [prompts[i] for i in bucket], max_length,
+                                             logits_processor, logits_warper):
+            yield bucket[row], response
 
 
 def batch(
@@ -45,18 +168,20 @@ def batch(
         top_p: float = 0.8,
         temperature: float = 0.8,
         logits_processor: Optional[LogitsProcessorList] = LogitsProcessorList(),
+        max_tokens_per_batch: int = 8192,
 ):
-    tokenizer.encode_special_tokens = True
     if isinstance(prompts, str):
         prompts = [prompts]
-    batched_inputs = tokenizer(prompts, return_tensors="pt", padding="longest")
-    batched_inputs = batched_inputs.to(model.device)
-
-    eos_token_id = [
-        tokenizer.eos_token_id,
-        tokenizer.get_command("<|user|>"),
-        tokenizer.get_command("<|assistant|>"),
-    ]
+    batched_response = [None] * len(prompts)
+    if num_beams == 1:
+        for index, response in batch_stream(model, tokenizer, prompts, max_length, do_sample, top_p, temperature,
+                                            logits_processor, max_tokens_per_batch):
+            batched_response[index] = response
+        return batched_response
+
+    # Beam search keeps every row until the end, leave it to `model.generate`.
+    tokenizer.encode_special_tokens = True
+    lengths = [len(input_ids) for input_ids in tokenizer(prompts)["input_ids"]]
     gen_kwargs = {
         "max_length": max_length,
         "num_beams": num_beams,
@@ -64,17 +189,19 @@ def batch(
         "top_p": top_p,
         "temperature": temperature,
         "logits_processor": logits_processor,
-        "eos_token_id": eos_token_id,
+        "eos_token_id": eos_token_ids(tokenizer),
     }
-    batched_outputs = model.generate(**batched_inputs, **gen_kwargs)
-    batched_response = []
-    for input_ids, output_ids in zip(batched_inputs.input_ids, batched_outputs):
-        decoded_text = tokenizer.decode(output_ids[len(input_ids):])
-        batched_response.append(decoded_text.strip())
+    for bucket in bucket_by_length(lengths, max_tokens_per_batch):
+        batched_inputs = tokenizer([prompts[i] for i in bucket], return_tensors="pt", padding="longest")
+        batched_inputs = batched_inputs.to(model.device)
+        batched_outputs = model.generate(**batched_inputs, **gen_kwargs)
+        prompt_length = batched_inputs["input_ids"].shape[1]
+        for index, response in zip(bucket, process_model_outputs(batched_outputs, prompt_length, tokenizer)):
+            batched_response[index] = response
     return batched_response
 
 
-def main(batch_queries):
+def main(model, tokenizer, batch_queries):
     gen_kwargs = {
         "max_length": 2048,
         "do_sample": True,
@@ -87,6 +214,8 @@ def main(batch_queries):
 
 
 if __name__ == "__main__":
+    tokenizer = AutoTokenizer.from_pretrained(TOKENIZER_PATH, trust_remote_code=True)
+    model = AutoModel.from_pretrained(MODEL_PATH, trust_remote_code=True, device_map="auto").eval()
     batch_queries = [
         "<|user|>\n讲个故事\n<|assistant|>",
         "<|user|>\n讲个爱情故事\n<|assistant|>",
@@ -98,7 +227,8 @@ if __name__ == "__main__":
         "<|user|>\n讲个工作故事\n<|assistant|>",
         "<|user|>\n讲个旅游的故事\n<|assistant|>",
     ]
-    batch_responses = main(batch_queries)
-    for response in batch_responses:
+    # Responses are printed as they finish, short stories first.
+    for index, response in batch_stream(model, tokenizer, batch_queries, max_length=2048):
         print("=" * 10)
+        print(batch_queries[index].strip())
         print(response)
@@ -0,0 +1,78 @@
+import types
+
+import pytest
+import torch
+from transformers import BatchEncoding, LogitsProcessorList, RepetitionPenaltyLogitsProcessor
+
+import cli_batch_request_demo as demo
+
+
+class FakeTokenizer:
+    """
+    One token per character, left padding with id 0.
+    """
+    pad_token_id = 0
+    eos_token_id = 2
+    encode_special_tokens = False
+
+    def get_command(self, token):
+        return {"<|user|>": 3, "<|assistant|>": 4}[token]
+
+    def __call__(self, prompts, return_tensors=None, padding=False):
+        input_ids = [[10 + ord(char) % 50 for char in prompt] for prompt in prompts]
+        if return_tensors is None:
+            return {"input_ids": input_ids}
+        length = max(len(ids) for ids in input_ids)
+        return BatchEncoding({
+            "input_ids": torch.tensor([[0] * (length - len(ids)) + ids for ids in input_ids]),
+            "attention_mask": torch.tensor([[0] * (length - len(ids)) + [1] * len(ids) for ids in input_ids]),
+        })
+
+    def batch_decode(self, token_ids, skip_special_tokens=True):
+        return [" ".join(str(token) for token in ids) for ids in token_ids.tolist()]
+
+
+class FakeModel:
+    """
+    Always predicts token 7.
+    """
+    device = torch.device("cpu")
+
+    def __call__(self, input_ids, **kwargs):
+        logits = torch.zeros(input_ids.shape[0], input_ids.shape[1], 64)
+        logits[..., 7] = 1.0
+        return types.SimpleNamespace(logits=logits, past_key_values=())
+
+
+class PadPreferringModel(FakeModel):
+    """
+    Prefers the pad id 0 over token 7, unless a repetition penalty pushes 0 below 7.
+    """
+
+    def __call__(self, input_ids, **kwargs):
+        outputs = super().__call__(input_ids, **kwargs)
+        outputs.logits[..., 7] = 0.9
+        outputs.logits[..., 0] = 1.0
+        return outputs
+
+
+def test_prompt_too_long_for_max_length():
+    with pytest.raises(ValueError, match="max_length 4"):
+        demo.batch(FakeModel(), FakeTokenizer(), ["abcd", "ab"], max_length=4, do_sample=False)
+
+
+def test_prompt_with_room_for_one_token():
+    assert demo.batch(FakeModel(), FakeTokenizer(), ["abcd", "ab"], max_length=5, do_sample=False) == ["7", "7"]
+
+
+def test_repetition_penalty_ignores_left_padding():
+    penalty = LogitsProcessorList([RepetitionPenaltyLogitsProcessor(2.0)])
+    # Three new tokens for every prompt, alone and batched.
+    single = [
+        demo.batch(PadPreferringModel(), FakeTokenizer(), [prompt], max_length=len(prompt) + 3, do_sample=False,
+                   logits_processor=penalty)[0]
+        for prompt in ["abcd", "ab"]
+    ]
+    assert single == ["0 7 0", "0 7 0"]
+    assert demo.batch(PadPreferringModel(), FakeTokenizer(), ["abcd", "ab"], max_length=7, do_sample=False,
+                      logits_processor=penalty) == single
@@ -0,0 +1,226 @@
+"""
+Serve many ChatGLM3-6B fine-tunes from one base model in the OpenAI-style API.
+
+The fine-tuning demos produce two kinds of lightweight adapters:
+- P-tuning v2 (`finetune_chatmodel_demo`, `PrefixTrainer`): a `prefix_encoder` that turns `pre_seq_len` virtual
+  tokens into key/value pairs for every layer. Its output does not depend on the prompt, so it is computed once
+  when the adapter is loaded and a request simply starts from that prefix KV cache. The base model config keeps
+  `pre_seq_len=None`, requests for different prefixes (or none) can share one batch.
+- LoRA (`finetune_basemodel_demo`, `LoRATrainer`): low-rank updates of `query_key_value`. Those layers are wrapped
+  by `LoRALinear`, which adds the update of each batch row's own adapter, so LoRA requests share the batch too.
+
+Key Components:
+- AdapterRegistry: maps the adapter names of `ADAPTERS` to checkpoints and keeps the loaded ones in an LRU.
+- activate_adapters: selects the adapter of every batch row before a forward pass.
+
+Note:
+    ChatGLM3 hidden states are shaped `[seq_len, batch, hidden_size]`, batch rows are on dimension 1.
+"""
+
+import os
+import re
+import threading
+
+import torch
+
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+from loguru import logger
+from transformers import PreTrainedModel
+from kv_cache import PastKeyValues, past_key_values_nbytes
+
+# Batch dimension of ChatGLM3 hidden states: [seq_len, batch, hidden_size]
+HIDDEN_BATCH_DIM = 1
+
+PREFIX_ENCODER_PREFIX = "transformer.prefix_encoder."
+LORA_KEY_PATTERN = re.compile(r"layers\.(\d+)\.self_attention\.query_key_value\.lora_([AB])\.")
+
+
+class Adapter:
+    """
+    A loaded adapter: either the prefix KV cache of a P-tuning checkpoint or the LoRA weights per layer.
+    """
+
+    def __init__(self, name: str, past_key_values: Optional[PastKeyValues] = None,
+                 lora_weights: Optional[Dict[int, Tuple[torch.Tensor, torch.Tensor]]] = None, scaling: float = 1.0):
+        self.name = name
+        self.past_key_values = past_key_values
+        self.lora_weights = lora_weights or {}
+        self.scaling = scaling
+
+    @property
+    def kind(self) -> str:
+        return "ptuning" if self.past_key_values is not None else "lora"
+
+    @property
+    def nbytes(self) -> int:
+        nbytes = past_key_values_nbytes(self.past_key_values) if self.past_key_values is not None else 0
+        return nbytes + sum(a.numel() * a.element_size() + b.numel() * b.element_size()
+                            for a, b in self.lora_weights.values())
+
+
+class LoRALinear(torch.nn.Module):
+    """
+    `query_key_value` plus the LoRA update of the adapter selected for each batch row.
+    """
+
+    def __init__(self, base: torch.nn.Module, layer_number: int):
+        super().__init__()
+        self.base = base
+        self.layer_number = layer_number
+        self.row_adapters: List[Optional[Adapter]] = []
+
+    def forward(self, hidden_states: torch.Tensor) -> torch.Tensor:
+        output = self.base(hidden_states)
+        rows: Dict[int, Tuple[Adapter, List[int]]] = {}
+        for row, adapter in enumerate(self.row_adapters):
+            if adapter is not None and self.layer_number in adapter.lora_weights:
+                rows.setdefault(id(adapter), (adapter, []))[1].append(row)
+        for adapter, index in rows.values():
+            lora_a, lora_b = adapter.lora_weights[self.layer_number]
+            index = torch.tensor(index, dtype=torch.long, device=hidden_states.device)
+            delta = hidden_states.index_select(HIDDEN_BATCH_DIM, index) @ lora_a.t() @ lora_b.t()
+            output = output.index_add(HIDDEN_BATCH_DIM, index, delta * adapter.scaling)
+        return output
+
+
+def _layers(model: PreTrainedModel):
+    return model.transformer.encoder.layers
+
+
+def install_lora_layers(model: PreTrainedModel):
+    """
+    Wrap `query_key_value` of every layer in a `LoRALinear`, a no-op until adapters are activated.
+    """
+    model.lora_layers = []
+    for layer_number, layer in enumerate(_layers(model)):
+        attention = layer.self_attention
+        if not isinstance(attention.query_key_value, LoRALinear):
+            attention.query_key_value = LoRALinear(attention.query_key_value, layer_number)
+        model.lora_layers.append(attention.query_key_value)
+
+
+def activate_adapters(model: PreTrainedModel, adapters: List[Optional[Adapter]]):
+    """
+    Select the adapter of every batch row, None for the base model, for the following forward passes.
+    """
+    for module in getattr(model, "lora_layers", ()):
+        module.row_adapters = adapters
+
+
+def _prefix_past_key_values(model: PreTrainedModel, state_dict: Dict[str, torch.Tensor]) -> PastKeyValues:
+    """
+    Run the P-tuning `PrefixEncoder` once, the same way `ChatGLMModel.get_prompt` does for each request.
+    """
+    config = model.config
+    prefix = state_dict["embedding.weight"].float()
+    if "trans.0.weight" in state_dict:
+        # prefix_projection=True: a two-layer MLP on top of the embedding
+        prefix = torch.nn.functional.linear(prefix, state_dict["trans.0.weight"].float(),
+                                            state_dict["trans.0.bias"].float())
+        prefix = torch.nn.functional.linear(torch.tanh(prefix), state_dict["trans.2.weight"].float(),
+                                            state_dict["trans.2.bias"].float())
+    pre_seq_len = prefix.shape[0]
+    prefix = prefix.view(pre_seq_len, config.num_layers * 2, config.multi_query_group_num, config.kv_channels)
+    # [num_layers * 2, pre_seq_len, batch=1, multi_query_group_num, kv_channels]
+    prefix = prefix.permute(1, 0, 2, 3).unsqueeze(2)
+
+    past_key_values = []
+    for layer_number, layer in enumerate(_layers(model)):
+        weight = next(layer.parameters())
+        past_key_values.append(tuple(
+            prefix[2 * layer_number + i].to(device=weight.device, dtype=weight.dtype).contiguous() for i in range(2)
+        ))
+    return tuple(past_key_values)
+
+
+def load_adapter(model: PreTrainedModel, name: str, path: str, lora_alpha: float = 32.0) -> Adapter:
+    """
+    Load a P-tuning or LoRA checkpoint, the kind is told from the saved parameter names.
+    """
+    if os.path.isdir(path):
+        path = os.path.join(path, "pytorch_model.bin")
+    # LoRATrainer may save the whole model, mmap only reads the adapter tensors.
+    state_dict = torch.load(path, map_location="cpu", mmap=True)
+
+    prefix_state_dict = {
+        key[len(PREFIX_ENCODER_PREFIX):]: value for key, value in state_dict.items()
+        if key.startswith(PREFIX_ENCODER_PREFIX)
+    }
+    if prefix_state_dict:
+        return Adapter(name, past_key_values=_prefix_past_key_values(model, prefix_state_dict))
+
+    lora_state_dict: Dict[int, Dict[str, torch.Tensor]] = {}
+    for key, value in state_dict.items():
+        match = LORA_KEY_PATTERN.search(key)
+        if match:
+            lora_state_dict.setdefault(int(match.group(1)), {})[match.group(2)] = value
+    if not lora_state_dict:
+        raise ValueError(f"{path} holds neither a P-tuning prefix encoder nor LoRA weights")
+
+    layers = _layers(model)
+    lora_weights, rank = {}, None
+    for layer_number, weights in lora_state_dict.items():
+        weight = next(layers[layer_number].parameters())
+        lora_weights[layer_number] = tuple(
+            weights[part].to(device=weight.device, dtype=weight.dtype) for part in ("A", "B")
+        )
+        rank = weights["A"].shape[0]
+    return Adapter(name, lora_weights=lora_weights, scaling=lora_alpha / rank)
+
+
+def parse_adapters(spec: str) -> Dict[str, str]:
+    """
+    Parse `name=path,name=path` into a mapping of adapter names to checkpoint paths.
+    """
+    adapters = {}
+    for item in spec.split(","):
+        if item.strip():
+            name, path = item.split("=", maxsplit=1)
+            adapters[name.strip()] = path.strip()
+    return adapters
+
+
+class AdapterRegistry:
+    """
+    The adapters that can be requested by model name, at most `max_loaded` of them are kept loaded.
+
+    Requests hold a reference to their `Adapter`, so evicting it never disturbs a running generation.
+    """
+
+    def __init__(self, model: PreTrainedModel, paths: Dict[str, str], max_loaded: int = 4, lora_alpha: float = 32.0):
+        self.model = model
+        self.paths = paths
+        self.max_loaded = max_loaded
+        self.lora_alpha = lora_alpha
+        self.hits = 0
+        self.misses = 0
+        self._loaded: "OrderedDict[str, Adapter]" = OrderedDict()
+        self._lock = threading.Lock()
+        install_lora_layers(model)
+
+    @property
+    def names(self) -> List[str]:
+        return list(self.paths)
+
+    def get(self, name: str) -> Optional[Adapter]:
+        """
+        Return the adapter called `name`, loading it if needed, or None when it is not an adapter name.
+        """
+        if name not in self.paths:
+            return None
+        with self._lock:
+            adapter = self._loaded.get(name)
+            if adapter is not None:
+                self._loaded.move_to_end(name)
+                self.hits += 1
+                return adapter
+
+            self.misses += 1
+            adapter = load_adapter(self.model, name, self.paths[name], self.lora_alpha)
+            logger.info(f"Loaded {adapter.kind} adapter {name} ({adapter.nbytes / 2 ** 20:.1f} MB)")
+            self._loaded[name] = adapter
+            while len(self._loaded) > self.max_loaded:
+                evicted, _ = self._loaded.popitem(last=False)
+                logger.debug(f"Evicted adapter {evicted}")
+            return adapter
@@ -0,0 +1,108 @@
+"""
+Admission control for the chat endpoint of the ChatGLM3-6B OpenAI-style API.
+
+Every generation needs a permit before it reaches the model. Permits are limited both by the number of
+in-flight generations and by a token budget, where a request costs its prompt tokens plus `max_tokens`,
+so a few huge requests cannot take all the memory. Requests that do not fit wait in a bounded FIFO queue
+for at most `timeout` seconds; when the queue is full or the wait times out the request is rejected
+right away, and the API answers 429 with a Retry-After header instead of piling up work.
+
+All methods run on the asyncio event loop, no locking is needed.
+"""
+
+import asyncio
+
+from collections import deque
+from metrics import ADMISSION_QUEUE, REJECTED_REQUESTS
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class Permit:
+    """
+    Granted admission for one generation, `release` gives its slot and tokens back.
+    """
+
+    def __init__(self, controller: "AdmissionController", cost: int):
+        self._controller = controller
+        self.cost = cost
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self._controller._release(self.cost)
+
+
+class AdmissionController:
+    def __init__(self, max_requests: int, max_tokens: int, max_queue: int, timeout: float, retry_after: int = 1):
+        self.max_requests = max_requests
+        self.max_tokens = max_tokens
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self.running = 0
+        self.tokens = 0
+        self._waiters = deque()
+
+    async def acquire(self, cost: int) -> Permit:
+        """
+        Wait for a permit for a request of `cost` tokens, raise `AdmissionRejected` when there is no room.
+        """
+        if not self._waiters and self._can_admit(cost):
+            self._grant(cost)
+            return Permit(self, cost)
+
+        if len(self._waiters) >= self.max_queue:
+            REJECTED_REQUESTS.labels("queue_full").inc()
+            raise AdmissionRejected("Too many requests waiting", self.retry_after)
+
+        waiter = (cost, asyncio.get_running_loop().create_future())
+        self._waiters.append(waiter)
+        ADMISSION_QUEUE.set(len(self._waiters))
+        try:
+            await asyncio.wait_for(waiter[1], self.timeout)
+        except BaseException as e:
+            if waiter[1].done() and not waiter[1].cancelled():
+                # The permit was granted while this request gave up, hand it back.
+                self._release(cost)
+            if isinstance(e, asyncio.TimeoutError):
+                REJECTED_REQUESTS.labels("timeout").inc()
+                raise AdmissionRejected("Timed out waiting for a generation slot", self.retry_after)
+            raise
+        finally:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+                ADMISSION_QUEUE.set(len(self._waiters))
+                # The head of the queue may have been blocking smaller requests behind it.
+                self._wake()
+        return Permit(self, cost)
+
+    def _can_admit(self, cost: int) -> bool:
+        if self.running >= self.max_requests:
+            return False
+        # A request larger than the whole budget may still run, but only on its own.
+        return self.running == 0 or self.tokens + cost <= self.max_tokens
+
+    def _grant(self, cost: int):
+        self.running += 1
+        self.tokens += cost
+
+    def _release(self, cost: int):
+        self.running -= 1
+        self.tokens -= cost
+        self._wake()
+
+    def _wake(self):
+        while self._waiters and self._can_admit(self._waiters[0][0]):
+            cost, future = self._waiters.popleft()
+            if future.done():
+                continue
+            self._grant(cost)
+            future.set_result(None)
+        ADMISSION_QUEUE.set(len(self._waiters))
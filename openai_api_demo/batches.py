@@ -0,0 +1,355 @@
+"""
+Offline batch jobs for the ChatGLM3-6B OpenAI-style API, compatible with the OpenAI Files and Batch APIs.
+
+A JSONL file of chat requests (`{"custom_id": ..., "method": "POST", "url": "/v1/chat/completions", "body": {...}}`
+per line, like the OpenAI batch input format) is uploaded to "/v1/files" and run by creating a batch on
+"/v1/batches". Results are written to an output file (and failed requests to an error file) as they finish,
+one JSONL line per request in the OpenAI batch output format.
+
+Key Components:
+- BatchRunner: runs batches in the background on the event loop, through the same generation path as
+  "/v1/chat/completions". Throughput matters more than latency here: the requests of a batch are sorted by
+  prompt length, so requests of similar length share the running batch, and `concurrency` of them are kept
+  in flight to keep the batch full.
+- Persistence: uploaded files, batch states and results live under one directory. A finished request is
+  appended to the output file right away, so after a restart unfinished batches resume with the requests
+  that have no result yet. While a batch runs, its file reads and writes happen on worker threads, so
+  its disk I/O never holds up the event loop that serves live traffic.
+"""
+
+import asyncio
+import json
+import os
+import time
+import uuid
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable, Deque, Dict, List, Literal, Optional, Set, Tuple
+from fastapi import HTTPException
+from loguru import logger
+from pydantic import BaseModel, Field
+
+BATCH_ENDPOINTS = ("/v1/chat/completions",)
+
+
+class FileObject(BaseModel):
+    id: str
+    object: Literal["file"] = "file"
+    bytes: int
+    created_at: int = Field(default_factory=lambda: int(time.time()))
+    filename: str
+    purpose: str
+
+
+class BatchRequestCounts(BaseModel):
+    total: int = 0
+    completed: int = 0
+    failed: int = 0
+
+
+class BatchError(BaseModel):
+    code: str
+    message: str
+    line: Optional[int] = None
+
+
+class BatchErrors(BaseModel):
+    object: Literal["list"] = "list"
+    data: List[BatchError] = []
+
+
+class Batch(BaseModel):
+    id: str
+    object: Literal["batch"] = "batch"
+    endpoint: str
+    errors: Optional[BatchErrors] = None
+    input_file_id: str
+    completion_window: str
+    status: Literal["validating", "failed", "in_progress", "finalizing", "completed", "cancelling", "cancelled"]
+    output_file_id: Optional[str] = None
+    error_file_id: Optional[str] = None
+    created_at: int = Field(default_factory=lambda: int(time.time()))
+    in_progress_at: Optional[int] = None
+    finalizing_at: Optional[int] = None
+    completed_at: Optional[int] = None
+    failed_at: Optional[int] = None
+    cancelling_at: Optional[int] = None
+    cancelled_at: Optional[int] = None
+    request_counts: BatchRequestCounts = Field(default_factory=BatchRequestCounts)
+    metadata: Optional[Dict[str, str]] = None
+
+
+class BatchCreateRequest(BaseModel):
+    input_file_id: str
+    endpoint: str
+    completion_window: str = "24h"
+    metadata: Optional[Dict[str, str]] = None
+
+
+class BatchList(BaseModel):
+    object: Literal["list"] = "list"
+    data: List[Batch] = []
+    has_more: bool = False
+
+
+def _request_length(request: dict) -> int:
+    """
+    Characters of the messages and tools, a cheap stand-in for the prompt length in tokens.
+    """
+    body = request["body"]
+    return sum(len(str(message.get("content") or "")) for message in body.get("messages") or []) + \
+        len(json.dumps(body.get("tools") or "", ensure_ascii=False))
+
+
+class BatchRunner:
+    """
+    Stores files and batches under `directory` and runs the batches with `handler`, which takes the body of one
+    request and returns its response body, or raises an `HTTPException`.
+    """
+
+    def __init__(self, directory: str, handler: Callable[[dict], Awaitable[dict]], concurrency: int = 8):
+        self.directory = directory
+        self.handler = handler
+        self.concurrency = concurrency
+        self.batches: Dict[str, Batch] = {}
+        self._tasks: Dict[str, asyncio.Task] = {}
+        # Batch states are written on one thread, in the order their changes were made.
+        self._state_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="batch-state")
+        os.makedirs(os.path.join(directory, "files"), exist_ok=True)
+        os.makedirs(os.path.join(directory, "batches"), exist_ok=True)
+
+    def start(self):
+        """
+        Load the stored batches and resume the unfinished ones, must be called on the event loop.
+        """
+        for name in sorted(os.listdir(os.path.join(self.directory, "batches"))):
+            if not name.endswith(".json"):
+                continue
+            with open(os.path.join(self.directory, "batches", name), encoding="utf-8") as f:
+                batch = Batch.model_validate_json(f.read())
+            self.batches[batch.id] = batch
+            if batch.status == "cancelling":
+                self._set_status(batch, "cancelled")
+            elif batch.status in ("validating", "in_progress", "finalizing"):
+                logger.info(f"Resuming batch {batch.id} ({batch.status})")
+                self._schedule(batch)
+        return self
+
+    async def stop(self):
+        for task in self._tasks.values():
+            task.cancel()
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+
+    def create_file(self, filename: str, purpose: str, content: bytes) -> FileObject:
+        file = FileObject(id=f"file-{uuid.uuid4().hex}", bytes=len(content), filename=filename, purpose=purpose)
+        with open(self.file_path(file.id), "wb") as f:
+            f.write(content)
+        self._write_json(self._file_info_path(file.id), file)
+        return file
+
+    def get_file(self, file_id: str) -> Optional[FileObject]:
+        path = self._file_info_path(file_id)
+        if not os.path.exists(path):
+            return None
+        with open(path, encoding="utf-8") as f:
+            file = FileObject.model_validate_json(f.read())
+        # Output files grow while their batch runs.
+        file.bytes = os.path.getsize(self.file_path(file_id))
+        return file
+
+    def file_path(self, file_id: str) -> str:
+        return os.path.join(self.directory, "files", f"{os.path.basename(file_id)}.jsonl")
+
+    def create_batch(self, request: BatchCreateRequest) -> Batch:
+        if request.endpoint not in BATCH_ENDPOINTS:
+            raise HTTPException(status_code=400, detail=f"endpoint must be one of {', '.join(BATCH_ENDPOINTS)}")
+        if self.get_file(request.input_file_id) is None:
+            raise HTTPException(status_code=404, detail=f"No such file: {request.input_file_id}")
+        batch = Batch(
+            id=f"batch_{uuid.uuid4().hex}",
+            endpoint=request.endpoint,
+            input_file_id=request.input_file_id,
+            completion_window=request.completion_window,
+            status="validating",
+            metadata=request.metadata,
+        )
+        self.batches[batch.id] = batch
+        self._save(batch)
+        self._schedule(batch)
+        return batch
+
+    def cancel_batch(self, batch_id: str) -> Optional[Batch]:
+        batch = self.batches.get(batch_id)
+        if batch is not None and batch.status in ("validating", "in_progress"):
+            self._set_status(batch, "cancelling")
+            if batch.id not in self._tasks:
+                self._set_status(batch, "cancelled")
+        return batch
+
+    def _schedule(self, batch: Batch):
+        task = asyncio.create_task(self._run(batch))
+        self._tasks[batch.id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(batch.id, None))
+
+    async def _run(self, batch: Batch):
+        try:
+            requests, errors = await asyncio.to_thread(self._validate, batch)
+            if errors:
+                batch.errors = BatchErrors(data=errors)
+                await self._update_status(batch, "failed")
+                return
+            if batch.status == "cancelling":
+                await self._update_status(batch, "cancelled")
+                return
+            if batch.status == "validating":
+                if batch.output_file_id is None:
+                    batch.output_file_id = (await asyncio.to_thread(
+                        self.create_file, f"{batch.id}_output.jsonl", "batch_output", b"")).id
+                if batch.error_file_id is None:
+                    batch.error_file_id = (await asyncio.to_thread(
+                        self.create_file, f"{batch.id}_error.jsonl", "batch_output", b"")).id
+                batch.request_counts = BatchRequestCounts(total=len(requests))
+                await self._update_status(batch, "in_progress")
+
+            finished, batch.request_counts = await asyncio.to_thread(self._finished_requests, batch)
+            pending = deque(sorted((request for request in requests if request["custom_id"] not in finished),
+                                   key=_request_length))
+            logger.info(f"Batch {batch.id}: {len(pending)} of {len(requests)} requests to run")
+            await asyncio.gather(*(self._worker(batch, pending) for _ in range(self.concurrency)))
+
+            if batch.status == "cancelling":
+                await self._update_status(batch, "cancelled")
+            else:
+                await self._update_status(batch, "finalizing")
+                await self._update_status(batch, "completed")
+        except asyncio.CancelledError:
+            # Server shutdown, the stored state lets the next start resume the batch.
+            self._save(batch)
+            raise
+        except Exception as e:
+            logger.exception(f"Batch {batch.id} failed")
+            batch.errors = BatchErrors(data=[BatchError(code="batch_failed", message=str(e))])
+            await self._update_status(batch, "failed")
+
+    async def _worker(self, batch: Batch, pending: Deque[dict]):
+        while pending and batch.status != "cancelling":
+            request = pending.popleft()
+            status_code, body = await self._call(request["body"])
+            line = json.dumps({
+                "id": f"batch_req_{uuid.uuid4().hex}",
+                "custom_id": request["custom_id"],
+                "response": {"status_code": status_code, "request_id": uuid.uuid4().hex, "body": body},
+                "error": None,
+            }, ensure_ascii=False)
+            file_id = batch.output_file_id if status_code == 200 else batch.error_file_id
+            await asyncio.to_thread(self._append_line, self.file_path(file_id), line)
+            if status_code == 200:
+                batch.request_counts.completed += 1
+            else:
+                batch.request_counts.failed += 1
+
+    async def _call(self, body: dict) -> Tuple[int, dict]:
+        while True:
+            try:
+                return 200, await self.handler(body)
+            except HTTPException as e:
+                if e.status_code != 429:
+                    return e.status_code, {"error": {"message": str(e.detail), "code": e.status_code}}
+                # Admission control is full with interactive traffic, wait for room instead of failing.
+                await asyncio.sleep(float((e.headers or {}).get("Retry-After", 1)))
+            except Exception as e:
+                logger.exception("Batch request failed")
+                return 500, {"error": {"message": str(e), "code": 500}}
+
+    def _validate(self, batch: Batch) -> Tuple[List[dict], List[BatchError]]:
+        """
+        Parse the input file into its requests and the errors of its invalid lines.
+        """
+        requests, errors, custom_ids = [], [], set()
+        with open(self.file_path(batch.input_file_id), encoding="utf-8") as f:
+            for line_number, line in enumerate(f, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    request = json.loads(line)
+                except json.JSONDecodeError as e:
+                    errors.append(BatchError(code="invalid_json_line", message=str(e), line=line_number))
+                    continue
+                if not isinstance(request, dict) or not isinstance(request.get("body"), dict):
+                    errors.append(BatchError(code="invalid_request", message="Missing body", line=line_number))
+                elif request.get("url", batch.endpoint) != batch.endpoint:
+                    errors.append(BatchError(code="mismatched_url", line=line_number,
+                                             message=f"The url must be the batch endpoint {batch.endpoint}"))
+                elif request.get("custom_id") is None or request["custom_id"] in custom_ids:
+                    errors.append(BatchError(code="duplicate_custom_id", line=line_number,
+                                             message="Every request needs a unique custom_id"))
+                else:
+                    custom_ids.add(request["custom_id"])
+                    requests.append(request)
+        return requests, errors
+
+    def _finished_requests(self, batch: Batch) -> Tuple[Set[str], BatchRequestCounts]:
+        """
+        Collect the custom ids that already have a result, and recount them after a restart.
+        """
+        finished, counts = set(), BatchRequestCounts(total=batch.request_counts.total)
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            path = self.file_path(file_id)
+            with open(path, "rb+") as f:
+                content = f.read()
+                # A line cut short by a crash has no result, drop it.
+                f.truncate(content.rfind(b"\n") + 1)
+            for line in content.splitlines(keepends=True):
+                if line.endswith(b"\n"):
+                    finished.add(json.loads(line)["custom_id"])
+                    if file_id == batch.output_file_id:
+                        counts.completed += 1
+                    else:
+                        counts.failed += 1
+        return finished, counts
+
+    def _set_status(self, batch: Batch, status: str):
+        self._stamp(batch, status)
+        self._save(batch)
+
+    async def _update_status(self, batch: Batch, status: str):
+        """
+        `_set_status` for running batches, without waiting on the disk in the event loop.
+        """
+        self._stamp(batch, status)
+        await asyncio.wrap_future(self._submit_save(batch))
+
+    @staticmethod
+    def _stamp(batch: Batch, status: str):
+        batch.status = status
+        if f"{status}_at" in Batch.model_fields:
+            setattr(batch, f"{status}_at", int(time.time()))
+
+    def _save(self, batch: Batch):
+        self._submit_save(batch).result()
+
+    def _submit_save(self, batch: Batch):
+        return self._state_writer.submit(self._write_text, self._batch_path(batch.id), batch.model_dump_json())
+
+    def _batch_path(self, batch_id: str) -> str:
+        return os.path.join(self.directory, "batches", f"{batch_id}.json")
+
+    def _file_info_path(self, file_id: str) -> str:
+        return os.path.join(self.directory, "files", f"{os.path.basename(file_id)}.json")
+
+    @classmethod
+    def _write_json(cls, path: str, model: BaseModel):
+        cls._write_text(path, model.model_dump_json())
+
+    @staticmethod
+    def _write_text(path: str, text: str):
+        # Write and rename, a crash never leaves a half-written state behind.
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(path + ".tmp", path)
+
+    @staticmethod
+    def _append_line(path: str, line: str):
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
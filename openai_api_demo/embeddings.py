@@ -0,0 +1,208 @@
+"""
+Embedding helpers for the `/v1/embeddings` endpoint of the ChatGLM3-6B OpenAI-style API.
+
+Key Components:
+- EmbeddingCache: an LRU cache of embeddings keyed by model name and text hash, with hit/miss counters.
+  RAG indexing jobs send the same chunks over and over, those are served without running the model.
+- encode_texts: encodes the whole input list with one batched `SentenceTransformer.encode` call,
+  only for the texts that are neither cached nor repeated within the request.
+- encode_base64: packs embeddings for `encoding_format="base64"` straight from the numpy buffer, optionally
+  quantized to float16 or int8, instead of converting every element to a Python float for JSON.
+- EmbeddingBatcher: merges concurrent `/v1/embeddings` requests into shared forward passes. Requests are
+  collected for a short time window or up to a maximum number of texts, encoded together on a worker
+  thread, and the results are scattered back to each caller.
+"""
+
+import asyncio
+import base64
+import hashlib
+import queue
+import threading
+import time
+
+import numpy as np
+
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+from loguru import logger
+from metrics import EMBEDDING_BATCH_TEXTS
+
+
+class EmbeddingCache:
+    """
+    Thread-safe LRU cache of embedding vectors.
+    """
+
+    def __init__(self, max_size: int = 10000):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(model: str, text: str) -> tuple:
+        return model, hashlib.sha256(text.encode("utf-8")).digest()
+
+    def get(self, model: str, text: str) -> Optional[np.ndarray]:
+        key = self.key(model, text)
+        with self._lock:
+            embedding = self._entries.get(key)
+            if embedding is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return embedding
+
+    def put(self, model: str, text: str, embedding: np.ndarray):
+        key = self.key(model, text)
+        with self._lock:
+            self._entries[key] = embedding
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def encode_texts(embedding_model, texts: List[str], model: str, cache: Optional[EmbeddingCache] = None,
+                 batch_size: int = 32) -> List[np.ndarray]:
+    """
+    Embed `texts` in input order with a single batched `encode` call for everything not found in `cache`.
+    """
+    embeddings: List[Optional[np.ndarray]] = [None] * len(texts)
+    missing = OrderedDict()
+    for index, text in enumerate(texts):
+        embedding = cache.get(model, text) if cache is not None else None
+        if embedding is None:
+            missing.setdefault(text, []).append(index)
+        else:
+            embeddings[index] = embedding
+
+    if missing:
+        encoded = embedding_model.encode(list(missing), batch_size=batch_size)
+        for (text, indices), embedding in zip(missing.items(), encoded):
+            if cache is not None:
+                cache.put(model, text, embedding)
+            for index in indices:
+                embeddings[index] = embedding
+    return embeddings
+
+
+def encode_base64(embeddings: List[np.ndarray], dtype: str = "float32") -> Tuple[List[str], Optional[np.ndarray]]:
+    """
+    Base64-encode every embedding as a little-endian buffer of `dtype` ("float32", "float16" or "int8").
+
+    "float32" matches the OpenAI `encoding_format="base64"` output. "int8" uses symmetric per-vector
+    quantization and also returns the scales: `embedding ~= int8_values * scale`.
+    """
+    matrix = np.asarray(embeddings, dtype="<f4")
+    scales = None
+    if dtype == "float16":
+        matrix = matrix.astype("<f2")
+    elif dtype == "int8":
+        scales = np.abs(matrix).max(axis=1) / 127
+        scales[scales == 0] = 1
+        matrix = np.round(matrix / scales[:, None]).astype(np.int8)
+    elif dtype != "float32":
+        raise ValueError(f"Unsupported embedding dtype: {dtype}")
+    return [base64.b64encode(row.tobytes()).decode("ascii") for row in matrix], scales
+
+
+class _EmbeddingTask:
+    def __init__(self, texts: List[str], model: str, loop: asyncio.AbstractEventLoop):
+        self.texts = texts
+        self.model = model
+        self.loop = loop
+        self.future = loop.create_future()
+
+    def set_result(self, result):
+        self.loop.call_soon_threadsafe(_resolve, self.future, result)
+
+
+def _resolve(future: asyncio.Future, result):
+    if future.done():
+        return
+    if isinstance(result, Exception):
+        future.set_exception(result)
+    else:
+        future.set_result(result)
+
+
+class EmbeddingBatcher:
+    """
+    Micro-batches embedding requests from many concurrent callers into one `encode` call.
+
+    The worker thread starts a batch with the first waiting request, then keeps collecting requests
+    for at most `max_wait` seconds or until `max_batch_texts` texts are gathered. A request that
+    arrives alone therefore waits at most `max_wait` before it is encoded.
+    """
+
+    def __init__(self, embedding_model, cache: Optional[EmbeddingCache] = None, batch_size: int = 32,
+                 max_batch_texts: int = 256, max_wait: float = 0.005):
+        self.embedding_model = embedding_model
+        self.cache = cache
+        self.batch_size = batch_size
+        self.max_batch_texts = max_batch_texts
+        self.max_wait = max_wait
+        self._queue = queue.Queue()
+        self._shutdown = False
+        self._thread = threading.Thread(target=self._loop, name="embedding-batcher", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._shutdown = True
+        self._thread.join()
+
+    async def encode(self, texts: List[str], model: str) -> List[np.ndarray]:
+        task = _EmbeddingTask(texts, model, asyncio.get_running_loop())
+        self._queue.put(task)
+        return await task.future
+
+    def _loop(self):
+        while not self._shutdown:
+            try:
+                task = self._queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+
+            tasks, num_texts = [task], len(task.texts)
+            deadline = time.monotonic() + self.max_wait
+            while num_texts < self.max_batch_texts:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    task = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                tasks.append(task)
+                num_texts += len(task.texts)
+
+            self._run(tasks)
+
+    def _run(self, tasks: List[_EmbeddingTask]):
+        by_model = OrderedDict()
+        for task in tasks:
+            by_model.setdefault(task.model, []).append(task)
+
+        for model, model_tasks in by_model.items():
+            texts = [text for task in model_tasks for text in task.texts]
+            EMBEDDING_BATCH_TEXTS.observe(len(texts))
+            try:
+                embeddings = encode_texts(self.embedding_model, texts, model, self.cache, self.batch_size)
+            except Exception as e:
+                logger.exception("Embedding batch failed")
+                for task in model_tasks:
+                    task.set_result(e)
+                continue
+
+            offset = 0
+            for task in model_tasks:
+                task.set_result(embeddings[offset:offset + len(task.texts)])
+                offset += len(task.texts)
@@ -0,0 +1,605 @@
+"""
+A continuous batching engine for the ChatGLM3-6B OpenAI-style API.
+
+Instead of running `generate_stream_chatglm3` once per request, the engine keeps every active
+request in one running batch and advances all of them together, one decode step per iteration
+(iteration-level scheduling). New requests are prefilled and join the batch between two decode
+steps, finished requests leave it right away, so aggregate tokens/sec grows with concurrency.
+
+Key Components:
+- Sequence: the state of a single request (prompt ids, sampled ids, sampling parameters, output queue).
+  A request asking for `n` (or `best_of`) choices becomes a group of sequences: the prompt is prefilled
+  once, its KV cache is copied to every sequence of the group and they are decoded as separate batch rows.
+- GenerationEngine: owns the model loop in a background thread and exposes `generate_stream` / `generate`,
+  which produce the same dicts as `generate_stream_chatglm3` in `utils.py`.
+- AsyncStream: bridges items produced on a worker thread to a coroutine through an `asyncio.Queue`,
+  so FastAPI handlers never block the event loop while waiting for tokens.
+- Sessions: a request with a session id starts from the KV its session kept after the previous turn
+  (`SessionCache`), a finished turn stores its KV for the next one.
+- Adapters: every sequence may use its own P-tuning prefix or LoRA adapter (`adapters.py`). A P-tuning
+  sequence starts from the adapter's prefix KV, LoRA updates are applied per batch row before each forward.
+- process_batch_logits: the repetition penalty, temperature and top-p of every running sequence applied to
+  the whole batch at once, so one decode step samples all rows with a few tensor ops and a single sync.
+- GenerationWorker: a dedicated thread for blocking generators, used when continuous batching is disabled.
+
+Note:
+    ChatGLM3 keeps its KV cache as a tuple of `(key, value)` pairs per layer, each shaped
+    `[seq_len, batch, num_kv_heads, head_dim]`. Sequences of different lengths share the batch by
+    left-padding the cache, and the attention mask marks the padded positions.
+"""
+
+import asyncio
+import queue
+import threading
+import time
+import uuid
+
+import torch
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, List, Optional
+from loguru import logger
+from transformers import PreTrainedModel, PreTrainedTokenizer
+from adapters import Adapter, activate_adapters
+from metrics import RequestMetrics
+from kv_cache import (
+    KV_SEQ_DIM,
+    PastKeyValues,
+    PrefixCache,
+    SessionCache,
+    concat_past_key_values,
+    pad_past_key_values,
+    select_past_key_values,
+)
+from utils import (
+    IncrementalDetokenizer,
+    StopStringMatcher,
+    ToolCallDetector,
+    build_chat_inputs,
+)
+
+# Sentinel placed on a request queue once the request has finished.
+_FINISHED = object()
+
+
+def process_batch_logits(logits: torch.Tensor, seen: torch.Tensor, repetition_penalty: Optional[torch.Tensor],
+                         temperature: Optional[torch.Tensor], top_p: Optional[torch.Tensor]) -> torch.Tensor:
+    """
+    What `RepetitionPenaltyLogitsProcessor`, `InvalidScoreLogitsProcessor`, `TemperatureLogitsWarper` and
+    `TopPLogitsWarper` do to the logits of a single request, for a batch whose rows have their own parameters,
+    each a `[batch]` tensor or None when no row uses it. `seen` (`[batch, vocab]`, bool) marks the tokens
+    the repetition penalty applies to: the prompt and output tokens of each row.
+    """
+    scores = logits.float()
+    if repetition_penalty is not None:
+        penalty = repetition_penalty[:, None]
+        scores = torch.where(seen, torch.where(scores < 0, scores * penalty, scores / penalty), scores)
+    # A row with NaN or inf scores falls back to token 5.
+    invalid = ~torch.isfinite(scores).all(dim=-1, keepdim=True)
+    fallback = torch.zeros_like(scores[0])
+    fallback[5] = 5e4
+    scores = torch.where(invalid, fallback, scores)
+    if temperature is not None:
+        scores = scores / temperature[:, None]
+    if top_p is not None:
+        sorted_scores, sorted_indices = torch.sort(scores, descending=False)
+        cumulative_probs = sorted_scores.softmax(dim=-1).cumsum(dim=-1)
+        sorted_to_remove = cumulative_probs <= (1 - top_p[:, None])
+        sorted_to_remove[:, -1] = False
+        scores = scores.masked_fill(sorted_to_remove.scatter(1, sorted_indices, sorted_to_remove), -float("inf"))
+    return scores
+
+
+class AsyncStream:
+    """
+    An async iterator fed from another thread.
+
+    `put` may be called from any thread, items are handed to the event loop with
+    `call_soon_threadsafe`. Exceptions put on the stream are raised in the consumer.
+    The consumer calls `cancel` when it stops listening, producers check `cancelled`
+    and stop generating.
+    """
+
+    def __init__(self, loop: Optional[asyncio.AbstractEventLoop] = None):
+        self._loop = loop or asyncio.get_running_loop()
+        self._queue = asyncio.Queue()
+        self.cancelled = threading.Event()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def put(self, item):
+        try:
+            self._loop.call_soon_threadsafe(self._queue.put_nowait, item)
+        except RuntimeError:
+            # The event loop is closed, nobody is listening any more.
+            pass
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        item = await self._queue.get()
+        if item is _FINISHED:
+            raise StopAsyncIteration
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+
+class GenerationWorker:
+    """
+    Runs blocking generation on one dedicated thread and streams its outputs back to the event loop.
+    """
+
+    def __init__(self, name: str = "chatglm3-worker"):
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=name)
+
+    def stream(self, fn: Callable[..., Iterable], *args, stream: Optional[AsyncStream] = None) -> AsyncStream:
+        """
+        Run `fn(*args)` on the worker thread and forward what it yields to `stream`.
+        The generator is closed as soon as the stream is cancelled.
+        """
+        stream = stream if stream is not None else AsyncStream()
+
+        def run():
+            try:
+                if stream.cancelled.is_set():
+                    return
+                for item in fn(*args):
+                    if stream.cancelled.is_set():
+                        break
+                    stream.put(item)
+            except Exception as e:
+                logger.exception("Generation failed")
+                stream.put(e)
+            finally:
+                stream.put(_FINISHED)
+
+        self._executor.submit(run)
+        return stream
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+class Sequence:
+    """
+    State of one request inside the engine.
+    """
+
+    def __init__(self, prompt_ids: List[int], params: dict, tokenizer: PreTrainedTokenizer, outputs=None,
+                 metrics: Optional[RequestMetrics] = None, index: int = 0, adapter: Optional[Adapter] = None):
+        self.request_id = uuid.uuid4().hex
+        self.index = index
+        self.adapter = adapter
+        # Only the first choice continues the session, sessions keep base model KV.
+        self.session_id = params.get("session_id") if index == 0 and adapter is None else None
+        # All sequences of one request, they share `outputs` and `cancelled`.
+        self.group: List[Sequence] = [self]
+        # Only the candidates of a `best_of` request larger than `n` are ranked, by their log probability.
+        self.ranked = int(params.get("best_of") or 1) > int(params.get("n") or 1)
+        self.cumulative_logprob = 0.0
+        self.prompt_ids = prompt_ids
+        self.output_ids: List[int] = []
+        self.max_new_tokens = int(params.get("max_tokens", 256))
+        self.echo = params.get("echo", True)
+        self.finish_reason: Optional[str] = None
+        self.detokenizer = IncrementalDetokenizer(tokenizer, prompt_ids if self.echo else None)
+        self.tool_call_detector = ToolCallDetector(tokenizer)
+        self.stop_matcher = StopStringMatcher(list(params.get("stop") or []))
+        # What the client has been sent: the detokenized text up to any stop string.
+        self.text = self.detokenizer.text
+        # Either a `queue.Queue` for blocking callers or an `AsyncStream` for coroutines.
+        self.outputs = outputs if outputs is not None else queue.Queue()
+        self.cancelled = outputs.cancelled if isinstance(outputs, AsyncStream) else threading.Event()
+        self.metrics = metrics
+
+        # Same sampling `model.stream_generate` does for a single request, see `process_batch_logits`.
+        # Greedy decoding leaves temperature and top-p out.
+        temperature = float(params.get("temperature", 1.0))
+        self.do_sample = temperature > 1e-5
+        self.repetition_penalty = float(params.get("repetition_penalty", 1.0))
+        self.temperature = temperature if self.do_sample else 1.0
+        self.top_p = float(params.get("top_p", 1.0)) if self.do_sample else 1.0
+
+    @property
+    def num_tokens(self) -> int:
+        return len(self.prompt_ids) + len(self.output_ids)
+
+    def usage(self) -> dict:
+        return {
+            "prompt_tokens": len(self.prompt_ids),
+            "completion_tokens": len(self.output_ids),
+            "total_tokens": self.num_tokens,
+        }
+
+
+class GenerationEngine:
+    """
+    Iteration-level scheduler running ChatGLM3 over a dynamic batch of requests.
+
+    All model calls happen on the engine thread. Coroutines submit work with `generate_stream_async`,
+    plain threads can use the blocking `generate_stream`.
+    """
+
+    def __init__(self, model: PreTrainedModel, tokenizer: PreTrainedTokenizer, max_batch_size: int = 8,
+                 prefix_cache: Optional[PrefixCache] = None, session_cache: Optional[SessionCache] = None):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_batch_size = max_batch_size
+        self.prefix_cache = prefix_cache
+        self.session_cache = session_cache
+        self.device = model.device
+        self.seq_length = model.config.seq_length
+
+        self.eos_token_id = [
+            tokenizer.eos_token_id,
+            tokenizer.get_command("<|user|>"),
+        ]
+        self.observation_token_id = tokenizer.get_command("<|observation|>")
+
+        self._waiting = queue.Queue()
+        # A group that did not fit into the batch yet.
+        self._deferred: Optional[List[Sequence]] = None
+        self._running: List[Sequence] = []
+        self._past_key_values: Optional[PastKeyValues] = None
+        self._attention_mask: Optional[torch.Tensor] = None
+        self._next_tokens: Optional[torch.Tensor] = None
+        # Per batch row, the tokens of the sequence so far, as a `[batch, vocab]` mask for the repetition penalty.
+        self._seen: Optional[torch.Tensor] = None
+
+        self._shutdown = False
+        self._thread = threading.Thread(target=self._loop, name="chatglm3-engine", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._shutdown = True
+        self._thread.join()
+
+    def submit(self, params: dict, outputs=None, metrics: Optional[RequestMetrics] = None, inputs=None,
+               adapter: Optional[Adapter] = None) -> Sequence:
+        """
+        Queue a request and return its first sequence. With `n` or `best_of` in `params`, that many sequences
+        are generated from one prefill, their outputs carry an `index` and share the first sequence's queue.
+        `adapter` selects a P-tuning or LoRA fine-tune, requests with different adapters share the batch.
+        """
+        if inputs is None:
+            start_time = time.perf_counter()
+            inputs = build_chat_inputs(self.tokenizer, params["messages"], params.get("tools"))
+            if metrics is not None:
+                metrics.observe_tokenization(time.perf_counter() - start_time)
+        prompt_ids = inputs["input_ids"][0].tolist()
+        seq = Sequence(prompt_ids, params, self.tokenizer, outputs=outputs, metrics=metrics, adapter=adapter)
+        num_sequences = max(int(params.get("n") or 1), int(params.get("best_of") or 1))
+        for index in range(1, num_sequences):
+            # Token timings are only followed on the first sequence.
+            sibling = Sequence(prompt_ids, params, self.tokenizer, outputs=seq.outputs, index=index, adapter=adapter)
+            sibling.cancelled = seq.cancelled
+            seq.group.append(sibling)
+        for sibling in seq.group:
+            sibling.group = seq.group
+        self._waiting.put(seq.group)
+        return seq
+
+    def generate_stream_async(self, params: dict, metrics: Optional[RequestMetrics] = None,
+                              inputs=None, adapter: Optional[Adapter] = None) -> AsyncStream:
+        """
+        Submit a request from a coroutine, its outputs arrive on the returned `AsyncStream`.
+        `inputs` may carry the already built chat inputs of the request.
+        """
+        return self.submit(params, outputs=AsyncStream(), metrics=metrics, inputs=inputs, adapter=adapter).outputs
+
+    def generate_stream(self, params: dict):
+        """
+        Submit a request and yield its outputs as they are produced.
+
+        Yields the same dicts as `generate_stream_chatglm3`: `text`, `usage` and `finish_reason`.
+        """
+        seq = self.submit(params)
+        try:
+            while True:
+                output = seq.outputs.get()
+                if output is _FINISHED:
+                    break
+                if isinstance(output, Exception):
+                    raise output
+                yield output
+        finally:
+            # Stop decoding when the caller stops reading early.
+            seq.cancelled.set()
+
+    def generate(self, params: dict):
+        response = None
+        for response in self.generate_stream(params):
+            pass
+        return response
+
+    def _loop(self):
+        while not self._shutdown:
+            try:
+                self._admit()
+                self._drop_cancelled()
+                if self._running:
+                    self._decode_step()
+            except Exception as e:
+                logger.exception("Engine step failed, aborting running requests")
+                for seq in self._running:
+                    seq.outputs.put(e)
+                    seq.outputs.put(_FINISHED)
+                self._reset_batch()
+
+    def _reset_batch(self):
+        self._running = []
+        self._past_key_values = None
+        self._attention_mask = None
+        self._next_tokens = None
+        self._seen = None
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def _admit(self):
+        """
+        Move waiting requests into the running batch, blocking only when there is nothing to decode.
+        """
+        while len(self._running) < self.max_batch_size:
+            if self._deferred is not None:
+                group, self._deferred = self._deferred, None
+            else:
+                try:
+                    if self._running:
+                        group = self._waiting.get_nowait()
+                    else:
+                        group = self._waiting.get(timeout=0.1)
+                except queue.Empty:
+                    return
+            seq = group[0]
+            if seq.cancelled.is_set():
+                seq.outputs.put(_FINISHED)
+                continue
+            if self._running and len(self._running) + len(group) > self.max_batch_size:
+                # Wait until the whole group fits, a group larger than the batch runs on its own.
+                self._deferred = group
+                return
+            try:
+                self._prefill(group)
+            except Exception as e:
+                logger.exception("Prefill failed")
+                seq.outputs.put(e)
+                seq.outputs.put(_FINISHED)
+
+    @torch.inference_mode()
+    def _prefill(self, group: List[Sequence]):
+        seq = group[0]
+        if len(seq.prompt_ids) >= self.seq_length:
+            logger.warning(f"Input length larger than {self.seq_length}")
+        if seq.metrics is not None:
+            seq.metrics.start()
+        start_time = time.perf_counter()
+
+        # Reuse the longest cached prefix and only prefill the rest of the prompt.
+        # The cache holds base model KV, a P-tuning request starts from its adapter's prefix KV instead.
+        cached_length, past_key_values = 0, None
+        if seq.adapter is not None:
+            past_key_values = seq.adapter.past_key_values
+        else:
+            if self.session_cache is not None and seq.session_id is not None:
+                cached_length, past_key_values = self.session_cache.match(seq.session_id, seq.prompt_ids)
+            if past_key_values is None and self.prefix_cache is not None:
+                cached_length, past_key_values = self.prefix_cache.match(seq.prompt_ids)
+
+        input_ids = torch.tensor([seq.prompt_ids[cached_length:]], dtype=torch.long, device=self.device)
+        position_ids = torch.arange(cached_length, len(seq.prompt_ids), dtype=torch.long,
+                                    device=self.device).unsqueeze(0)
+        activate_adapters(self.model, [seq.adapter])
+        outputs = self.model(
+            input_ids=input_ids,
+            position_ids=position_ids,
+            past_key_values=past_key_values,
+            use_cache=True,
+            return_dict=True,
+            return_last_logit=True,
+        )
+        if self.prefix_cache is not None and seq.adapter is None:
+            self.prefix_cache.insert(seq.prompt_ids, outputs.past_key_values)
+        if seq.metrics is not None:
+            seq.metrics.observe_prefill(time.perf_counter() - start_time)
+
+        # Every sequence of the group samples its first token from the same prompt logits.
+        logits = outputs.logits[:, -1, :].expand(len(group), -1)
+        seen = torch.zeros(logits.shape, dtype=torch.bool, device=self.device)
+        seen[:, torch.tensor(seq.prompt_ids, dtype=torch.long, device=self.device)] = True
+        next_tokens = self._sample(group, logits, seen)
+        joining = [row for row, (seq, token) in enumerate(zip(group, next_tokens.tolist()))
+                   if not self._append_token(seq, token)]
+        if group[0].finish_reason is not None:
+            self._save_session(group[0], outputs.past_key_values)
+        if joining:
+            if len(joining) < len(group):
+                index = torch.tensor(joining, dtype=torch.long, device=self.device)
+                next_tokens, seen = next_tokens[index], seen[index]
+            self._join_batch([group[row] for row in joining], outputs.past_key_values, next_tokens, seen)
+
+    def _join_batch(self, seqs: List[Sequence], past_key_values: PastKeyValues, next_tokens: torch.Tensor,
+                    seen: torch.Tensor):
+        if len(seqs) > 1:
+            # Copy the prompt KV cache to one batch row per sequence.
+            index = torch.zeros(len(seqs), dtype=torch.long, device=self.device)
+            past_key_values = select_past_key_values(past_key_values, index)
+        past_length = past_key_values[0][0].shape[KV_SEQ_DIM]
+        attention_mask = torch.ones((len(seqs), past_length), dtype=torch.long, device=self.device)
+
+        if self._past_key_values is None:
+            self._past_key_values = past_key_values
+            self._attention_mask = attention_mask
+            self._next_tokens = next_tokens
+            self._seen = seen
+        else:
+            batch_length = self._attention_mask.shape[1]
+            length = max(batch_length, past_length)
+            self._past_key_values = concat_past_key_values([
+                pad_past_key_values(self._past_key_values, length),
+                pad_past_key_values(past_key_values, length),
+            ])
+            self._attention_mask = torch.cat((
+                torch.nn.functional.pad(self._attention_mask, (length - batch_length, 0)),
+                torch.nn.functional.pad(attention_mask, (length - past_length, 0)),
+            ), dim=0)
+            self._next_tokens = torch.cat((self._next_tokens, next_tokens))
+            self._seen = torch.cat((self._seen, seen))
+        self._running.extend(seqs)
+
+    @torch.inference_mode()
+    def _decode_step(self):
+        attention_mask = torch.cat((self._attention_mask, self._attention_mask.new_ones((len(self._running), 1))), dim=1)
+        position_ids = torch.tensor([[seq.num_tokens - 1] for seq in self._running], dtype=torch.long,
+                                    device=self.device)
+        activate_adapters(self.model, [seq.adapter for seq in self._running])
+        outputs = self.model(
+            input_ids=self._next_tokens.unsqueeze(1),
+            position_ids=position_ids,
+            attention_mask=attention_mask,
+            past_key_values=self._past_key_values,
+            use_cache=True,
+            return_dict=True,
+        )
+        self._past_key_values = outputs.past_key_values
+        self._attention_mask = attention_mask
+
+        next_tokens = self._sample(self._running, outputs.logits[:, -1, :], self._seen)
+        keep = []
+        for row, (seq, token) in enumerate(zip(self._running, next_tokens.tolist())):
+            if not self._append_token(seq, token):
+                keep.append(row)
+            elif seq.session_id is not None:
+                index = torch.tensor([row], dtype=torch.long, device=self.device)
+                start = int(self._attention_mask[row].nonzero()[0])
+                self._save_session(seq, select_past_key_values(self._past_key_values, index, start))
+
+        if len(keep) < len(self._running):
+            next_tokens = next_tokens[keep]
+            self._evict(keep)
+        if self._running:
+            self._next_tokens = next_tokens
+
+    def _save_session(self, seq: Sequence, past_key_values: PastKeyValues):
+        """
+        Keep the KV of a finished turn for the next request of its session. The last sampled token
+        was never fed to the model, so the cache covers everything before it.
+        """
+        if self.session_cache is not None and seq.session_id is not None:
+            self.session_cache.update(seq.session_id, seq.prompt_ids + seq.output_ids[:-1], past_key_values)
+
+    def _drop_cancelled(self):
+        """
+        Free the batch rows of requests whose client went away.
+        """
+        keep = [row for row, seq in enumerate(self._running) if not seq.cancelled.is_set()]
+        if len(keep) == len(self._running):
+            return
+        for seq in self._running:
+            if seq.cancelled.is_set():
+                logger.debug(f"Request {seq.request_id} cancelled after {len(seq.output_ids)} tokens")
+                seq.outputs.put(_FINISHED)
+        next_tokens = self._next_tokens[keep]
+        self._evict(keep)
+        if self._running:
+            self._next_tokens = next_tokens
+
+    def _evict(self, keep: List[int]):
+        """
+        Drop finished rows from the batch and trim the left padding no remaining row needs.
+        """
+        if not keep:
+            self._reset_batch()
+            return
+        index = torch.tensor(keep, dtype=torch.long, device=self.device)
+        attention_mask = self._attention_mask.index_select(0, index)
+        start = int(attention_mask.any(dim=0).nonzero()[0])
+        self._past_key_values = select_past_key_values(self._past_key_values, index, start)
+        self._attention_mask = attention_mask[:, start:]
+        self._seen = self._seen.index_select(0, index)
+        self._running = [self._running[row] for row in keep]
+
+    def _sample(self, seqs: List[Sequence], logits: torch.Tensor, seen: torch.Tensor) -> torch.Tensor:
+        """
+        Sample the next token of every row of `logits`, row `i` belonging to `seqs[i]`, and mark the sampled
+        tokens in `seen`. The tokens stay on the device, the caller reads them back with one `tolist`.
+        """
+
+        def row_parameter(name: str, neutral: float) -> Optional[torch.Tensor]:
+            values = [getattr(seq, name) for seq in seqs]
+            if all(value == neutral for value in values):
+                return None
+            return torch.tensor(values, dtype=torch.float, device=logits.device)
+
+        scores = process_batch_logits(logits, seen, row_parameter("repetition_penalty", 1.0),
+                                      row_parameter("temperature", 1.0), row_parameter("top_p", 1.0))
+        next_tokens = torch.argmax(scores, dim=-1)
+        do_sample = [seq.do_sample for seq in seqs]
+        if any(do_sample):
+            sampled = torch.multinomial(torch.softmax(scores, dim=-1), num_samples=1).squeeze(1)
+            if not all(do_sample):
+                sampled = torch.where(torch.tensor(do_sample, device=logits.device), sampled, next_tokens)
+            next_tokens = sampled
+        seen[torch.arange(len(seqs), device=logits.device), next_tokens] = True
+
+        ranked = [row for row, seq in enumerate(seqs) if seq.ranked]
+        if ranked:
+            index = torch.tensor(ranked, dtype=torch.long, device=logits.device)
+            logprobs = torch.log_softmax(scores[index], dim=-1).gather(1, next_tokens[index, None]).squeeze(1)
+            for row, logprob in zip(ranked, logprobs.tolist()):
+                seqs[row].cumulative_logprob += logprob
+        return next_tokens
+
+    def _append_token(self, seq: Sequence, token: int) -> bool:
+        """
+        Record a sampled token, publish the new output and return whether the request has finished.
+        """
+        seq.output_ids.append(token)
+        if seq.metrics is not None:
+            seq.metrics.token()
+        delta = ""
+        if token == self.observation_token_id:
+            seq.finish_reason = "function_call"
+        elif token in self.eos_token_id:
+            seq.finish_reason = "stop"
+        else:
+            seq.tool_call_detector.step(token)
+            delta, stop = seq.stop_matcher.feed(seq.detokenizer.step(token))
+            if stop is not None or len(seq.output_ids) >= seq.max_new_tokens or seq.num_tokens >= self.seq_length:
+                seq.finish_reason = "stop"
+        if seq.finish_reason is not None:
+            # Text held back as the possible start of a stop string that never completed.
+            delta += seq.stop_matcher.flush()
+        seq.text += delta
+
+        if delta or seq.finish_reason == "function_call":
+            seq.outputs.put({
+                "text": seq.text,
+                "delta": delta,
+                "usage": seq.usage(),
+                "finish_reason": seq.finish_reason if seq.finish_reason == "function_call" else None,
+                "is_tool_call": seq.tool_call_detector.is_tool_call,
+                "index": seq.index,
+            })
+
+        if seq.finish_reason is None:
+            return False
+
+        # Only last stream result contains finish_reason, we set finish_reason as stop
+        seq.outputs.put({
+            "text": seq.text,
+            "delta": "",
+            "usage": seq.usage(),
+            "finish_reason": "stop",
+            "is_tool_call": seq.tool_call_detector.is_tool_call,
+            "index": seq.index,
+            "cumulative_logprob": seq.cumulative_logprob,
+        })
+        if all(sibling.finish_reason is not None for sibling in seq.group):
+            seq.outputs.put(_FINISHED)
+        return True
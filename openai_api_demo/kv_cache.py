@@ -0,0 +1,534 @@
+"""
+KV cache utilities for the ChatGLM3-6B OpenAI-style API.
+
+ChatGLM3 keeps its KV cache (`past_key_values`) as a tuple of `(key, value)` pairs per layer,
+each tensor shaped `[seq_len, batch, num_kv_heads, head_dim]`. The helpers below pad, stack,
+slice and measure caches in that layout.
+
+Key Components:
+- PrefixCache: a radix tree keyed on token id prefixes. Almost every request repeats the same system
+  prompt, or the same long tool schema produced by `process_chatglm_messages`; the cache keeps their
+  KV so that a new request only has to prefill the part of its prompt that was never seen before.
+- SessionCache: the KV of the last turn (prompt and reply) of each conversation session, the API
+  counterpart of `return_past_key_values=True` in the CLI demos. The next turn of the session only
+  prefills the messages that were added since. Idle sessions are offloaded from the device to host
+  memory and then to disk, so many more conversations can be resumed with a copy instead of a prefill.
+  Those moves run on a background thread, off the engine thread.
+"""
+
+import os
+import queue
+import tempfile
+import threading
+import time
+import uuid
+
+import torch
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Tuple
+from loguru import logger
+from metrics import SESSION_KV_TRANSFER, SESSION_TIER_LOOKUPS
+
+# ChatGLM3 cache layout: [seq_len, batch, num_kv_heads, head_dim]
+KV_SEQ_DIM = 0
+KV_BATCH_DIM = 1
+
+PastKeyValues = Tuple[Tuple[torch.Tensor, torch.Tensor], ...]
+
+
+def pad_past_key_values(past_key_values: PastKeyValues, length: int) -> PastKeyValues:
+    """
+    Left-pad every cache tensor with zeros along the sequence dimension up to `length`.
+    """
+    pad = length - past_key_values[0][0].shape[KV_SEQ_DIM]
+    if pad <= 0:
+        return past_key_values
+
+    def _pad(tensor):
+        shape = list(tensor.shape)
+        shape[KV_SEQ_DIM] = pad
+        return torch.cat((tensor.new_zeros(shape), tensor), dim=KV_SEQ_DIM)
+
+    return tuple(tuple(_pad(tensor) for tensor in layer) for layer in past_key_values)
+
+
+def concat_past_key_values(past_key_values: List[PastKeyValues]) -> PastKeyValues:
+    """
+    Stack several caches along the batch dimension. All caches must already have the same length.
+    """
+    return tuple(
+        tuple(torch.cat(tensors, dim=KV_BATCH_DIM) for tensors in zip(*layers))
+        for layers in zip(*past_key_values)
+    )
+
+
+def select_past_key_values(past_key_values: PastKeyValues, index: torch.Tensor, start: int = 0) -> PastKeyValues:
+    """
+    Keep the batch rows in `index` and drop the first `start` positions of every cache tensor.
+    """
+    return tuple(
+        tuple(tensor.index_select(KV_BATCH_DIM, index).narrow(KV_SEQ_DIM, start, tensor.shape[KV_SEQ_DIM] - start)
+              for tensor in layer)
+        for layer in past_key_values
+    )
+
+
+def truncate_past_key_values(past_key_values: PastKeyValues, length: int) -> PastKeyValues:
+    """
+    Keep the first `length` positions of every cache tensor, without copying.
+    """
+    return tuple(tuple(tensor.narrow(KV_SEQ_DIM, 0, length) for tensor in layer) for layer in past_key_values)
+
+
+def slice_past_key_values(past_key_values: PastKeyValues, start: int, end: int) -> PastKeyValues:
+    """
+    Copy the positions `[start, end)` of every cache tensor, so the result does not keep the source alive.
+    """
+    return tuple(
+        tuple(tensor.narrow(KV_SEQ_DIM, start, end - start).clone() for tensor in layer)
+        for layer in past_key_values
+    )
+
+
+def past_key_values_nbytes(past_key_values: PastKeyValues) -> int:
+    return sum(tensor.numel() * tensor.element_size() for layer in past_key_values for tensor in layer)
+
+
+class _RadixNode:
+    """
+    One edge of the radix tree: `key` holds the token ids of the edge, `past_key_values` their KV.
+    """
+
+    def __init__(self, key: Tuple[int, ...] = (), past_key_values: Optional[PastKeyValues] = None,
+                 parent: Optional["_RadixNode"] = None):
+        self.key = key
+        self.past_key_values = past_key_values
+        self.parent = parent
+        self.children: Dict[int, "_RadixNode"] = {}
+        self.last_access = time.monotonic()
+        self.nbytes = past_key_values_nbytes(past_key_values) if past_key_values is not None else 0
+
+    def split(self, length: int) -> "_RadixNode":
+        """
+        Split this edge after `length` tokens and return the new upper node.
+        """
+        head = _RadixNode(
+            self.key[:length],
+            slice_past_key_values(self.past_key_values, 0, length),
+            parent=self.parent,
+        )
+        head.last_access = self.last_access
+        self.parent.children[self.key[0]] = head
+
+        self.past_key_values = slice_past_key_values(self.past_key_values, length, len(self.key))
+        self.key = self.key[length:]
+        self.nbytes = past_key_values_nbytes(self.past_key_values)
+        self.parent = head
+        head.children[self.key[0]] = self
+        return head
+
+
+class PrefixCache:
+    """
+    Radix tree of token id prefixes with the KV cache of every cached position.
+
+    Because attention is causal, the KV of the first `k` tokens of a cached prompt only depends
+    on those `k` tokens, so a request can reuse any common prefix, even one that ends in the middle
+    of an edge. Leaves are evicted in LRU order once the stored KV exceeds `max_bytes`.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.hit_tokens = 0
+        self._root = _RadixNode()
+        self._lock = threading.Lock()
+
+    def match(self, token_ids: List[int]) -> Tuple[int, Optional[PastKeyValues]]:
+        """
+        Find the longest cached prefix of `token_ids` and return its length and KV.
+
+        At least the last token is never matched, so the caller always has something
+        left to prefill and gets the logits for the next token.
+        """
+        with self._lock:
+            max_length = len(token_ids) - 1
+            node, matched, segments = self._root, 0, []
+            now = time.monotonic()
+            while matched < max_length and token_ids[matched] in node.children:
+                child = node.children[token_ids[matched]]
+                length = _common_length(child.key, token_ids, matched, max_length)
+                child.last_access = now
+                segments.append(tuple(
+                    tuple(tensor.narrow(KV_SEQ_DIM, 0, length) for tensor in layer)
+                    for layer in child.past_key_values
+                ))
+                matched += length
+                if length < len(child.key):
+                    break
+                node = child
+
+            if not matched:
+                self.misses += 1
+                return 0, None
+
+            self.hits += 1
+            self.hit_tokens += matched
+            past_key_values = tuple(
+                tuple(torch.cat(tensors, dim=KV_SEQ_DIM) for tensors in zip(*layers))
+                for layers in zip(*segments)
+            )
+            return matched, past_key_values
+
+    def insert(self, token_ids: List[int], past_key_values: PastKeyValues):
+        """
+        Store the KV of `token_ids`, `past_key_values` must cover at least `len(token_ids)` positions
+        of a single sequence. Only the positions that are not cached yet are copied.
+        """
+        with self._lock:
+            node, matched = self._root, 0
+            now = time.monotonic()
+            while matched < len(token_ids) and token_ids[matched] in node.children:
+                child = node.children[token_ids[matched]]
+                length = _common_length(child.key, token_ids, matched, len(token_ids))
+                if length < len(child.key):
+                    child = child.split(length)
+                child.last_access = now
+                node = child
+                matched += length
+
+            if matched < len(token_ids):
+                leaf = _RadixNode(
+                    tuple(token_ids[matched:]),
+                    slice_past_key_values(past_key_values, matched, len(token_ids)),
+                    parent=node,
+                )
+                node.children[token_ids[matched]] = leaf
+                self.nbytes += leaf.nbytes
+
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._root = _RadixNode()
+            self.nbytes = 0
+
+    def _evict(self):
+        while self.nbytes > self.max_bytes:
+            leaves = self._leaves()
+            if not leaves:
+                return
+            leaf = min(leaves, key=lambda node: node.last_access)
+            del leaf.parent.children[leaf.key[0]]
+            self.nbytes -= leaf.nbytes
+
+    def _leaves(self) -> List[_RadixNode]:
+        leaves, stack = [], list(self._root.children.values())
+        while stack:
+            node = stack.pop()
+            if node.children:
+                stack.extend(node.children.values())
+            else:
+                leaves.append(node)
+        return leaves
+
+
+# Where a session's KV is kept, from the fastest to resume to the cheapest to hold
+DEVICE_TIER = "device"
+HOST_TIER = "host"
+DISK_TIER = "disk"
+
+
+class _Session:
+    def __init__(self, token_ids: Tuple[int, ...], past_key_values: PastKeyValues):
+        self.token_ids = token_ids
+        self.past_key_values: Optional[PastKeyValues] = past_key_values
+        self.device = past_key_values[0][0].device
+        self.nbytes = past_key_values_nbytes(past_key_values)
+        self.tier = DEVICE_TIER
+        self.path: Optional[str] = None
+        self.last_access = time.monotonic()
+        # The demotion queued for the offload thread, if any.
+        self.move: Optional[_Move] = None
+
+
+class _Move:
+    def __init__(self, session: _Session, tier: str):
+        self.session = session
+        self.source = session.tier
+        self.tier = tier
+        self.past_key_values = session.past_key_values
+        # The KV may still be written by kernels queued on the engine's stream.
+        self.ready = None
+        if session.device.type == "cuda":
+            self.ready = torch.cuda.Event()
+            self.ready.record(torch.cuda.current_stream(session.device))
+
+
+class SessionCache:
+    """
+    The token ids and KV of the last turn of every session, by session id.
+
+    A new turn re-sends the whole history, which starts with the cached tokens unless the client edited it or
+    the reply tokenizes differently, so the longest common prefix is reused. Sessions are dropped after `ttl`
+    seconds without a request, and least recently used first beyond `max_sessions`.
+
+    The KV is kept in tiers. Beyond `max_bytes` on the device, or after `offload_after` idle seconds, the least
+    recently used sessions are moved to (pinned) host memory; beyond `host_bytes` there, they are saved under
+    `offload_dir` and memory-mapped back. Resuming an offloaded session copies its KV back to the device.
+
+    Moving a session down a tier is left to an offload thread, which copies on its own CUDA stream and writes
+    the files, so the engine thread never waits for it. A session resumed before its move finished is simply
+    kept where it is. The offload thread also checks `ttl` and `offload_after` every `check_interval` seconds.
+    """
+
+    def __init__(self, max_sessions: int, max_bytes: int, ttl: float, host_bytes: int = 0, disk_bytes: int = 0,
+                 offload_dir: Optional[str] = None, offload_after: Optional[float] = None,
+                 check_interval: float = 1.0):
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.offload_after = offload_after
+        self.check_interval = check_interval
+        self.budgets = {DEVICE_TIER: max_bytes, HOST_TIER: host_bytes, DISK_TIER: disk_bytes}
+        self.tier_bytes = {DEVICE_TIER: 0, HOST_TIER: 0, DISK_TIER: 0}
+        # Bytes of every tier that are queued to move down.
+        self.leaving_bytes = {DEVICE_TIER: 0, HOST_TIER: 0, DISK_TIER: 0}
+        if disk_bytes > 0:
+            self.offload_dir = offload_dir or tempfile.mkdtemp(prefix="chatglm3-sessions-")
+            os.makedirs(self.offload_dir, exist_ok=True)
+        else:
+            self.offload_dir = None
+        self.hits = 0
+        self.misses = 0
+        self.hit_tokens = 0
+        self._sessions: "OrderedDict[str, _Session]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._moves: "queue.Queue[_Move]" = queue.Queue()
+        self._streams: Dict[torch.device, torch.cuda.Stream] = {}
+        threading.Thread(target=self._offload_loop, name="chatglm3-session-offload", daemon=True).start()
+
+    @property
+    def nbytes(self) -> int:
+        return self.tier_bytes[DEVICE_TIER]
+
+    def match(self, session_id: str, token_ids: List[int]) -> Tuple[int, Optional[PastKeyValues]]:
+        """
+        Return how many leading tokens of `token_ids` the session has cached, and their KV on the device.
+        Like `PrefixCache.match`, the last token is never matched.
+        """
+        with self._lock:
+            self._expire()
+            session = self._sessions.get(session_id)
+            length = 0
+            if session is not None:
+                length = _common_length(session.token_ids, token_ids, 0, len(token_ids) - 1)
+            if not length:
+                self.misses += 1
+                SESSION_TIER_LOOKUPS.labels("miss").inc()
+                return 0, None
+
+            SESSION_TIER_LOOKUPS.labels(session.tier).inc()
+            session.last_access = time.monotonic()
+            self._sessions.move_to_end(session_id)
+            self._cancel_move(session)
+            self._promote(session)
+            past_key_values = session.past_key_values
+            # The resumed session is about to be used, even if it is larger than the device budget.
+            self._enforce_budgets(keep=session)
+            self.hits += 1
+            self.hit_tokens += length
+            return length, truncate_past_key_values(past_key_values, length)
+
+    def update(self, session_id: str, token_ids: List[int], past_key_values: PastKeyValues):
+        """
+        Replace the state of the session, `past_key_values` must cover at least `len(token_ids)` positions.
+        """
+        session = _Session(tuple(token_ids), slice_past_key_values(past_key_values, 0, len(token_ids)))
+        with self._lock:
+            self._drop(session_id)
+            self._sessions[session_id] = session
+            self.tier_bytes[DEVICE_TIER] += session.nbytes
+            self._expire()
+            while len(self._sessions) > self.max_sessions:
+                self._drop(next(iter(self._sessions)))
+            self._enforce_budgets()
+
+    def clear(self):
+        with self._lock:
+            for session_id in list(self._sessions):
+                self._drop(session_id)
+
+    def flush(self):
+        """
+        Wait until the offload thread has carried out every queued move.
+        """
+        self._moves.join()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def _drop(self, session_id: str):
+        session = self._sessions.pop(session_id, None)
+        if session is not None:
+            self._cancel_move(session)
+            self.tier_bytes[session.tier] -= session.nbytes
+            if session.path is not None:
+                os.remove(session.path)
+
+    def _expire(self):
+        now = time.monotonic()
+        while self._sessions:
+            session_id, session = next(iter(self._sessions.items()))
+            if session.last_access >= now - self.ttl:
+                break
+            self._drop(session_id)
+        if self.offload_after is not None:
+            for session in list(self._sessions.values()):
+                if session.last_access >= now - self.offload_after:
+                    break
+                if session.tier == DEVICE_TIER and session.move is None:
+                    self._demote(session)
+
+    def _enforce_budgets(self, keep: Optional[_Session] = None):
+        """
+        Move the least recently used sessions of every tier over budget one tier down, or drop them from disk.
+        Sessions already on their way down no longer count against their tier.
+        """
+        for tier in (DEVICE_TIER, HOST_TIER, DISK_TIER):
+            for session_id, session in list(self._sessions.items()):
+                if self.tier_bytes[tier] - self.leaving_bytes[tier] <= self.budgets[tier]:
+                    break
+                if session.tier == tier and session.move is None and session is not keep:
+                    if tier == DISK_TIER:
+                        self._drop(session_id)
+                    else:
+                        self._demote(session)
+
+    def _demote(self, session: _Session):
+        if session.tier == DEVICE_TIER and self.budgets[HOST_TIER] > 0:
+            self._queue_move(session, HOST_TIER)
+        elif session.tier != DISK_TIER and self.offload_dir is not None:
+            self._queue_move(session, DISK_TIER)
+        else:
+            self._drop(next(key for key, value in self._sessions.items() if value is session))
+
+    def _queue_move(self, session: _Session, tier: str):
+        session.move = _Move(session, tier)
+        self.leaving_bytes[session.tier] += session.nbytes
+        self._moves.put(session.move)
+
+    def _cancel_move(self, session: _Session):
+        if session.move is not None:
+            self.leaving_bytes[session.tier] -= session.nbytes
+            session.move = None
+
+    def _promote(self, session: _Session):
+        """
+        Bring the KV of a resumed session back to the device, on the engine thread since it is needed right away.
+        The copy from pinned host memory is queued on the current stream, ahead of the prefill that reads it.
+        """
+        if session.tier == DEVICE_TIER:
+            return
+        start = time.perf_counter()
+        past_key_values = session.past_key_values
+        if session.tier == DISK_TIER:
+            past_key_values = torch.load(session.path, map_location="cpu", mmap=True)
+            os.remove(session.path)
+            session.path = None
+        session.past_key_values = _map_past_key_values(
+            past_key_values, lambda t: t.to(session.device, non_blocking=True, copy=True))
+        SESSION_KV_TRANSFER.labels(session.tier, DEVICE_TIER).observe(time.perf_counter() - start)
+        self._set_tier(session, DEVICE_TIER)
+
+    def _set_tier(self, session: _Session, tier: str):
+        self.tier_bytes[session.tier] -= session.nbytes
+        self.tier_bytes[tier] += session.nbytes
+        session.tier = tier
+
+    def _offload_loop(self):
+        next_check = time.monotonic() + self.check_interval
+        while True:
+            try:
+                move = self._moves.get(timeout=max(next_check - time.monotonic(), 0))
+            except queue.Empty:
+                move = None
+            if move is not None:
+                try:
+                    self._run_move(move)
+                except Exception:
+                    logger.exception("Moving a session KV cache failed")
+                    with self._lock:
+                        if move.session.move is move:
+                            self._cancel_move(move.session)
+                finally:
+                    self._moves.task_done()
+            if time.monotonic() >= next_check:
+                with self._lock:
+                    self._expire()
+                next_check = time.monotonic() + self.check_interval
+
+    def _run_move(self, move: _Move):
+        """
+        Copy the KV of `move` to its target tier on the offload thread, then switch the session over to it
+        unless it was resumed or dropped in the meantime.
+        """
+        start = time.perf_counter()
+        session, past_key_values, path = move.session, move.past_key_values, None
+        with self._offload_stream(move):
+            if move.tier == HOST_TIER:
+                pin = session.device.type == "cuda"
+                past_key_values = _map_past_key_values(past_key_values, lambda t: _copy_to_host(t, pin))
+            else:
+                path = os.path.join(self.offload_dir, f"{uuid.uuid4().hex}.pt")
+                torch.save(_map_past_key_values(past_key_values, lambda t: t.to("cpu")), path)
+                past_key_values = None
+        SESSION_KV_TRANSFER.labels(move.source, move.tier).observe(time.perf_counter() - start)
+
+        with self._lock:
+            if session.move is not move:
+                if path is not None:
+                    os.remove(path)
+                return
+            self._cancel_move(session)
+            session.past_key_values, session.path = past_key_values, path
+            self._set_tier(session, move.tier)
+            # The host tier may be over budget now.
+            self._enforce_budgets()
+
+    @contextmanager
+    def _offload_stream(self, move: _Move):
+        """
+        Run the copies of `move` on a CUDA stream of their own, after the KV is ready, and wait for them.
+        """
+        if move.ready is None:
+            yield
+            return
+        device = move.session.device
+        stream = self._streams.get(device)
+        if stream is None:
+            stream = self._streams[device] = torch.cuda.Stream(device)
+        stream.wait_event(move.ready)
+        with torch.cuda.stream(stream):
+            yield
+        stream.synchronize()
+
+
+def _copy_to_host(tensor: torch.Tensor, pin: bool) -> torch.Tensor:
+    host = torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=pin)
+    return host.copy_(tensor, non_blocking=pin)
+
+
+def _map_past_key_values(past_key_values: PastKeyValues, function: Callable[[torch.Tensor], torch.Tensor]):
+    return tuple(tuple(function(tensor) for tensor in layer) for layer in past_key_values)
+
+
+def _common_length(key: Tuple[int, ...], token_ids: List[int], start: int, end: int) -> int:
+    length = 0
+    while length < len(key) and start + length < end and key[length] == token_ids[start + length]:
+        length += 1
+    return length
@@ -0,0 +1,144 @@
+"""
+Model loading for the ChatGLM3-6B OpenAI-style API, built to keep restarts short.
+
+Key Components:
+- ModelLoader: runs the load phases (tokenizer, LLM weights, embedding model, ...) in parallel on background
+  threads while the server is already answering "/health", and records how long each phase took. The status
+  is "loading" until `run` finishes, then "ready" (or "failed").
+- LazyModel: a model that is loaded on its first use, or ahead of it on a loader thread, and then forwards
+  attribute access to the loaded model. The embedding model can wait for the first "/v1/embeddings" request.
+- load_model: loads ChatGLM3 from its safetensors shards. Transformers reads those through `safe_open`, which
+  memory-maps the shard files instead of reading them into memory first; the shards are also prefetched into
+  the page cache up front, so the disk reads overlap with building the model and loading the other phases.
+"""
+
+import asyncio
+import glob
+import os
+import threading
+import time
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Optional
+from loguru import logger
+from transformers import AutoModel
+from metrics import LOAD_PHASE_SECONDS
+
+
+def safetensors_files(path: str) -> List[str]:
+    """
+    The safetensors shards of a local model directory, or of a model already in the Hugging Face cache.
+    """
+    if not os.path.isdir(path):
+        try:
+            from huggingface_hub import snapshot_download
+            path = snapshot_download(path, allow_patterns=["*.safetensors"], local_files_only=True)
+        except Exception:
+            return []
+    return sorted(glob.glob(os.path.join(path, "*.safetensors")))
+
+
+def prefetch(files: List[str]):
+    """
+    Ask the kernel to start reading the files into the page cache, without waiting for it.
+    """
+    if not hasattr(os, "posix_fadvise"):
+        return
+    for file in files:
+        fd = os.open(file, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+
+
+def load_model(path: str, **kwargs):
+    """
+    `AutoModel.from_pretrained`, but from the memory-mapped safetensors shards whenever the model has them,
+    never from the pickled `.bin` checkpoints next to them.
+    """
+    files = safetensors_files(path)
+    if files:
+        prefetch(files)
+        kwargs.setdefault("use_safetensors", True)
+    return AutoModel.from_pretrained(path, trust_remote_code=True, **kwargs).eval()
+
+
+class LazyModel:
+    """
+    Loads the model with `load` on first use, once, and then behaves like it.
+    """
+
+    def __init__(self, load: Callable[[], Any]):
+        self._load = load
+        self._model = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    self._model = self._load()
+        return self._model
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+
+class ModelLoader:
+    """
+    Runs load phases on `max_workers` background threads and keeps their durations in `timings` (seconds).
+    """
+
+    def __init__(self, max_workers: int = 4):
+        self.status = "loading"
+        self.error: Optional[str] = None
+        self.timings: Dict[str, float] = {}
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix="model-loader")
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        yield
+        seconds = time.perf_counter() - start
+        self.timings[name] = round(seconds, 3)
+        LOAD_PHASE_SECONDS.labels(name).set(seconds)
+        logger.info(f"Loaded {name} in {seconds:.2f}s")
+
+    def timed(self, name: str, fn: Callable, *args, **kwargs) -> Callable[[], Any]:
+        """
+        `fn(*args, **kwargs)` as a callable that records its duration as the phase `name`.
+        """
+
+        def load():
+            with self.phase(name):
+                return fn(*args, **kwargs)
+
+        return load
+
+    def submit(self, name: str, fn: Callable, *args, **kwargs) -> Future:
+        """
+        Start the phase `name` on a loader thread.
+        """
+        return self.run_in_background(self.timed(name, fn, *args, **kwargs))
+
+    def run_in_background(self, fn: Callable[[], Any]) -> Future:
+        return self._executor.submit(fn)
+
+    async def run(self, load: Callable[[], None]):
+        """
+        Run `load`, which submits the phases and waits for them, off the event loop and set the status.
+        """
+        start = time.perf_counter()
+        try:
+            await asyncio.to_thread(load)
+        except Exception as e:
+            logger.exception("Loading the models failed")
+            self.error = str(e)
+            self.status = "failed"
+            return
+        self.timings["total"] = round(time.perf_counter() - start, 3)
+        LOAD_PHASE_SECONDS.labels("total").set(self.timings["total"])
+        logger.info(f"Models ready after {self.timings['total']:.2f}s")
+        self.status = "ready"
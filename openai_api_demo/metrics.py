@@ -0,0 +1,130 @@
+"""
+Prometheus metrics for the ChatGLM3-6B OpenAI-style API, exported on "/metrics".
+
+Key Components:
+- Histograms for every phase of a chat request: queue wait, tokenization, prefill, time to first token,
+  inter-token latency, total latency, and prompt/completion token counts.
+- Counters and a histogram of the draft tokens proposed and accepted by prompt lookup speculation.
+- Gauges for in-flight requests, the admission queue and the hit rate of the prefix and embedding caches.
+- Lookups per tier (device, host, disk) of the session KV cache and the time spent moving KV between tiers.
+- The duration of every model load phase at startup (`loader.py`).
+- RequestMetrics: follows one chat generation through those phases. It is created when the request
+  arrives and handed to the generation code (`generate_stream_chatglm3` or the batching engine).
+"""
+
+import time
+
+from typing import Optional
+from prometheus_client import Counter, Gauge, Histogram
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+TOKEN_LATENCY_BUCKETS = (0.005, 0.01, 0.02, 0.03, 0.05, 0.075, 0.1, 0.15, 0.25, 0.5, 1)
+TOKEN_COUNT_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192)
+
+QUEUE_WAIT = Histogram(
+    "chatglm3_queue_wait_seconds", "Time a chat request waits before its generation starts",
+    buckets=LATENCY_BUCKETS)
+TOKENIZATION = Histogram(
+    "chatglm3_tokenization_seconds", "Time spent building the chat input ids",
+    buckets=LATENCY_BUCKETS)
+PREFILL = Histogram(
+    "chatglm3_prefill_seconds", "Time spent on the prompt forward pass",
+    buckets=LATENCY_BUCKETS)
+TIME_TO_FIRST_TOKEN = Histogram(
+    "chatglm3_time_to_first_token_seconds", "Time from request arrival to the first generated token",
+    buckets=LATENCY_BUCKETS)
+INTER_TOKEN_LATENCY = Histogram(
+    "chatglm3_inter_token_latency_seconds", "Time between two generated tokens of one request",
+    buckets=TOKEN_LATENCY_BUCKETS)
+REQUEST_LATENCY = Histogram(
+    "chatglm3_request_latency_seconds", "Total time from request arrival to the last output",
+    ["endpoint"], buckets=LATENCY_BUCKETS)
+PROMPT_TOKENS = Histogram(
+    "chatglm3_prompt_tokens", "Prompt tokens per request",
+    ["endpoint"], buckets=TOKEN_COUNT_BUCKETS)
+COMPLETION_TOKENS = Histogram(
+    "chatglm3_completion_tokens", "Completion tokens per request",
+    ["endpoint"], buckets=TOKEN_COUNT_BUCKETS)
+EMBEDDING_BATCH_TEXTS = Histogram(
+    "chatglm3_embedding_batch_texts", "Texts encoded in one merged embedding forward pass",
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512))
+SPECULATIVE_ACCEPTANCE_RATE = Histogram(
+    "chatglm3_speculative_acceptance_rate", "Fraction of prompt lookup draft tokens accepted per request",
+    buckets=(0.05, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1))
+SPECULATIVE_DRAFT_TOKENS = Counter(
+    "chatglm3_speculative_draft_tokens", "Draft tokens proposed by prompt lookup speculation")
+SPECULATIVE_ACCEPTED_TOKENS = Counter(
+    "chatglm3_speculative_accepted_tokens", "Draft tokens accepted by prompt lookup speculation")
+SESSION_TIER_LOOKUPS = Counter(
+    "chatglm3_session_tier_lookups", "Session KV lookups by the tier the session was found in, or miss",
+    ["tier"])
+SESSION_KV_TRANSFER = Histogram(
+    "chatglm3_session_kv_transfer_seconds", "Time spent moving a session KV cache between tiers",
+    ["source", "target"], buckets=LATENCY_BUCKETS)
+
+IN_FLIGHT = Gauge("chatglm3_in_flight_requests", "Requests currently being processed", ["endpoint"])
+ADMISSION_QUEUE = Gauge("chatglm3_admission_queue_length", "Chat requests waiting for a generation slot")
+REJECTED_REQUESTS = Counter("chatglm3_rejected_requests", "Chat requests rejected by admission control", ["reason"])
+LOAD_PHASE_SECONDS = Gauge("chatglm3_load_phase_seconds", "Time spent in each model load phase at startup", ["phase"])
+CACHE_HIT_RATE = Gauge("chatglm3_cache_hit_rate", "Fraction of cache lookups that were hits", ["cache"])
+
+
+def register_cache(name: str, cache):
+    """
+    Export the hit rate of a cache with `hits` and `misses` counters.
+    """
+
+    def hit_rate():
+        lookups = cache.hits + cache.misses
+        return cache.hits / lookups if lookups else 0.0
+
+    CACHE_HIT_RATE.labels(name).set_function(hit_rate)
+
+
+class RequestMetrics:
+    """
+    Phase timings of one chat generation.
+    """
+
+    def __init__(self, endpoint: str = "chat"):
+        self.endpoint = endpoint
+        self.arrival_time = time.perf_counter()
+        self.last_token_time: Optional[float] = None
+        self._finished = False
+        IN_FLIGHT.labels(endpoint).inc()
+
+    def start(self):
+        """
+        Generation of this request starts, everything before was queueing.
+        """
+        QUEUE_WAIT.observe(time.perf_counter() - self.arrival_time)
+
+    def observe_tokenization(self, seconds: float):
+        TOKENIZATION.observe(seconds)
+
+    def observe_prefill(self, seconds: float):
+        PREFILL.observe(seconds)
+
+    def observe_speculation(self, draft_tokens: int, accepted_tokens: int):
+        SPECULATIVE_DRAFT_TOKENS.inc(draft_tokens)
+        SPECULATIVE_ACCEPTED_TOKENS.inc(accepted_tokens)
+        if draft_tokens:
+            SPECULATIVE_ACCEPTANCE_RATE.observe(accepted_tokens / draft_tokens)
+
+    def token(self):
+        now = time.perf_counter()
+        if self.last_token_time is None:
+            TIME_TO_FIRST_TOKEN.observe(now - self.arrival_time)
+        else:
+            INTER_TOKEN_LATENCY.observe(now - self.last_token_time)
+        self.last_token_time = now
+
+    def finish(self, usage: Optional[dict] = None):
+        if self._finished:
+            return
+        self._finished = True
+        IN_FLIGHT.labels(self.endpoint).dec()
+        REQUEST_LATENCY.labels(self.endpoint).observe(time.perf_counter() - self.arrival_time)
+        if usage:
+            PROMPT_TOKENS.labels(self.endpoint).observe(usage["prompt_tokens"])
+            COMPLETION_TOKENS.labels(self.endpoint).observe(usage["completion_tokens"])
@@ -8,14 +8,63 @@ Key Components and Features:
 - Model and Tokenizer Setup: Configures the model and tokenizer paths and loads them.
 - FastAPI Configuration: Sets up a FastAPI application with CORS middleware for handling cross-origin requests.
 - API Endpoints:
-  - "/v1/models": Lists the available models, specifically ChatGLM3-6B.
+  - "/v1/models": Lists the available models, specifically ChatGLM3-6B and the adapters configured in `ADAPTERS`.
   - "/v1/chat/completions": Processes chat completion requests with options for streaming and regular responses.
-  - "/v1/embeddings": Processes Embedding request of a list of text inputs.
+  - "/v1/embeddings": Processes Embedding request of a list of text inputs, encoded in one batched call
+  (`EMBEDDING_BATCH_SIZE`) and cached in an LRU keyed by model name and text hash (`EMBEDDING_CACHE_SIZE`).
+  Concurrent requests are merged into shared forward passes (`EMBEDDING_BATCH_WAIT_MS`, `EMBEDDING_MAX_BATCH_TEXTS`).
+  `encoding_format="base64"` returns little-endian float32 buffers, `embedding_dtype` can shrink them to float16/int8.
+  - "/v1/completions": Completes raw prompts such as "<|user|>\n...\n<|assistant|>", `prompt` may be a list. The
+  prompts are generated together, in padded batches of prompts of similar length (`COMPLETION_MAX_BATCH_TOKENS`),
+  or shortest first through the continuous batching engine.
+- Batch Jobs: OpenAI-compatible "/v1/files" and "/v1/batches" run JSONL files of chat requests in the background
+(`batches.py`), sorted by prompt length and `BATCH_CONCURRENCY` at a time, with progress in `request_counts`.
+Files, states and results are kept in `BATCH_DIR`, unfinished batches resume after a restart.
+- Continuous Batching: Concurrent chat requests share one running batch in `engine.py`, requests join and leave
+between decode steps. Set `MAX_BATCH_SIZE=1` to fall back to one `generate_stream_chatglm3` call per request.
+- Multi-Adapter Serving: P-tuning v2 and LoRA checkpoints from the fine-tuning demos are served on top of the one
+base model (`adapters.py`), `ChatCompletionRequest.model` picks the adapter. At most `ADAPTER_CACHE_SIZE` adapters
+stay loaded, and requests for different adapters share the running batch.
+- Speculative Decoding: With `SPECULATIVE_DRAFT_TOKENS` set and continuous batching off, greedy requests draft tokens
+by matching n-grams of the prompt and output (prompt lookup) and verify them in one forward pass. The output is
+unchanged, usage reports the `draft_acceptance_rate`.
+- Prefix Caching: The KV cache of prompt prefixes (system prompts, tool schemas) is kept in a radix tree
+(`kv_cache.py`), new requests only prefill the part of the prompt that is not cached. Size it with
+`PREFIX_CACHE_MB`, 0 disables it.
+- Conversation Sessions: Requests with a `session_id` (field or "X-Session-Id" header) keep the KV cache of their
+last turn on the server, the next turn of the conversation only prefills the new messages. At most `MAX_SESSIONS`
+sessions and `SESSION_CACHE_MB` of KV are kept on the device, sessions idle for `SESSION_OFFLOAD_AFTER` seconds
+or over that budget move to `SESSION_HOST_MB` of host memory, then to `SESSION_DISK_MB` of files in
+`SESSION_OFFLOAD_DIR`, and are copied back when they resume. Idle sessions are dropped after `SESSION_TTL` seconds.
+- Admission Control: At most `MAX_INFLIGHT_REQUESTS` generations and `MAX_INFLIGHT_TOKENS` tokens (prompt tokens plus
+max_tokens) run at once, others wait in a FIFO queue of `MAX_QUEUED_REQUESTS` for up to `QUEUE_TIMEOUT` seconds.
+When the queue is full or the wait times out, the request fails fast with 429 and a Retry-After header.
+- Client Disconnects: When a client goes away, its generation is cancelled and the batch slot is freed right away,
+streams are cancelled by the SSE layer, non-stream requests poll `Request.is_disconnected()`.
+- Metrics: "/metrics" exports Prometheus histograms of queue wait, tokenization, prefill, time to first token,
+inter-token latency, total latency and token counts, plus in-flight requests and cache hit rates (`metrics.py`).
+- Non-blocking Handlers: Generation never runs on the asyncio event loop, tokens reach the SSE response through
+an `asyncio.Queue`, so "/health" and "/v1/models" stay responsive under load.
+- Multiple Workers: `router.py` runs one server per GPU or CPU core set (`API_PORT` is set per worker) behind a
+router that sends requests to the worker with the fewest outstanding tokens and keeps sessions on their worker.
 - Token Limit Caution: In the OpenAI API, 'max_tokens' is equivalent to HuggingFace's 'max_new_tokens', not 'max_length'.
 For instance, setting 'max_tokens' to 8192 for a 6b model would result in an error due to the model's inability to output
 that many tokens after accounting for the history and prompt tokens.
+- Response Cache: Greedy (temperature 0) generations are cached by a hash of messages, tools and generation
+parameters and replayed in either response format (`response_cache.py`). Enable it with `RESPONSE_CACHE_SIZE`,
+entries expire after `RESPONSE_CACHE_TTL` seconds, `RESPONSE_CACHE_PATH` keeps them in a SQLite file.
+- Parallel Sampling: `n` choices (or `best_of` candidates, of which the `n` most likely are returned) share one
+prompt prefill, the engine copies its KV cache to `n` batch rows and decodes them together. Both are capped at
+`MAX_CHOICES`.
 - Stream Handling and Custom Functions: Manages streaming responses and custom function calls within chat responses.
+Whether a reply is a tool call is decided from its first generated token (the metadata line of ChatGLM3's output),
+so text replies stream without buffering and tool calls are sent as one `function_call` chunk. `stop` strings are
+found incrementally (`StopStringMatcher`), only text that may start a stop string is held back.
 - Pydantic Models: Defines structured models for requests and responses, enhancing API documentation and type safety.
+- Fast Startup: The server starts right away and "/health" answers 503 "loading" (with the seconds spent in each load
+phase) until the models are ready, other endpoints answer 503 meanwhile. The tokenizer, the LLM (from memory-mapped
+safetensors shards) and the embedding model load in parallel (`loader.py`), `EMBEDDING_LAZY=1` defers the
+embedding model to the first "/v1/embeddings" request.
 - Main Execution: Initializes the model and tokenizer, and starts the FastAPI app on the designated host and port.
 
 Note:
@@ -25,21 +74,41 @@ Note:
 
 """
 
+import asyncio
+import json
 import os
 import time
 import tiktoken
 import torch
 import uvicorn
 
-from fastapi import FastAPI, HTTPException, Response
+from fastapi import Depends, FastAPI, Form, HTTPException, Request, Response, UploadFile
+from fastapi.responses import FileResponse, JSONResponse
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 from fastapi.middleware.cors import CORSMiddleware
 
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import asynccontextmanager
 from typing import List, Literal, Optional, Union
 from loguru import logger
-from pydantic import BaseModel, Field
-from transformers import AutoTokenizer, AutoModel
-from utils import process_response, generate_chatglm3, generate_stream_chatglm3
+from pydantic import BaseModel, Field, ValidationError, model_serializer
+from transformers import AutoTokenizer
+from utils import (
+    process_response,
+    generate_stream_chatglm3,
+    generate_batch_chatglm3,
+    build_chat_inputs,
+    build_completion_inputs,
+)
+from engine import AsyncStream, GenerationEngine, GenerationWorker
+from kv_cache import PrefixCache, SessionCache
+from embeddings import EmbeddingBatcher, EmbeddingCache, encode_base64
+from admission import AdmissionController, AdmissionRejected
+from adapters import AdapterRegistry, parse_adapters
+from response_cache import ResponseCache
+from batches import Batch, BatchCreateRequest, BatchList, BatchRunner, FileObject
+from loader import LazyModel, ModelLoader, load_model
+from metrics import IN_FLIGHT, REQUEST_LATENCY, RequestMetrics, register_cache
 from sentence_transformers import SentenceTransformer
 
 from sse_starlette.sse import EventSourceResponse
@@ -47,23 +116,161 @@ from sse_starlette.sse import EventSourceResponse
 # Set up limit request time
 EventSourceResponse.DEFAULT_PING_INTERVAL = 1000
 
+# How often (seconds) a non-stream request checks whether its client is still connected
+DISCONNECT_CHECK_INTERVAL = 0.5
+
+# Stream chunks as `ChatCompletionResponse(...).model_dump_json(exclude_unset=True)` renders them, filled in with
+# the choice index (and JSON-encoded content) instead of building pydantic objects for every token.
+ROLE_CHUNK_TEMPLATE = \
+    '{"object":"chat.completion.chunk","choices":[{"index":%d,"delta":{"role":"assistant"},"finish_reason":null}]}'
+CONTENT_CHUNK_TEMPLATE = \
+    '{"object":"chat.completion.chunk","choices":[{"index":%d,"delta":{"role":"assistant","content":%s,' \
+    '"function_call":null},"finish_reason":null}]}'
+STOP_CHUNK_TEMPLATE = '{"object":"chat.completion.chunk","choices":[{"index":%d,"delta":{},"finish_reason":"stop"}]}'
+
+# set the address the server listens on, "router.py" starts one server per worker port
+API_HOST = os.environ.get('API_HOST', '0.0.0.0')
+API_PORT = int(os.environ.get('API_PORT', 8000))
+
 # set LLM path
 MODEL_PATH = os.environ.get('MODEL_PATH', 'THUDM/chatglm3-6b')
 TOKENIZER_PATH = os.environ.get("TOKENIZER_PATH", MODEL_PATH)
 
-# set Embedding Model path
+# set Embedding Model path and device, and whether it is loaded on the first embedding request instead of at startup
 EMBEDDING_PATH = os.environ.get('EMBEDDING_PATH', 'BAAI/bge-large-zh-v1.5')
+EMBEDDING_DEVICE = os.environ.get('EMBEDDING_DEVICE', 'cuda')
+EMBEDDING_LAZY = bool(int(os.environ.get('EMBEDDING_LAZY', 0)))
+
+# set the batch size of embedding encode calls and the number of cached embeddings, 0 disables the cache
+EMBEDDING_BATCH_SIZE = int(os.environ.get('EMBEDDING_BATCH_SIZE', 32))
+EMBEDDING_CACHE_SIZE = int(os.environ.get('EMBEDDING_CACHE_SIZE', 10000))
+
+# set how long concurrent embedding requests are collected (ms) and how many texts one merged forward pass takes
+EMBEDDING_BATCH_WAIT_MS = float(os.environ.get('EMBEDDING_BATCH_WAIT_MS', 5))
+EMBEDDING_MAX_BATCH_TEXTS = int(os.environ.get('EMBEDDING_MAX_BATCH_TEXTS', 256))
+
+# set P-tuning / LoRA fine-tunes served on top of the base model as "name=checkpoint,name=checkpoint",
+# requested by `model` name, how many of them stay loaded, and the lora_alpha used for LoRA training
+ADAPTERS = parse_adapters(os.environ.get('ADAPTERS', ''))
+ADAPTER_CACHE_SIZE = int(os.environ.get('ADAPTER_CACHE_SIZE', 4))
+LORA_ALPHA = float(os.environ.get('LORA_ALPHA', 32))
+
+# set after how many tokens, or how many ms after its first token, merged stream text is sent as one chunk.
+# 1 token (the default) sends every token right away, raise it to merge chunks
+STREAM_FLUSH_TOKENS = int(os.environ.get('STREAM_FLUSH_TOKENS', 1))
+STREAM_FLUSH_INTERVAL_MS = float(os.environ.get('STREAM_FLUSH_INTERVAL_MS', 0))
+
+# set the max prompt tokens, padding included, of one batch of "/v1/completions" prompts (without continuous batching)
+COMPLETION_MAX_BATCH_TOKENS = int(os.environ.get('COMPLETION_MAX_BATCH_TOKENS', 8192))
+
+# set the max number of requests decoded together, 1 disables continuous batching
+MAX_BATCH_SIZE = int(os.environ.get('MAX_BATCH_SIZE', 8))
+
+# set the max `n` and `best_of` of one chat request, by default one full batch (8 choices without batching,
+# those are generated one after another)
+MAX_CHOICES = int(os.environ.get('MAX_CHOICES', MAX_BATCH_SIZE if MAX_BATCH_SIZE > 1 else 8))
+
+# set the number of prompt lookup draft tokens checked per forward pass for greedy requests, 0 disables speculation.
+# Only used without continuous batching (MAX_BATCH_SIZE=1)
+SPECULATIVE_DRAFT_TOKENS = int(os.environ.get('SPECULATIVE_DRAFT_TOKENS', 0))
+SPECULATIVE_NGRAM_SIZE = int(os.environ.get('SPECULATIVE_NGRAM_SIZE', 3))
+
+# set the memory budget of the prompt prefix KV cache in MB, 0 disables it
+PREFIX_CACHE_MB = int(os.environ.get('PREFIX_CACHE_MB', 1024))
+
+# set the memory budget of the conversation session KV cache in MB (0 disables sessions), the max number of
+# sessions, and how long an idle session is kept in seconds
+SESSION_CACHE_MB = int(os.environ.get('SESSION_CACHE_MB', 2048))
+MAX_SESSIONS = int(os.environ.get('MAX_SESSIONS', 256))
+SESSION_TTL = float(os.environ.get('SESSION_TTL', 600))
+
+# set the host memory and disk budgets (MB, 0 disables a tier) of offloaded session KV caches, the directory of
+# the offload files (a temporary one by default), and after how many idle seconds a session leaves the device
+SESSION_HOST_MB = int(os.environ.get('SESSION_HOST_MB', 8192))
+SESSION_DISK_MB = int(os.environ.get('SESSION_DISK_MB', 0))
+SESSION_OFFLOAD_DIR = os.environ.get('SESSION_OFFLOAD_DIR') or None
+SESSION_OFFLOAD_AFTER = float(os.environ.get('SESSION_OFFLOAD_AFTER', 60))
+
+# set up admission control for chat generations
+MAX_INFLIGHT_REQUESTS = int(os.environ.get('MAX_INFLIGHT_REQUESTS', 32))
+MAX_INFLIGHT_TOKENS = int(os.environ.get('MAX_INFLIGHT_TOKENS', 65536))
+MAX_QUEUED_REQUESTS = int(os.environ.get('MAX_QUEUED_REQUESTS', 64))
+QUEUE_TIMEOUT = float(os.environ.get('QUEUE_TIMEOUT', 30))
+RETRY_AFTER = int(os.environ.get('RETRY_AFTER', 1))
+
+# set the number of cached temperature-0 responses (0 disables the cache), their lifetime in seconds,
+# and optionally a SQLite file that keeps them across restarts
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', 0))
+RESPONSE_CACHE_TTL = float(os.environ.get('RESPONSE_CACHE_TTL', 3600))
+RESPONSE_CACHE_PATH = os.environ.get('RESPONSE_CACHE_PATH', ':memory:')
+
+# set the directory of batch job files and states (empty disables "/v1/files" and "/v1/batches"),
+# and how many requests of a batch job are generated at once
+BATCH_DIR = os.environ.get('BATCH_DIR', 'batches')
+BATCH_CONCURRENCY = int(os.environ.get('BATCH_CONCURRENCY', MAX_BATCH_SIZE))
+
+# Endpoints that answer while the models are still loading
+LOADING_PATHS = ("/health", "/metrics", "/v1/models")
+
+loader = ModelLoader()
+engine = None
+worker = None
+prefix_cache = None
+session_cache = None
+embedding_cache = None
+embedding_batcher = None
+response_cache = None
+adapter_registry = None
+batch_runner = None
+admission = AdmissionController(
+    max_requests=MAX_INFLIGHT_REQUESTS,
+    max_tokens=MAX_INFLIGHT_TOKENS,
+    max_queue=MAX_QUEUED_REQUESTS,
+    timeout=QUEUE_TIMEOUT,
+    retry_after=RETRY_AFTER,
+)
+# Prompts are tokenized off the event loop on one thread: `build_completion_inputs` switches the tokenizer to
+# encoding special tokens while it runs, no other prompt may be tokenized meanwhile.
+tokenizer_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="tokenizer")
+
+
+async def run_tokenizer(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(tokenizer_executor, fn, *args)
+
+
+async def start_when_loaded():
+    await loader.run(load_models)
+    if loader.status == "ready" and batch_runner is not None:
+        batch_runner.start()
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    # Serve "/health" while loading, the models are loaded in the background.
+    loading = asyncio.create_task(start_when_loaded())
     yield
+    loading.cancel()
+    if batch_runner is not None:
+        await batch_runner.stop()
+    if engine is not None:
+        engine.stop()
+    if worker is not None:
+        worker.shutdown()
+    if embedding_batcher is not None:
+        embedding_batcher.stop()
+    if response_cache is not None:
+        response_cache.close()
     if torch.cuda.is_available():
         torch.cuda.empty_cache()
         torch.cuda.ipc_collect()
 
 
-app = FastAPI(lifespan=lifespan)
+async def models_loaded(request: Request):
+    if loader.status != "ready" and request.url.path not in LOADING_PATHS:
+        raise HTTPException(status_code=503, detail=f"The models are {loader.status}", headers={"Retry-After": "5"})
+
+
+app = FastAPI(lifespan=lifespan, dependencies=[Depends(models_loaded)])
 
 app.add_middleware(
     CORSMiddleware,
@@ -111,6 +318,9 @@ class DeltaMessage(BaseModel):
 class EmbeddingRequest(BaseModel):
     input: List[str]
     model: str
+    encoding_format: Literal["float", "base64"] = "float"
+    # Additional parameters, element type of the base64 buffer
+    embedding_dtype: Literal["float32", "float16", "int8"] = "float32"
 
 
 class EmbeddingResponse(BaseModel):
@@ -126,6 +336,16 @@ class UsageInfo(BaseModel):
     prompt_tokens: int = 0
     total_tokens: int = 0
     completion_tokens: Optional[int] = 0
+    # Share of the prompt lookup draft tokens accepted, only with speculative decoding
+    draft_acceptance_rate: Optional[float] = None
+
+    @model_serializer(mode="wrap")
+    def _serialize(self, handler):
+        # Without speculative decoding the usage keeps the OpenAI shape.
+        usage = handler(self)
+        if usage.get("draft_acceptance_rate") is None:
+            usage.pop("draft_acceptance_rate", None)
+        return usage
 
 
 class ChatCompletionRequest(BaseModel):
@@ -136,6 +356,13 @@ class ChatCompletionRequest(BaseModel):
     max_tokens: Optional[int] = None
     stream: Optional[bool] = False
     tools: Optional[Union[dict, List[dict]]] = None
+    # Up to which strings to generate, they are not part of the reply.
+    stop: Optional[Union[str, List[str]]] = None
+    n: Optional[int] = 1
+    # Generate `best_of` candidates and return the `n` most likely ones, not available when streaming.
+    best_of: Optional[int] = None
+    # Keep the KV cache of this conversation for its next turn, also read from the "X-Session-Id" header.
+    session_id: Optional[str] = None
     # Additional parameters
     repetition_penalty: Optional[float] = 1.1
 
@@ -160,63 +387,138 @@ class ChatCompletionResponse(BaseModel):
     usage: Optional[UsageInfo] = None
 
 
+class CompletionRequest(BaseModel):
+    model: str
+    prompt: Union[str, List[str]]
+    temperature: Optional[float] = 0.8
+    top_p: Optional[float] = 0.8
+    max_tokens: Optional[int] = None
+    stream: Optional[bool] = False
+    stop: Optional[Union[str, List[str]]] = None
+    echo: Optional[bool] = False
+    # Additional parameters
+    repetition_penalty: Optional[float] = 1.1
+
+
+class CompletionResponseChoice(BaseModel):
+    index: int
+    text: str
+    logprobs: Optional[dict] = None
+    finish_reason: Literal["stop", "length"]
+
+
+class CompletionResponse(BaseModel):
+    model: str
+    object: Literal["text_completion"] = "text_completion"
+    choices: List[CompletionResponseChoice]
+    created: Optional[int] = Field(default_factory=lambda: int(time.time()))
+    usage: UsageInfo
+
+
 @app.get("/health")
 async def health() -> Response:
-    """Health check."""
-    return Response(status_code=200)
+    """Health check, 503 while the models are loading, with the seconds spent in each load phase."""
+    content = {"status": loader.status, "load_seconds": loader.timings}
+    if loader.error is not None:
+        content["error"] = loader.error
+    return JSONResponse(content, status_code={"ready": 200, "loading": 503}.get(loader.status, 500))
+
+
+@app.get("/metrics")
+async def metrics() -> Response:
+    """Prometheus metrics."""
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
 
 
 @app.post("/v1/embeddings", response_model=EmbeddingResponse)
 async def get_embeddings(request: EmbeddingRequest):
-    embeddings = [embedding_model.encode(text) for text in request.input]
-    embeddings = [embedding.tolist() for embedding in embeddings]
-
-    def num_tokens_from_string(string: str) -> int:
-        """
-        Returns the number of tokens in a text string.
-        use cl100k_base tokenizer
-        """
-        encoding = tiktoken.get_encoding('cl100k_base')
-        num_tokens = len(encoding.encode(string))
-        return num_tokens
+    with IN_FLIGHT.labels("embeddings").track_inprogress(), REQUEST_LATENCY.labels("embeddings").time():
+        embeddings = await embedding_batcher.encode(request.input, request.model)
+
+    if request.encoding_format == "base64":
+        embeddings, scales = encode_base64(embeddings, dtype=request.embedding_dtype)
+    else:
+        embeddings, scales = [embedding.tolist() for embedding in embeddings], None
+
+    data = [
+        {
+            "object": "embedding",
+            "embedding": embedding,
+            "index": index
+        }
+        for index, embedding in enumerate(embeddings)
+    ]
+    if scales is not None:
+        for item, scale in zip(data, scales.tolist()):
+            item["scale"] = scale
 
     response = {
-        "data": [
-            {
-                "object": "embedding",
-                "embedding": embedding,
-                "index": index
-            }
-            for index, embedding in enumerate(embeddings)
-        ],
+        "data": data,
         "model": request.model,
         "object": "list",
         "usage": {
             "prompt_tokens": sum(len(text.split()) for text in request.input),  # how many characters in prompt
-            "total_tokens": sum(num_tokens_from_string(text) for text in request.input),  # how many tokens (encoding)
+            "total_tokens": num_tokens_from_strings(request.input),  # how many tokens (encoding)
         },
     }
     return response
 
 
+def num_tokens_from_strings(strings: List[str]) -> int:
+    """
+    Returns the number of tokens in a list of text strings.
+    use cl100k_base tokenizer, built once at startup
+    """
+    return sum(len(tokens) for tokens in tiktoken_encoding.encode_batch(strings))
+
+
 @app.get("/v1/models", response_model=ModelList)
 async def list_models():
     model_card = ModelCard(
         id="chatglm3-6b"
     )
+    adapter_cards = [
+        ModelCard(id=name, root="chatglm3-6b", parent="chatglm3-6b")
+        for name in (adapter_registry.names if adapter_registry is not None else [])
+    ]
     return ModelList(
-        data=[model_card]
+        data=[model_card] + adapter_cards
     )
 
 
 @app.post("/v1/chat/completions", response_model=ChatCompletionResponse)
-async def create_chat_completion(request: ChatCompletionRequest):
-    global model, tokenizer
+async def create_chat_completion(request: ChatCompletionRequest, raw_request: Request):
+    gen_params = chat_gen_params(request, session_id=request.session_id or raw_request.headers.get("x-session-id"))
+    logger.debug(f"==== request ====\n{gen_params}")
+
+    if request.stream:
+        # The first chunk only comes once the generation is admitted, so a rejection still gets a 429.
+        predict_stream_generator = predict(request.model, gen_params)
+        first_chunk = await cancel_on_disconnect(raw_request, predict_stream_generator.__anext__())
+        return EventSourceResponse(prepend_chunk(first_chunk, predict_stream_generator), media_type="text/event-stream")
+
+    # Here is the handling of stream = False
+    responses = await cancel_on_disconnect(raw_request, generate_response(gen_params))
+    return chat_completion_response(request, responses)
+
 
+def chat_gen_params(request: ChatCompletionRequest, session_id: Optional[str] = None) -> dict:
+    """
+    Validate a chat completion request and turn it into the generation parameters.
+    """
     if len(request.messages) < 1 or request.messages[-1].role == "assistant":
         raise HTTPException(status_code=400, detail="Invalid request")
+    request.n = request.n or 1
+    request.best_of = request.best_of or request.n
+    if request.n < 1 or request.best_of < request.n:
+        raise HTTPException(status_code=400, detail="n must be at least 1 and best_of at least n")
+    if request.best_of > MAX_CHOICES:
+        raise HTTPException(status_code=400, detail=f"n and best_of must be at most {MAX_CHOICES}")
+    if request.best_of > request.n and (request.stream or engine is None):
+        raise HTTPException(status_code=400, detail="best_of is not supported when streaming or without batching")
 
     gen_params = dict(
+        model=request.model,
         messages=request.messages,
         temperature=request.temperature,
         top_p=request.top_p,
@@ -225,275 +527,482 @@ async def create_chat_completion(request: ChatCompletionRequest):
         stream=request.stream,
         repetition_penalty=request.repetition_penalty,
         tools=request.tools,
+        stop=[request.stop] if isinstance(request.stop, str) else request.stop,
+        n=request.n,
+        best_of=request.best_of,
+        session_id=session_id,
     )
-    logger.debug(f"==== request ====\n{gen_params}")
-
-    if request.stream:
-
-        # Use the stream mode to read the first few characters, if it is not a function call, direct stram output
-        predict_stream_generator = predict_stream(request.model, gen_params)
-        output = next(predict_stream_generator)
-        if not contains_custom_function(output):
-            return EventSourceResponse(predict_stream_generator, media_type="text/event-stream")
+    return gen_params
 
-        # Obtain the result directly at one time and determine whether tools needs to be called.
-        logger.debug(f"First result output：\n{output}")
 
-        function_call = None
-        if output and request.tools:
+def chat_completion_response(request: ChatCompletionRequest, responses: List[dict]) -> ChatCompletionResponse:
+    """
+    Build the non-stream response from the last output of every choice.
+    """
+    usage = UsageInfo(prompt_tokens=responses[0]["usage"]["prompt_tokens"])
+    usage.completion_tokens = sum(response["usage"]["completion_tokens"] for response in responses)
+    usage.total_tokens = usage.prompt_tokens + usage.completion_tokens
+    if "draft_acceptance_rate" in responses[0]["usage"]:
+        usage.draft_acceptance_rate = responses[0]["usage"]["draft_acceptance_rate"]
+    if len(responses) > request.n:
+        # best_of: keep the candidates the model found most likely.
+        responses = sorted(responses, key=lambda response: response["cumulative_logprob"], reverse=True)
+        responses = responses[:request.n]
+
+    choices = []
+    for index, response in enumerate(responses):
+        # Remove the first newline character
+        if response["text"].startswith("\n"):
+            response["text"] = response["text"][1:]
+        response["text"] = response["text"].strip()
+
+        function_call, finish_reason = None, "stop"
+        if request.tools:
             try:
-                function_call = process_response(output, use_tool=True)
+                function_call = process_response(response["text"], use_tool=True)
             except:
-                logger.warning("Failed to parse tool call")
+                logger.warning(
+                    "Failed to parse tool call, maybe the response is not a tool call or have been answered.")
 
-        # CallFunction
         if isinstance(function_call, dict):
+            finish_reason = "function_call"
             function_call = FunctionCallResponse(**function_call)
 
-            """
-            In this demo, we did not register any tools.
-            You can use the tools that have been implemented in our `tools_using_demo` and implement your own streaming tool implementation here.
-            Similar to the following method:
-                function_args = json.loads(function_call.arguments)
-                tool_response = dispatch_tool(tool_name: str, tool_params: dict)
-            """
-            tool_response = ""
-
-            if not gen_params.get("messages"):
-                gen_params["messages"] = []
-
-            gen_params["messages"].append(ChatMessage(
-                role="assistant",
-                content=output,
-            ))
-            gen_params["messages"].append(ChatMessage(
-                role="function",
-                name=function_call.name,
-                content=tool_response,
-            ))
-
-            # Streaming output of results after function calls
-            generate = predict(request.model, gen_params)
-            return EventSourceResponse(generate, media_type="text/event-stream")
-
-        else:
-            # Handled to avoid exceptions in the above parsing function process.
-            generate = parse_output_text(request.model, output)
-            return EventSourceResponse(generate, media_type="text/event-stream")
-
-    # Here is the handling of stream = False
-    response = generate_chatglm3(model, tokenizer, gen_params)
-
-    # Remove the first newline character
-    if response["text"].startswith("\n"):
-        response["text"] = response["text"][1:]
-    response["text"] = response["text"].strip()
+        message = ChatMessage(
+            role="assistant",
+            content=response["text"],
+            function_call=function_call if isinstance(function_call, FunctionCallResponse) else None,
+        )
 
-    usage = UsageInfo()
-    function_call, finish_reason = None, "stop"
-    if request.tools:
-        try:
-            function_call = process_response(response["text"], use_tool=True)
-        except:
-            logger.warning("Failed to parse tool call, maybe the response is not a tool call or have been answered.")
-
-    if isinstance(function_call, dict):
-        finish_reason = "function_call"
-        function_call = FunctionCallResponse(**function_call)
-
-    message = ChatMessage(
-        role="assistant",
-        content=response["text"],
-        function_call=function_call if isinstance(function_call, FunctionCallResponse) else None,
-    )
+        logger.debug(f"==== message ====\n{message}")
 
-    logger.debug(f"==== message ====\n{message}")
-
-    choice_data = ChatCompletionResponseChoice(
-        index=0,
-        message=message,
-        finish_reason=finish_reason,
-    )
-    task_usage = UsageInfo.model_validate(response["usage"])
-    for usage_key, usage_value in task_usage.model_dump().items():
-        setattr(usage, usage_key, getattr(usage, usage_key) + usage_value)
+        choices.append(ChatCompletionResponseChoice(
+            index=index,
+            message=message,
+            finish_reason=finish_reason,
+        ))
 
     return ChatCompletionResponse(
-        choices=[choice_data],
+        choices=choices,
         object="chat.completion",
         usage=usage
     )
 
 
-async def predict(model_id: str, params: dict):
-    global model, tokenizer
+async def run_batch_request(body: dict) -> dict:
+    """
+    Run one request of a batch job, like a non-stream call to "/v1/chat/completions".
+    """
+    try:
+        request = ChatCompletionRequest.model_validate(body)
+    except ValidationError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if request.stream:
+        raise HTTPException(status_code=400, detail="Batch requests cannot stream")
+    responses = await generate_response(chat_gen_params(request, session_id=None))
+    return chat_completion_response(request, responses).model_dump()
 
-    choice_data = ChatCompletionResponseStreamChoice(
-        index=0,
-        delta=DeltaMessage(role="assistant"),
-        finish_reason=None
-    )
-    chunk = ChatCompletionResponse(model=model_id, choices=[choice_data], object="chat.completion.chunk")
-    yield "{}".format(chunk.model_dump_json(exclude_unset=True))
 
-    previous_text = ""
-    for new_response in generate_stream_chatglm3(model, tokenizer, params):
-        decoded_unicode = new_response["text"]
-        delta_text = decoded_unicode[len(previous_text):]
-        previous_text = decoded_unicode
+@app.post("/v1/files", response_model=FileObject)
+async def upload_file(file: UploadFile, purpose: str = Form("batch")):
+    if batch_runner is None:
+        raise HTTPException(status_code=404, detail="Batch jobs are disabled")
+    content = await file.read()
+    return await asyncio.to_thread(batch_runner.create_file, file.filename or "input.jsonl", purpose, content)
 
-        finish_reason = new_response["finish_reason"]
-        if len(delta_text) == 0 and finish_reason != "function_call":
-            continue
 
-        function_call = None
-        if finish_reason == "function_call":
-            try:
-                function_call = process_response(decoded_unicode, use_tool=True)
-            except:
-                logger.warning(
-                    "Failed to parse tool call, maybe the response is not a tool call or have been answered.")
+@app.get("/v1/files/{file_id}", response_model=FileObject)
+async def retrieve_file(file_id: str):
+    file = batch_runner.get_file(file_id) if batch_runner is not None else None
+    if file is None:
+        raise HTTPException(status_code=404, detail=f"No such file: {file_id}")
+    return file
 
-        if isinstance(function_call, dict):
-            function_call = FunctionCallResponse(**function_call)
 
-        delta = DeltaMessage(
-            content=delta_text,
-            role="assistant",
-            function_call=function_call if isinstance(function_call, FunctionCallResponse) else None,
-        )
+@app.get("/v1/files/{file_id}/content")
+async def retrieve_file_content(file_id: str):
+    if batch_runner is None or batch_runner.get_file(file_id) is None:
+        raise HTTPException(status_code=404, detail=f"No such file: {file_id}")
+    return FileResponse(batch_runner.file_path(file_id), media_type="application/jsonl")
 
-        choice_data = ChatCompletionResponseStreamChoice(
-            index=0,
-            delta=delta,
-            finish_reason=finish_reason
-        )
-        chunk = ChatCompletionResponse(model=model_id, choices=[choice_data], object="chat.completion.chunk")
-        yield "{}".format(chunk.model_dump_json(exclude_unset=True))
 
-    choice_data = ChatCompletionResponseStreamChoice(
-        index=0,
-        delta=DeltaMessage(),
-        finish_reason="stop"
-    )
-    chunk = ChatCompletionResponse(model=model_id, choices=[choice_data], object="chat.completion.chunk")
-    yield "{}".format(chunk.model_dump_json(exclude_unset=True))
-    yield '[DONE]'
+@app.post("/v1/batches", response_model=Batch)
+async def create_batch(request: BatchCreateRequest):
+    if batch_runner is None:
+        raise HTTPException(status_code=404, detail="Batch jobs are disabled")
+    return batch_runner.create_batch(request)
 
 
-def predict_stream(model_id, gen_params):
-    """
-    The function call is compatible with stream mode output.
+@app.get("/v1/batches", response_model=BatchList)
+async def list_batches():
+    batches = list(batch_runner.batches.values()) if batch_runner is not None else []
+    return BatchList(data=sorted(batches, key=lambda batch: batch.created_at, reverse=True))
+
 
-    The first seven characters are determined.
-    If not a function call, the stream output is directly generated.
-    Otherwise, the complete character content of the function call is returned.
+@app.get("/v1/batches/{batch_id}", response_model=Batch)
+async def retrieve_batch(batch_id: str):
+    batch = batch_runner.batches.get(batch_id) if batch_runner is not None else None
+    if batch is None:
+        raise HTTPException(status_code=404, detail=f"No such batch: {batch_id}")
+    return batch
 
-    :param model_id:
-    :param gen_params:
-    :return:
+
+@app.post("/v1/batches/{batch_id}/cancel", response_model=Batch)
+async def cancel_batch(batch_id: str):
+    batch = batch_runner.cancel_batch(batch_id) if batch_runner is not None else None
+    if batch is None:
+        raise HTTPException(status_code=404, detail=f"No such batch: {batch_id}")
+    return batch
+
+
+async def predict(model_id: str, params: dict):
     """
-    output = ""
-    is_function_call = False
-    has_send_first_chunk = False
-    for new_response in generate_stream_chatglm3(model, tokenizer, gen_params):
-        decoded_unicode = new_response["text"]
-        delta_text = decoded_unicode[len(output):]
-        output = decoded_unicode
-
-        # When it is not a function call and the character length is> 7,
-        # try to judge whether it is a function call according to the special function prefix
-        if not is_function_call and len(output) > 7:
-
-            # Determine whether a function is called
-            is_function_call = contains_custom_function(output)
-            if is_function_call:
+    Stream a chat completion.
+
+    Text replies are streamed as they are generated. When the request has `tools` and the generation reports
+    a tool call (`is_tool_call`, decided from the first tokens), the output is held back and sent in one chunk
+    with the parsed `function_call` once `<|observation|>` ends it.
+    With `n` choices, the chunks of all choices are interleaved and told apart by their `index`.
+    With `STREAM_FLUSH_TOKENS` or `STREAM_FLUSH_INTERVAL_MS` set, the new text of several tokens is sent in one
+    chunk. Text chunks are rendered from templates, the same JSON as `ChatCompletionResponse.model_dump_json`.
+    """
+    flush_interval = STREAM_FLUSH_INTERVAL_MS / 1000
+    # Length of the text already sent, number of tokens not sent yet and when the oldest of them arrived, per choice.
+    sent_length, unsent_tokens, unsent_since = {}, {}, {}
+    texts = {}
+
+    def flush(index: int) -> str:
+        delta_text = texts[index][sent_length[index]:]
+        sent_length[index] = len(texts[index])
+        unsent_tokens[index] = 0
+        unsent_since.pop(index, None)
+        return CONTENT_CHUNK_TEMPLATE % (index, json.dumps(delta_text, ensure_ascii=False))
+
+    responses = generate_stream(params).__aiter__()
+    next_response = None
+    try:
+        while True:
+            if next_response is None:
+                next_response = asyncio.ensure_future(responses.__anext__())
+            if unsent_since and flush_interval > 0:
+                # Wake up to send text that waited long enough, even if no new token arrives.
+                timeout = max(min(unsent_since.values()) + flush_interval - time.perf_counter(), 0)
+                done, _ = await asyncio.wait({next_response}, timeout=timeout)
+                if not done:
+                    deadline = time.perf_counter() - flush_interval
+                    for index in [index for index, since in unsent_since.items() if since <= deadline]:
+                        yield flush(index)
+                    continue
+            try:
+                new_response = await next_response
+            except StopAsyncIteration:
+                break
+            next_response = None
+
+            index = new_response["index"]
+            if index not in sent_length:
+                sent_length[index] = 0
+                unsent_tokens[index] = 0
+                yield ROLE_CHUNK_TEMPLATE % index
+
+            decoded_unicode = new_response["text"]
+            texts[index] = decoded_unicode
+            finish_reason = new_response["finish_reason"]
+            if params["tools"] and new_response["is_tool_call"] is not False and finish_reason is None:
                 continue
 
-            # Non-function call, direct stream output
-            finish_reason = new_response["finish_reason"]
+            if finish_reason == "function_call":
+                function_call = None
+                try:
+                    function_call = process_response(decoded_unicode, use_tool=True)
+                except:
+                    logger.warning(
+                        "Failed to parse tool call, maybe the response is not a tool call or have been answered.")
 
-            # Send an empty string first to avoid truncation by subsequent next() operations.
-            if not has_send_first_chunk:
-                message = DeltaMessage(
-                    content="",
+                if isinstance(function_call, dict):
+                    function_call = FunctionCallResponse(**function_call)
+
+                # Everything not sent yet, more than the last delta when a tool call was held back.
+                delta = DeltaMessage(
+                    content=decoded_unicode[sent_length[index]:],
                     role="assistant",
-                    function_call=None,
+                    function_call=function_call if isinstance(function_call, FunctionCallResponse) else None,
                 )
+                sent_length[index] = len(decoded_unicode)
+                unsent_since.pop(index, None)
                 choice_data = ChatCompletionResponseStreamChoice(
-                    index=0,
-                    delta=message,
-                    finish_reason=finish_reason
+                    index=index,
+                    delta=delta,
+                    finish_reason="function_call" if delta.function_call is not None else None
                 )
                 chunk = ChatCompletionResponse(model=model_id, choices=[choice_data], object="chat.completion.chunk")
                 yield "{}".format(chunk.model_dump_json(exclude_unset=True))
+                continue
+
+            if len(decoded_unicode) == sent_length[index]:
+                continue
+            unsent_tokens[index] += 1
+            unsent_since.setdefault(index, time.perf_counter())
+            if finish_reason is not None or unsent_tokens[index] >= STREAM_FLUSH_TOKENS or \
+                    (flush_interval > 0 and time.perf_counter() - unsent_since[index] >= flush_interval):
+                yield flush(index)
+    finally:
+        if next_response is not None:
+            next_response.cancel()
+
+    for index in sorted(sent_length):
+        if index in unsent_since:
+            yield flush(index)
+        yield STOP_CHUNK_TEMPLATE % index
+    yield '[DONE]'
 
-            send_msg = delta_text if has_send_first_chunk else output
-            has_send_first_chunk = True
-            message = DeltaMessage(
-                content=send_msg,
-                role="assistant",
-                function_call=None,
-            )
-            choice_data = ChatCompletionResponseStreamChoice(
-                index=0,
-                delta=message,
-                finish_reason=finish_reason
-            )
-            chunk = ChatCompletionResponse(model=model_id, choices=[choice_data], object="chat.completion.chunk")
-            yield "{}".format(chunk.model_dump_json(exclude_unset=True))
-
-    if is_function_call:
-        yield output
-    else:
-        yield '[DONE]'
 
+async def prepend_chunk(first_chunk: str, generator):
+    yield first_chunk
+    async for chunk in generator:
+        yield chunk
 
-async def parse_output_text(model_id: str, value: str):
+
+async def generate_stream(params: dict):
+    """
+    Stream a chat generation, through the batching engine when it is enabled,
+    otherwise on the dedicated generation worker thread.
+    Greedy generations are replayed from the response cache when it has them.
     """
-    Directly output the text content of value
+    cache_key, outputs = None, []
+    if response_cache is not None and params["temperature"] <= 1e-5:
+        cache_key = response_cache.key(params)
+        # The cache may live in a SQLite file, keep its disk reads and writes off the event loop.
+        cached_outputs = await asyncio.to_thread(response_cache.get, cache_key)
+        if cached_outputs is not None:
+            for response in cached_outputs:
+                yield response
+            return
+
+    request_metrics = RequestMetrics("chat")
+    usage, permit, stream = None, None, None
+    completion_tokens = {}
+    num_sequences = max(params.get("n") or 1, params.get("best_of") or 1)
+    try:
+        start_time = time.perf_counter()
+        inputs = await run_tokenizer(build_chat_inputs, tokenizer, params["messages"], params["tools"])
+        request_metrics.observe_tokenization(time.perf_counter() - start_time)
+        adapter = None
+        if adapter_registry is not None:
+            # Loading an adapter reads its checkpoint, keep that off the event loop.
+            adapter = await asyncio.to_thread(adapter_registry.get, params["model"])
 
-    :param model_id:
-    :param value:
-    :return:
+        try:
+            permit = await admission.acquire(inputs["input_ids"].shape[1] + params["max_tokens"] * num_sequences)
+        except AdmissionRejected as e:
+            raise HTTPException(status_code=429, detail=e.reason, headers={"Retry-After": str(e.retry_after)})
+
+        if engine is not None:
+            stream = engine.generate_stream_async(params, metrics=request_metrics, inputs=inputs, adapter=adapter)
+        else:
+            stream = AsyncStream()
+            worker.stream(generate_choices_chatglm3, params, request_metrics, inputs, stream.cancelled, adapter,
+                          stream=stream)
+        async for response in stream:
+            # All choices share the prompt, the request uses the completion tokens of all of them.
+            completion_tokens[response["index"]] = response["usage"]["completion_tokens"]
+            usage = dict(response["usage"], completion_tokens=sum(completion_tokens.values()))
+            usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+            if cache_key is not None:
+                outputs.append(response)
+            yield response
+
+        # Only complete generations are cached, a consumer that stops early never gets here.
+        if cache_key is not None and outputs:
+            await asyncio.to_thread(response_cache.put, cache_key, outputs)
+    finally:
+        # A no-op when the generation finished, otherwise the consumer went away and the model can stop.
+        if stream is not None:
+            stream.cancel()
+        if permit is not None:
+            permit.release()
+        request_metrics.finish(usage)
+
+
+def generate_choices_chatglm3(params: dict, metrics: RequestMetrics, inputs, cancelled, adapter=None):
     """
-    choice_data = ChatCompletionResponseStreamChoice(
-        index=0,
-        delta=DeltaMessage(role="assistant", content=value),
-        finish_reason=None
-    )
-    chunk = ChatCompletionResponse(model=model_id, choices=[choice_data], object="chat.completion.chunk")
-    yield "{}".format(chunk.model_dump_json(exclude_unset=True))
+    Generate the `n` choices of a request one after another on the worker thread.
+    With the prefix cache, only the first choice prefills the whole prompt.
+    """
+    for index in range(params.get("n") or 1):
+        for response in generate_stream_chatglm3(model, tokenizer, params, prefix_cache,
+                                                 metrics if index == 0 else None, inputs, cancelled,
+                                                 SPECULATIVE_DRAFT_TOKENS, SPECULATIVE_NGRAM_SIZE, adapter,
+                                                 session_cache if index == 0 else None):
+            response["index"] = index
+            yield response
 
-    choice_data = ChatCompletionResponseStreamChoice(
-        index=0,
-        delta=DeltaMessage(),
-        finish_reason="stop"
-    )
-    chunk = ChatCompletionResponse(model=model_id, choices=[choice_data], object="chat.completion.chunk")
-    yield "{}".format(chunk.model_dump_json(exclude_unset=True))
-    yield '[DONE]'
 
+async def cancel_on_disconnect(raw_request: Request, awaitable):
+    """
+    Await `awaitable`, but cancel it as soon as the client disconnects.
+    Cancelling it closes the generation stream, which frees the compute slot.
+    """
+    task = asyncio.ensure_future(awaitable)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=DISCONNECT_CHECK_INTERVAL)
+            if done:
+                return task.result()
+            if await raw_request.is_disconnected():
+                logger.debug("Client disconnected, cancelling generation")
+                raise HTTPException(status_code=499, detail="Client closed request")
+    finally:
+        task.cancel()
+
+
+@app.post("/v1/completions", response_model=CompletionResponse)
+async def create_completion(request: CompletionRequest, raw_request: Request):
+    if request.stream:
+        raise HTTPException(status_code=400, detail="Streaming is not supported for completions")
+    prompts = [request.prompt] if isinstance(request.prompt, str) else request.prompt
+    if len(prompts) < 1:
+        raise HTTPException(status_code=400, detail="Invalid request")
 
-def contains_custom_function(value: str) -> bool:
+    params = dict(
+        model=request.model,
+        temperature=request.temperature,
+        top_p=request.top_p,
+        max_tokens=request.max_tokens or 1024,
+        echo=False,
+        repetition_penalty=request.repetition_penalty,
+        stop=[request.stop] if isinstance(request.stop, str) else request.stop,
+    )
+    responses = await cancel_on_disconnect(raw_request, generate_completions(params, prompts))
+
+    usage = UsageInfo()
+    choices = []
+    for index, (prompt, response) in enumerate(zip(prompts, responses)):
+        usage.prompt_tokens += response["usage"]["prompt_tokens"]
+        usage.completion_tokens += response["usage"]["completion_tokens"]
+        finish_reason = "length" if response["usage"]["completion_tokens"] >= params["max_tokens"] else "stop"
+        text = prompt + response["text"] if request.echo else response["text"]
+        choices.append(CompletionResponseChoice(index=index, text=text, finish_reason=finish_reason))
+    usage.total_tokens = usage.prompt_tokens + usage.completion_tokens
+    return CompletionResponse(model=request.model, choices=choices, usage=usage)
+
+
+async def generate_completions(params: dict, prompts: List[str]) -> List[dict]:
+    """
+    Complete every prompt and return their last outputs in prompt order.
     """
-    Determine whether 'function_call' according to a special function prefix.
+    request_metrics = RequestMetrics("completions")
+    usage, permit, streams = None, None, []
+    try:
+        start_time = time.perf_counter()
+        prompt_ids = await run_tokenizer(lambda: [build_completion_inputs(tokenizer, prompt) for prompt in prompts])
+        request_metrics.observe_tokenization(time.perf_counter() - start_time)
 
-    For example, the functions defined in "tools_using_demo/tool_register.py" are all "get_xxx" and start with "get_"
+        try:
+            permit = await admission.acquire(sum(map(len, prompt_ids)) + params["max_tokens"] * len(prompts))
+        except AdmissionRejected as e:
+            raise HTTPException(status_code=429, detail=e.reason, headers={"Retry-After": str(e.retry_after)})
+
+        request_metrics.start()
+        responses = [None] * len(prompts)
+        if engine is not None:
+            # Shortest first, prompts of similar length join the running batch together.
+            order = sorted(range(len(prompts)), key=lambda index: len(prompt_ids[index]))
+            streams = [
+                engine.generate_stream_async(params, inputs={"input_ids": torch.tensor([prompt_ids[index]])})
+                for index in order
+            ]
+
+            async def last_output(index, stream):
+                async for response in stream:
+                    responses[index] = dict(response, index=index)
+
+            await asyncio.gather(*(last_output(index, stream) for index, stream in zip(order, streams)))
+        else:
+            stream = AsyncStream()
+            streams.append(stream)
+            worker.stream(generate_batch_chatglm3, model, tokenizer, prompt_ids, params, stream.cancelled,
+                          COMPLETION_MAX_BATCH_TOKENS, stream=stream)
+            async for response in stream:
+                responses[response["index"]] = response
+
+        usage = {
+            "prompt_tokens": sum(response["usage"]["prompt_tokens"] for response in responses),
+            "completion_tokens": sum(response["usage"]["completion_tokens"] for response in responses),
+        }
+        return responses
+    finally:
+        # A no-op for finished generations, otherwise the client went away and the model can stop.
+        for stream in streams:
+            stream.cancel()
+        if permit is not None:
+            permit.release()
+        request_metrics.finish(usage)
+
+
+async def generate_response(params: dict):
+    """
+    Run a generation to the end and return the last output of every choice, ordered by index.
+    """
+    responses = {}
+    async for response in generate_stream(params):
+        responses[response["index"]] = response
+    return [responses[index] for index in sorted(responses)]
 
-    [Note] This is not a rigorous judgment method, only for reference.
 
-    :param value:
-    :return:
+def load_models():
     """
-    return value and 'get_' in value
+    Load the tokenizer, the LLM, the embedding model and the tiktoken encoding in parallel, then set up generation.
+    """
+    global tokenizer, model, tiktoken_encoding, adapter_registry, engine, worker
+    tokenizer_future = loader.submit("tokenizer", AutoTokenizer.from_pretrained, TOKENIZER_PATH, trust_remote_code=True)
+    model_future = loader.submit("llm", load_model, MODEL_PATH, device_map="auto")
+    tiktoken_future = loader.submit("tiktoken", tiktoken.get_encoding, 'cl100k_base')
+    embedding_future = None if EMBEDDING_LAZY else loader.run_in_background(embedding_model.get)
+    tokenizer = tokenizer_future.result()
+    model = model_future.result()
+    tiktoken_encoding = tiktoken_future.result()
+
+    with loader.phase("generation"):
+        if ADAPTERS:
+            adapter_registry = AdapterRegistry(model, ADAPTERS, max_loaded=ADAPTER_CACHE_SIZE, lora_alpha=LORA_ALPHA)
+            register_cache("adapter", adapter_registry)
+        if MAX_BATCH_SIZE > 1:
+            engine = GenerationEngine(model, tokenizer, max_batch_size=MAX_BATCH_SIZE, prefix_cache=prefix_cache,
+                                      session_cache=session_cache).start()
+        else:
+            worker = GenerationWorker()
+    if embedding_future is not None:
+        embedding_future.result()
 
 
 if __name__ == "__main__":
-    # Load LLM
-    tokenizer = AutoTokenizer.from_pretrained(TOKENIZER_PATH, trust_remote_code=True)
-    model = AutoModel.from_pretrained(MODEL_PATH, trust_remote_code=True, device_map="auto").eval()
-
-    # load Embedding
-    embedding_model = SentenceTransformer(EMBEDDING_PATH, device="cuda")
-    uvicorn.run(app, host='0.0.0.0', port=8000, workers=1)
+    if PREFIX_CACHE_MB > 0:
+        prefix_cache = PrefixCache(max_bytes=PREFIX_CACHE_MB * 1024 * 1024)
+    if prefix_cache is not None:
+        register_cache("prefix", prefix_cache)
+    if SESSION_CACHE_MB > 0:
+        session_cache = SessionCache(max_sessions=MAX_SESSIONS, max_bytes=SESSION_CACHE_MB * 1024 * 1024,
+                                     ttl=SESSION_TTL, host_bytes=SESSION_HOST_MB * 1024 * 1024,
+                                     disk_bytes=SESSION_DISK_MB * 1024 * 1024, offload_dir=SESSION_OFFLOAD_DIR,
+                                     offload_after=SESSION_OFFLOAD_AFTER)
+        register_cache("session", session_cache)
+    if RESPONSE_CACHE_SIZE > 0:
+        response_cache = ResponseCache(max_size=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL, path=RESPONSE_CACHE_PATH)
+        register_cache("response", response_cache)
+    if BATCH_DIR:
+        batch_runner = BatchRunner(BATCH_DIR, run_batch_request, concurrency=BATCH_CONCURRENCY)
+
+    # The embedding model is loaded by `load_models`, or by the first encode call with EMBEDDING_LAZY
+    embedding_model = LazyModel(loader.timed("embedding", SentenceTransformer, EMBEDDING_PATH, device=EMBEDDING_DEVICE))
+    if EMBEDDING_CACHE_SIZE > 0:
+        embedding_cache = EmbeddingCache(max_size=EMBEDDING_CACHE_SIZE)
+        register_cache("embedding", embedding_cache)
+    embedding_batcher = EmbeddingBatcher(
+        embedding_model,
+        cache=embedding_cache,
+        batch_size=EMBEDDING_BATCH_SIZE,
+        max_batch_texts=EMBEDDING_MAX_BATCH_TEXTS,
+        max_wait=EMBEDDING_BATCH_WAIT_MS / 1000,
+    ).start()
+    uvicorn.run(app, host=API_HOST, port=API_PORT, workers=1)
@@ -0,0 +1,87 @@
+"""
+A cache of finished chat generations for deterministic (temperature 0) requests of the ChatGLM3-6B OpenAI-style API.
+
+Classification-style prompts with greedy decoding repeat exactly and always produce the same answer, so the
+outputs of a finished generation are stored under a canonical hash of the messages, tools and generation
+parameters. A hit replays the stored outputs instead of running the model; the API turns them into a regular
+response or re-sends the same SSE chunks, depending on `stream`, which is not part of the key.
+
+Entries live in SQLite: an in-memory database by default, or a file that survives restarts. They are evicted
+least recently used first once there are more than `max_size`, and expire `ttl` seconds after they were stored.
+"""
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+from typing import List, Optional
+from pydantic import BaseModel
+
+
+class ResponseCache:
+    """
+    Thread-safe LRU + TTL cache of generation outputs, the dicts yielded by `generate_stream`.
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: float = 3600, path: str = ":memory:"):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, outputs TEXT NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+
+    @staticmethod
+    def key(params: dict) -> str:
+        """
+        Hash everything that decides the generated text, `stream` only changes how it is sent and
+        `session_id` only which KV cache the prompt is resumed from.
+        """
+        payload = {name: value for name, value in params.items() if name not in ("stream", "session_id")}
+        payload["messages"] = [
+            message.model_dump() if isinstance(message, BaseModel) else message for message in params["messages"]
+        ]
+        canonical = json.dumps(payload, sort_keys=True, ensure_ascii=False, separators=(",", ":"), default=str)
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[List[dict]]:
+        now = time.time()
+        with self._lock:
+            row = self._db.execute("SELECT outputs, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is not None and row[1] + self.ttl < now:
+                self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self._db.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+            self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, key: str, outputs: List[dict]):
+        now = time.time()
+        value = json.dumps(outputs, ensure_ascii=False)
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)", (key, value, now, now))
+            self._db.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl,))
+            self._db.execute(
+                "DELETE FROM responses WHERE key IN "
+                "(SELECT key FROM responses ORDER BY accessed DESC LIMIT -1 OFFSET ?)", (self.max_size,))
+
+    def clear(self):
+        with self._lock:
+            self._db.execute("DELETE FROM responses")
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
@@ -0,0 +1,404 @@
+"""
+Run several ChatGLM3-6B model workers on one machine behind a single OpenAI-style endpoint.
+
+`openai_api.py` serves one model replica from one process. This script starts `NUM_WORKERS` of them, each on its
+own port and pinned to its own device, and serves a lightweight router in front of them on `ROUTER_PORT`.
+
+Key Components:
+- launch_worker: starts one `openai_api.py` process. A worker device is either a CUDA device index ("0") or a
+  CPU core set ("cpu:0-7"): the process only sees that GPU, or is pinned to those cores with as many threads.
+- Router: forwards every request to the healthy worker with the fewest outstanding tokens (prompt estimate plus
+  `max_tokens` of the requests it is running). Requests with a session id (`session_id` field or "X-Session-Id"
+  header) stay on the worker that holds the KV cache of their conversation. Batch jobs ("/v1/files",
+  "/v1/batches") always go to the first worker, the only one that keeps batch files and runs batches.
+- Health: the router polls "/health" of every worker, takes failing workers out of rotation until they recover,
+  and restarts worker processes that exited.
+- Metrics: "/metrics" scrapes every worker and serves their metrics together, with a `worker` label.
+
+Usage:
+    NUM_WORKERS=2 WORKER_DEVICES=0,1 python router.py
+    NUM_WORKERS=4 WORKER_DEVICES=cpu:0-3,cpu:4-7,cpu:8-11,cpu:12-15 MODEL_PATH=/path/to/small/model python router.py
+"""
+
+import asyncio
+import json
+import os
+import re
+import shlex
+import subprocess
+import sys
+
+import httpx
+import uvicorn
+
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
+from loguru import logger
+from starlette.background import BackgroundTask
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, generate_latest
+from prometheus_client.metrics_core import Metric
+from prometheus_client.parser import text_string_to_metric_families
+from prometheus_client.samples import Sample
+
+# set the number of model workers, their devices ("0,1" for GPUs, "cpu:0-3,cpu:4-7" for CPU core sets),
+# by default one worker per GPU, or the CPU cores split evenly
+NUM_WORKERS = int(os.environ.get('NUM_WORKERS', 0))
+WORKER_DEVICES = os.environ.get('WORKER_DEVICES', '')
+
+# set the ports of the router and of the first worker, the others follow
+ROUTER_PORT = int(os.environ.get('ROUTER_PORT', 8000))
+WORKER_BASE_PORT = int(os.environ.get('WORKER_BASE_PORT', 8001))
+
+# set the command that starts one worker, it gets its port in API_PORT
+WORKER_COMMAND = os.environ.get('WORKER_COMMAND', f"{shlex.quote(sys.executable)} openai_api.py")
+
+# set how often (seconds) workers are health checked, and how many session to worker assignments are kept
+HEALTH_CHECK_INTERVAL = float(os.environ.get('HEALTH_CHECK_INTERVAL', 2))
+MAX_AFFINITY_SESSIONS = int(os.environ.get('MAX_AFFINITY_SESSIONS', 10000))
+
+# Requests that are answered by the first worker, which keeps the uploaded files and batch states
+PINNED_PATHS = ("v1/files", "v1/batches")
+
+# Rough number of prompt characters per token, to estimate the cost of a request before it is tokenized
+CHARS_PER_TOKEN = 3
+
+HOP_BY_HOP_HEADERS = {"connection", "keep-alive", "transfer-encoding", "content-length", "host"}
+
+
+def parse_cpu_set(spec: str) -> List[int]:
+    """
+    Parse a core set such as "0-3,8" into core ids.
+    """
+    cores = []
+    for part in spec.split(","):
+        if "-" in part:
+            first, last = part.split("-")
+            cores.extend(range(int(first), int(last) + 1))
+        elif part:
+            cores.append(int(part))
+    return cores
+
+
+def default_devices(num_workers: int) -> List[str]:
+    """
+    One GPU per worker when there are GPUs, otherwise an even share of the CPU cores.
+    """
+    try:
+        import torch
+        num_gpus = torch.cuda.device_count()
+    except ImportError:
+        num_gpus = 0
+    num_workers = num_workers or max(num_gpus, 1)
+    if num_gpus:
+        return [str(index % num_gpus) for index in range(num_workers)]
+    cores = sorted(os.sched_getaffinity(0))
+    share = max(len(cores) // num_workers, 1)
+    return [
+        "cpu:" + ",".join(map(str, cores[index * share % len(cores):][:share])) for index in range(num_workers)
+    ]
+
+
+def worker_devices(num_workers: int, spec: str) -> List[str]:
+    """
+    Parse `WORKER_DEVICES`, CPU core sets contain commas themselves, so those are split at their "cpu:" prefixes.
+    """
+    if not spec:
+        return default_devices(num_workers)
+    separator = r",\s*(?=cpu:)" if spec.lstrip().startswith("cpu:") else r",\s*"
+    devices = re.split(separator, spec.strip())
+    num_workers = num_workers or len(devices)
+    return [devices[index % len(devices)] for index in range(num_workers)]
+
+
+class Worker:
+    """
+    One model worker process and what the router knows about it.
+    """
+
+    def __init__(self, url: str, device: Optional[str] = None, port: Optional[int] = None,
+                 command: Optional[str] = None, batches: bool = False):
+        self.url = url
+        self.device = device
+        self.port = port
+        self.command = command
+        self.batches = batches
+        self.process: Optional[subprocess.Popen] = None
+        self.healthy = False
+        self.outstanding_tokens = 0
+        self.outstanding_requests = 0
+
+    def start(self):
+        """
+        Start the worker process, pinned to its device.
+        """
+        # Workers only listen on loopback, clients go through the router.
+        env = dict(os.environ, API_HOST="127.0.0.1", API_PORT=str(self.port))
+        if not self.batches:
+            # A worker resumes every unfinished batch in its BATCH_DIR, only one of them may have it.
+            env["BATCH_DIR"] = ""
+        preexec_fn = None
+        if self.device is not None and self.device.startswith("cpu:"):
+            cores = parse_cpu_set(self.device[len("cpu:"):])
+            env.update(CUDA_VISIBLE_DEVICES="", OMP_NUM_THREADS=str(len(cores)), EMBEDDING_DEVICE="cpu")
+
+            def preexec_fn():
+                os.sched_setaffinity(0, cores)
+        elif self.device is not None:
+            env["CUDA_VISIBLE_DEVICES"] = self.device
+        logger.info(f"Starting worker on port {self.port}, device {self.device}")
+        self.process = subprocess.Popen(shlex.split(self.command), env=env, preexec_fn=preexec_fn)
+        return self
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+
+
+def estimate_tokens(body: bytes, payload: Optional[dict]) -> int:
+    """
+    Prompt tokens estimated from the request size, plus the completion tokens the request may generate.
+    """
+    tokens = len(body) // CHARS_PER_TOKEN
+    if isinstance(payload, dict):
+        sequences = max(int(payload.get("n") or 1), int(payload.get("best_of") or 1))
+        prompts = payload.get("prompt")
+        if isinstance(prompts, list):
+            sequences *= len(prompts)
+        tokens += int(payload.get("max_tokens") or 1024) * sequences
+    return tokens
+
+
+class RelayResponse(StreamingResponse):
+    """
+    A streaming response that runs its background task however it ends, also when the client disconnects
+    before or while the body is sent, which `StreamingResponse` skips.
+    """
+
+    async def __call__(self, scope, receive, send):
+        background, self.background = self.background, None
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            if background is not None:
+                await background()
+
+
+class Router:
+    """
+    Picks a worker for every request and keeps track of the load and health of the workers.
+    """
+
+    def __init__(self, workers: List[Worker], health_check_interval: float = 2.0,
+                 max_sessions: int = 10000):
+        self.workers = workers
+        self.health_check_interval = health_check_interval
+        self.max_sessions = max_sessions
+        self._sessions: "OrderedDict[str, Worker]" = OrderedDict()
+        self._client: Optional[httpx.AsyncClient] = None
+        self._health_task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        self._client = httpx.AsyncClient(timeout=httpx.Timeout(None, connect=5.0))
+        await self.check_health()
+        self._health_task = asyncio.create_task(self._health_loop())
+
+    async def stop(self):
+        if self._health_task is not None:
+            self._health_task.cancel()
+        if self._client is not None:
+            await self._client.aclose()
+
+    def pick(self, session_id: Optional[str] = None) -> Optional[Worker]:
+        """
+        The worker that already holds the session, or else the healthy worker with the fewest outstanding tokens.
+        """
+        if session_id is not None:
+            worker = self._sessions.get(session_id)
+            if worker is not None and worker.healthy:
+                self._sessions.move_to_end(session_id)
+                return worker
+
+        healthy = [worker for worker in self.workers if worker.healthy]
+        if not healthy:
+            return None
+        worker = min(healthy, key=lambda worker: (worker.outstanding_tokens, worker.outstanding_requests))
+        if session_id is not None:
+            self._sessions[session_id] = worker
+            self._sessions.move_to_end(session_id)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+        return worker
+
+    async def check_health(self):
+        async def check(worker: Worker):
+            if worker.process is not None and worker.process.poll() is not None:
+                logger.warning(f"Worker {worker.url} exited with {worker.process.returncode}, restarting it")
+                worker.healthy = False
+                worker.start()
+                return
+            try:
+                response = await self._client.get(f"{worker.url}/health", timeout=self.health_check_interval)
+                healthy = response.status_code == 200
+            except httpx.HTTPError:
+                healthy = False
+            if healthy != worker.healthy:
+                logger.info(f"Worker {worker.url} is {'healthy' if healthy else 'unhealthy'}")
+            worker.healthy = healthy
+
+        await asyncio.gather(*(check(worker) for worker in self.workers))
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.sleep(self.health_check_interval)
+            try:
+                await self.check_health()
+            except Exception:
+                logger.exception("Health check failed")
+
+    async def forward(self, request: Request, path: str) -> Response:
+        body = await request.body()
+        payload = None
+        if body and request.headers.get("content-type", "").startswith("application/json"):
+            try:
+                payload = json.loads(body)
+            except ValueError:
+                pass
+
+        if path.startswith(PINNED_PATHS):
+            worker = self.workers[0] if self.workers[0].healthy else None
+        else:
+            session_id = payload.get("session_id") if isinstance(payload, dict) else None
+            worker = self.pick(session_id or request.headers.get("x-session-id"))
+        if worker is None:
+            return JSONResponse({"detail": "No healthy worker"}, status_code=503, headers={"Retry-After": "1"})
+
+        tokens = estimate_tokens(body, payload)
+        worker.outstanding_tokens += tokens
+        worker.outstanding_requests += 1
+        upstream = None
+        try:
+            headers = {key: value for key, value in request.headers.items() if key.lower() not in HOP_BY_HOP_HEADERS}
+            upstream = await self._client.send(self._client.build_request(
+                request.method, f"{worker.url}/{path}", params=request.query_params, headers=headers, content=body,
+            ), stream=True)
+        except httpx.HTTPError as e:
+            # The worker is gone, keep others from being sent there until the next health check.
+            worker.healthy = False
+            self._release(worker, tokens)
+            logger.warning(f"Worker {worker.url} failed: {e}")
+            return JSONResponse({"detail": "Worker unavailable"}, status_code=503, headers={"Retry-After": "1"})
+
+        async def finish():
+            await upstream.aclose()
+            self._release(worker, tokens)
+
+        # Streams (SSE) and plain responses alike are passed through as they arrive.
+        headers = {key: value for key, value in upstream.headers.items() if key.lower() not in HOP_BY_HOP_HEADERS}
+        return RelayResponse(upstream.aiter_raw(), status_code=upstream.status_code, headers=headers,
+                             background=BackgroundTask(finish))
+
+    async def metrics(self) -> bytes:
+        """
+        The metrics of all workers in one exposition, every sample labelled with the index of its worker.
+        """
+
+        async def scrape(worker: Worker) -> str:
+            try:
+                response = await self._client.get(f"{worker.url}/metrics", timeout=self.health_check_interval)
+                response.raise_for_status()
+                return response.text
+            except httpx.HTTPError as e:
+                logger.warning(f"Scraping worker {worker.url} failed: {e}")
+                return ""
+
+        texts = await asyncio.gather(*(scrape(worker) for worker in self.workers))
+        # Samples of one metric must be exposed together, so the workers' metrics are merged by name.
+        merged: Dict[str, Metric] = {}
+        for index, text in enumerate(texts):
+            for family in text_string_to_metric_families(text):
+                metric = merged.setdefault(family.name, Metric(family.name, family.documentation, family.type))
+                metric.samples.extend(
+                    Sample(sample.name, dict(sample.labels, worker=str(index)), sample.value, sample.timestamp,
+                           sample.exemplar)
+                    for sample in family.samples
+                )
+        registry = CollectorRegistry(auto_describe=False)
+        registry.register(_Collected(list(merged.values())))
+        return generate_latest(registry)
+
+    def _release(self, worker: Worker, tokens: int):
+        worker.outstanding_tokens -= tokens
+        worker.outstanding_requests -= 1
+
+
+class _Collected:
+    """
+    A collector of metrics that were already collected elsewhere.
+    """
+
+    def __init__(self, metrics: List[Metric]):
+        self.metrics = metrics
+
+    def collect(self):
+        return self.metrics
+
+
+def create_app(router: Router) -> FastAPI:
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        await router.start()
+        yield
+        await router.stop()
+
+    app = FastAPI(lifespan=lifespan)
+
+    @app.get("/health")
+    async def health() -> Response:
+        """Healthy while at least one worker is, with the state of every worker."""
+        workers = [
+            {
+                "url": worker.url,
+                "device": worker.device,
+                "healthy": worker.healthy,
+                "outstanding_requests": worker.outstanding_requests,
+                "outstanding_tokens": worker.outstanding_tokens,
+            }
+            for worker in router.workers
+        ]
+        status_code = 200 if any(worker.healthy for worker in router.workers) else 503
+        return JSONResponse({"workers": workers}, status_code=status_code)
+
+    @app.get("/metrics")
+    async def metrics() -> Response:
+        """Prometheus metrics of all workers."""
+        return Response(content=await router.metrics(), media_type=CONTENT_TYPE_LATEST)
+
+    @app.api_route("/{path:path}", methods=["GET", "POST", "PUT", "DELETE"])
+    async def forward(request: Request, path: str) -> Response:
+        return await router.forward(request, path)
+
+    return app
+
+
+if __name__ == "__main__":
+    devices = worker_devices(NUM_WORKERS, WORKER_DEVICES)
+    workers = [
+        Worker(f"http://127.0.0.1:{WORKER_BASE_PORT + index}", device, WORKER_BASE_PORT + index, WORKER_COMMAND,
+               batches=index == 0)
+        for index, device in enumerate(devices)
+    ]
+    for worker in workers:
+        worker.start()
+    try:
+        router = Router(workers, HEALTH_CHECK_INTERVAL, MAX_AFFINITY_SESSIONS)
+        uvicorn.run(create_app(router), host='0.0.0.0', port=ROUTER_PORT, workers=1)
+    finally:
+        for worker in workers:
+            worker.stop()
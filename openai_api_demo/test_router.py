@@ -0,0 +1,123 @@
+import asyncio
+import socket
+import sys
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+from prometheus_client.parser import text_string_to_metric_families
+from starlette.background import BackgroundTask
+
+from router import RelayResponse, Router, Worker, create_app
+
+# A stand-in for `openai_api.py` that answers with its port and counts its requests in a Prometheus counter.
+FAKE_WORKER = """
+import os, uvicorn
+from fastapi import FastAPI, Response
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, generate_latest
+
+app = FastAPI()
+port = int(os.environ["API_PORT"])
+requests = Counter("chatglm3_test_requests", "Requests answered")
+
+@app.get("/health")
+async def health():
+    return {}
+
+@app.get("/metrics")
+async def metrics():
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+@app.post("/v1/chat/completions")
+async def chat():
+    requests.inc()
+    return {"port": port, "batch_dir": os.environ.get("BATCH_DIR"), "host": os.environ["API_HOST"]}
+
+uvicorn.run(app, host=os.environ["API_HOST"], port=port, log_level="warning")
+"""
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture
+def workers(tmp_path):
+    script = tmp_path / "fake_worker.py"
+    script.write_text(FAKE_WORKER)
+    workers = []
+    for index in range(2):
+        port = free_port()
+        workers.append(Worker(f"http://127.0.0.1:{port}", "cpu:0", port, f"{sys.executable} {script}",
+                              batches=index == 0).start())
+    yield workers
+    for worker in workers:
+        worker.stop()
+
+
+def wait_healthy(client: TestClient, router: Router, timeout: float = 30):
+    deadline = time.time() + timeout
+    while not all(worker.healthy for worker in router.workers):
+        assert time.time() < deadline, client.get("/health").json()
+        time.sleep(0.1)
+
+
+def chat(client: TestClient, **kwargs) -> dict:
+    response = client.post("/v1/chat/completions", json={"messages": [], "max_tokens": 10}, **kwargs)
+    assert response.status_code == 200
+    return response.json()
+
+
+def test_cpu_workers(workers):
+    router = Router(workers, health_check_interval=0.1)
+    with TestClient(create_app(router)) as client:
+        wait_healthy(client, router)
+
+        # Least outstanding tokens: while one worker is busy, the other gets the request.
+        for worker, busy in zip(workers, reversed(workers)):
+            busy.outstanding_tokens += 1000
+            reply = chat(client)
+            busy.outstanding_tokens -= 1000
+            assert reply["port"] == worker.port
+            assert reply["host"] == "127.0.0.1"
+            # Only the first worker keeps the batch directory.
+            assert (reply["batch_dir"] == "") == (not worker.batches)
+
+        # Session affinity outweighs load.
+        first = chat(client, headers={"X-Session-Id": "session"})["port"]
+        holder = next(worker for worker in workers if worker.port == first)
+        holder.outstanding_tokens += 1000
+        assert chat(client, headers={"X-Session-Id": "session"})["port"] == first
+        holder.outstanding_tokens -= 1000
+
+        # Finished responses release their load.
+        assert [(worker.outstanding_tokens, worker.outstanding_requests) for worker in workers] == [(0, 0), (0, 0)]
+
+        # "/metrics" merges the metrics of both workers.
+        families = {family.name: family for family in text_string_to_metric_families(client.get("/metrics").text)}
+        totals = {
+            sample.labels["worker"]: sample.value
+            for sample in families["chatglm3_test_requests"].samples if sample.name.endswith("_total")
+        }
+        assert set(totals) == {"0", "1"}
+        assert sum(totals.values()) == 4
+
+
+def test_relay_response_releases_on_disconnect():
+    released = []
+
+    async def body():
+        yield b"data"
+
+    async def release():
+        released.append(True)
+
+    async def send(message):
+        raise OSError("client went away")
+
+    response = RelayResponse(body(), background=BackgroundTask(release))
+    with pytest.raises(Exception):
+        asyncio.run(response({"type": "http", "asgi": {"spec_version": "2.4"}}, None, send))
+    assert released == [True]
@@ -1,9 +1,21 @@
 import gc
 import json
+import threading
+import time
 import torch
 from transformers import PreTrainedModel, PreTrainedTokenizer
-from transformers.generation.logits_process import LogitsProcessor
-from typing import Union, Tuple
+from transformers.generation.logits_process import (
+    LogitsProcessor,
+    LogitsProcessorList,
+    RepetitionPenaltyLogitsProcessor,
+    TemperatureLogitsWarper,
+    TopPLogitsWarper,
+)
+from transformers.generation.stopping_criteria import StoppingCriteria, StoppingCriteriaList
+from adapters import Adapter, activate_adapters
+from kv_cache import KV_BATCH_DIM, KV_SEQ_DIM, PastKeyValues, PrefixCache, SessionCache, truncate_past_key_values
+from metrics import RequestMetrics
+from typing import List, Optional, Union, Tuple
 
 
 class InvalidScoreLogitsProcessor(LogitsProcessor):
@@ -16,6 +28,147 @@ class InvalidScoreLogitsProcessor(LogitsProcessor):
         return scores
 
 
+class IncrementalDetokenizer:
+    """
+    Decode a growing list of token ids without re-decoding the whole sequence on every step.
+
+    Only the window `token_ids[prefix_offset:]` is decoded: the ids before `read_offset` have already been
+    emitted and give the tokenizer enough context to get word boundaries right, the ids after it are new.
+    While the window decodes to a partial UTF-8 character ("�"), the offsets stay put and the pending
+    bytes are kept until the next token completes them.
+    """
+
+    def __init__(self, tokenizer: PreTrainedTokenizer, token_ids: Optional[List[int]] = None):
+        self.tokenizer = tokenizer
+        self.token_ids = list(token_ids or [])
+        self.text = tokenizer.decode(self.token_ids) if self.token_ids else ""
+        self.prefix_offset = max(len(self.token_ids) - 5, 0)
+        self.read_offset = len(self.token_ids)
+
+    def step(self, token_id: int) -> str:
+        """
+        Add one token id and return the text it completes, or "" when there is nothing new to emit yet.
+        """
+        self.token_ids.append(token_id)
+        prefix_text = self.tokenizer.decode(self.token_ids[self.prefix_offset:self.read_offset])
+        new_text = self.tokenizer.decode(self.token_ids[self.prefix_offset:])
+        if len(new_text) <= len(prefix_text) or new_text.endswith("�"):
+            return ""
+
+        delta = new_text[len(prefix_text):]
+        self.prefix_offset = self.read_offset
+        self.read_offset = len(self.token_ids)
+        self.text += delta
+        return delta
+
+
+class ToolCallDetector:
+    """
+    Tell a tool call from a plain reply by the first generated tokens.
+
+    ChatGLM3 opens every assistant turn with a metadata line: it is empty for a text reply, so the first
+    token is "\\n", and holds the tool name for a tool call, which then ends with `<|observation|>`.
+    `is_tool_call` stays None until a token decodes to visible text, usually right after the first one.
+    """
+
+    def __init__(self, tokenizer: PreTrainedTokenizer):
+        self.tokenizer = tokenizer
+        self.is_tool_call: Optional[bool] = None
+
+    def step(self, token_id: int) -> Optional[bool]:
+        if self.is_tool_call is None:
+            text = self.tokenizer.decode([token_id])
+            if text:
+                self.is_tool_call = not text.startswith("\n")
+        return self.is_tool_call
+
+
+OBSERVATION = "<|observation|>"
+
+
+class StopStringMatcher:
+    """
+    Find the first of several stop strings in streamed text, looking at every character once.
+
+    The stop strings are compiled into an Aho-Corasick automaton. Its state is the longest suffix of the text
+    seen so far that is the start of a stop string: those characters are held back, since they are cut if
+    the stop string completes, and released as soon as it cannot.
+    """
+
+    def __init__(self, stop_strings: List[str]):
+        self.stop_strings = [string for string in stop_strings if string]
+        # Trie of the stop strings: transitions, failure links, length of the longest stop string ending in
+        # a state (0 for none) and the matched string.
+        self._goto: List[dict] = [{}]
+        self._fail = [0]
+        self._depth = [0]
+        self._match: List[Optional[str]] = [None]
+        for string in self.stop_strings:
+            state = 0
+            for char in string:
+                if char not in self._goto[state]:
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._depth.append(self._depth[state] + 1)
+                    self._match.append(None)
+                    self._goto[state][char] = len(self._goto) - 1
+                state = self._goto[state][char]
+            self._match[state] = self._match[state] or string
+
+        queue = list(self._goto[0].values())
+        for state in queue:
+            for char, next_state in self._goto[state].items():
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(char, 0)
+                if self._match[next_state] is None:
+                    self._match[next_state] = self._match[self._fail[next_state]]
+                queue.append(next_state)
+
+        self._state = 0
+        self._pending = ""
+
+    def feed(self, text: str) -> Tuple[str, Optional[str]]:
+        """
+        Consume newly generated text. Return the part of the text that can be emitted, and the stop string
+        if one completed, in which case the text stops right before it.
+        """
+        text = self._pending + text
+        for position in range(len(self._pending), len(text)):
+            char = text[position]
+            while self._state and char not in self._goto[self._state]:
+                self._state = self._fail[self._state]
+            self._state = self._goto[self._state].get(char, 0)
+            stop = self._match[self._state]
+            if stop is not None:
+                self._state, self._pending = 0, ""
+                return text[:position + 1 - len(stop)], stop
+
+        held = self._depth[self._state]
+        self._pending = text[len(text) - held:] if held else ""
+        return text[:len(text) - held], None
+
+    def flush(self) -> str:
+        """
+        Release the held back text once the generation ended without a stop string.
+        """
+        pending, self._state, self._pending = self._pending, 0, ""
+        return pending
+
+
+class CancelledStoppingCriteria(StoppingCriteria):
+    """
+    Stop generating as soon as `cancelled` is set, e.g. when the client disconnected.
+    """
+
+    def __init__(self, cancelled: threading.Event):
+        self.cancelled = cancelled
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> bool:
+        return self.cancelled.is_set()
+
+
 def process_response(output: str, use_tool: bool = False) -> Union[str, dict]:
     content = ""
     for response in output.split("<|assistant|>"):
@@ -43,8 +196,107 @@ def process_response(output: str, use_tool: bool = False) -> Union[str, dict]:
     return content
 
 
+def find_draft_tokens(token_ids: torch.LongTensor, max_ngram_size: int = 3, num_draft_tokens: int = 10) -> List[int]:
+    """
+    Prompt lookup: find the latest earlier occurrence of the longest trailing n-gram of `token_ids`
+    and propose the tokens that followed it as drafts.
+    """
+    length = token_ids.shape[0]
+    for ngram_size in range(min(max_ngram_size, length - 1), 0, -1):
+        ngram = token_ids[-ngram_size:]
+        # Windows of the sequence without its last token, so the trailing n-gram never matches itself.
+        windows = token_ids[:-1].unfold(0, ngram_size, 1)
+        matches = (windows == ngram).all(dim=1).nonzero().flatten()
+        if len(matches):
+            start = int(matches[-1]) + ngram_size
+            return token_ids[start:start + num_draft_tokens].tolist()
+    return []
+
+
 @torch.inference_mode()
-def generate_stream_chatglm3(model: PreTrainedModel, tokenizer: PreTrainedTokenizer, params: dict):
+def prompt_lookup_generate(model: PreTrainedModel, input_ids: torch.LongTensor, eos_token_id: List[int],
+                           max_new_tokens: int, logits_processor: LogitsProcessorList,
+                           past_key_values: Optional[PastKeyValues] = None, past_length: int = 0,
+                           stopping_criteria: Optional[StoppingCriteriaList] = None, num_draft_tokens: int = 10,
+                           max_ngram_size: int = 3, return_past_key_values: bool = False,
+                           stats: Optional[dict] = None):
+    """
+    Greedy decoding with prompt lookup speculation.
+
+    Draft tokens are copied from the prompt and the generated text with `find_draft_tokens`, then the model
+    checks all of them in one forward pass. The drafts that match its own greedy choice are accepted, plus the
+    token it predicts after the last accepted one, so the output is the same as plain greedy decoding.
+
+    `input_ids` is the whole prompt, `past_key_values` may already cover its first `past_length` tokens
+    (and a P-tuning prefix before them).
+    Yields like `model.stream_generate`: the ids after every new token, without the first `past_length`.
+    `stats` counts the proposed `draft_tokens` and the `accepted_tokens`.
+    """
+    ids = input_ids
+    outputs = model(
+        input_ids=ids[:, past_length:],
+        position_ids=torch.arange(past_length, ids.shape[1], device=ids.device).unsqueeze(0),
+        past_key_values=past_key_values,
+        use_cache=True,
+        return_dict=True,
+        return_last_logit=True,
+    )
+    past_key_values = outputs.past_key_values
+    logits = outputs.logits
+    drafts = []
+    num_new_tokens = 0
+    while True:
+        # Position j of `logits` predicts the token after drafts[:j].
+        new_tokens = []
+        for j in range(logits.shape[1]):
+            context = torch.cat((ids, ids.new_tensor([new_tokens])), dim=1) if new_tokens else ids
+            scores = logits_processor(context, logits[:, j, :].float())
+            new_tokens.append(int(torch.argmax(scores, dim=-1)))
+            if j == len(drafts) or new_tokens[-1] != drafts[j]:
+                break
+        if stats is not None:
+            stats["draft_tokens"] += len(drafts)
+            stats["accepted_tokens"] += len(new_tokens) - 1
+        # The cache also holds the rejected drafts, drop them.
+        rejected = len(drafts) - (len(new_tokens) - 1)
+        if rejected:
+            past_key_values = truncate_past_key_values(
+                past_key_values, past_key_values[0][0].shape[KV_SEQ_DIM] - rejected)
+
+        for token in new_tokens:
+            ids = torch.cat((ids, ids.new_tensor([[token]])), dim=1)
+            num_new_tokens += 1
+            yield (ids[:, past_length:], past_key_values) if return_past_key_values else ids[:, past_length:]
+            if token in eos_token_id or num_new_tokens >= max_new_tokens:
+                return
+            if stopping_criteria is not None and stopping_criteria(ids, None):
+                return
+
+        drafts = find_draft_tokens(ids[0], max_ngram_size, min(num_draft_tokens, max_new_tokens - num_new_tokens - 1))
+        step_ids = torch.cat((ids[:, -1:], ids.new_tensor([drafts]).view(1, -1)), dim=1)
+        outputs = model(
+            input_ids=step_ids,
+            position_ids=torch.arange(ids.shape[1] - 1, ids.shape[1] + len(drafts), device=ids.device).unsqueeze(0),
+            past_key_values=past_key_values,
+            use_cache=True,
+            return_dict=True,
+        )
+        past_key_values = outputs.past_key_values
+        logits = outputs.logits
+
+
+@torch.inference_mode()
+def generate_stream_chatglm3(model: PreTrainedModel, tokenizer: PreTrainedTokenizer, params: dict,
+                             prefix_cache: Optional[PrefixCache] = None, metrics: Optional[RequestMetrics] = None,
+                             inputs=None, cancelled: Optional[threading.Event] = None, num_draft_tokens: int = 0,
+                             max_ngram_size: int = 3, adapter: Optional[Adapter] = None,
+                             session_cache: Optional[SessionCache] = None):
+    """
+    Stream one chat generation. With `num_draft_tokens` > 0, greedy requests use prompt lookup speculation
+    (`prompt_lookup_generate`) and their usage reports the `draft_acceptance_rate`.
+    `adapter` selects a P-tuning or LoRA fine-tune of the model. With a `session_id` in `params`, the turn
+    continues from the KV the session kept in `session_cache` and leaves its own KV there.
+    """
     messages = params["messages"]
     tools = params["tools"]
     temperature = float(params.get("temperature", 1.0))
@@ -52,12 +304,41 @@ def generate_stream_chatglm3(model: PreTrainedModel, tokenizer: PreTrainedTokeni
     top_p = float(params.get("top_p", 1.0))
     max_new_tokens = int(params.get("max_tokens", 256))
     echo = params.get("echo", True)
-    messages = process_chatglm_messages(messages, tools=tools)
-    query, role = messages[-1]["content"], messages[-1]["role"]
+    stop_matcher = StopStringMatcher([OBSERVATION] + list(params.get("stop") or []))
+    if metrics is not None:
+        metrics.start()
 
-    inputs = tokenizer.build_chat_input(query, history=messages[:-1], role=role)
-    inputs = inputs.to(model.device)
+    if inputs is None:
+        start_time = time.perf_counter()
+        inputs = build_chat_inputs(tokenizer, messages, tools)
+        if metrics is not None:
+            metrics.observe_tokenization(time.perf_counter() - start_time)
+    # A copy, the prompt is trimmed below and the caller may reuse `inputs` for another choice.
+    inputs = {key: value.to(model.device) for key, value in inputs.items()}
     input_echo_len = len(inputs["input_ids"][0])
+    prompt_input_ids = inputs["input_ids"]
+    prompt_ids = prompt_input_ids[0].tolist()
+
+    # Reuse the longest cached prefix, the same way `stream_chat` continues from `past_key_values`.
+    # The cache holds base model KV, a P-tuning request starts from its adapter's prefix KV instead.
+    session_id = params.get("session_id") if session_cache is not None else None
+    cached_length, past_key_values = 0, None
+    if adapter is not None:
+        prefix_cache, session_id = None, None
+        past_key_values = adapter.past_key_values
+        if past_key_values is not None:
+            prefix_length = past_key_values[0][0].shape[KV_SEQ_DIM]
+            inputs["attention_mask"] = torch.cat(
+                (inputs["attention_mask"].new_ones((1, prefix_length)), inputs["attention_mask"]), dim=1)
+    else:
+        if session_id is not None:
+            cached_length, past_key_values = session_cache.match(session_id, prompt_ids)
+        if past_key_values is None and prefix_cache is not None:
+            cached_length, past_key_values = prefix_cache.match(prompt_ids)
+    if cached_length:
+        inputs["input_ids"] = inputs["input_ids"][:, cached_length:]
+        inputs["position_ids"] = inputs["position_ids"][:, cached_length:]
+    activate_adapters(model, [adapter])
 
     if input_echo_len >= model.config.seq_length:
         print(f"Input length larger than {model.config.seq_length}")
@@ -76,42 +357,95 @@ def generate_stream_chatglm3(model: PreTrainedModel, tokenizer: PreTrainedTokeni
     }
     if temperature > 1e-5:
         gen_kwargs["temperature"] = temperature
+    if cancelled is not None:
+        gen_kwargs["stopping_criteria"] = StoppingCriteriaList([CancelledStoppingCriteria(cancelled)])
 
-    total_len = 0
-    for total_ids in model.stream_generate(**inputs, eos_token_id=eos_token_id, **gen_kwargs):
-        total_ids = total_ids.tolist()[0]
-        total_len = len(total_ids)
-        if echo:
-            output_ids = total_ids[:-1]
-        else:
-            output_ids = total_ids[input_echo_len:-1]
-
-        response = tokenizer.decode(output_ids)
-        if response and response[-1] != "�":
-            response, stop_found = apply_stopping_strings(response, ["<|observation|>"])
-
-            yield {
-                "text": response,
-                "usage": {
-                    "prompt_tokens": input_echo_len,
-                    "completion_tokens": total_len - input_echo_len,
-                    "total_tokens": total_len,
-                },
-                "finish_reason": "function_call" if stop_found else None,
-            }
+    return_past_key_values = prefix_cache is not None or session_id is not None
+    speculation = None
+    if num_draft_tokens > 0 and temperature <= 1e-5:
+        speculation = {"draft_tokens": 0, "accepted_tokens": 0}
+        logits_processor = LogitsProcessorList()
+        if repetition_penalty != 1.0:
+            logits_processor.append(RepetitionPenaltyLogitsProcessor(repetition_penalty))
+        logits_processor.append(InvalidScoreLogitsProcessor())
+        token_stream = prompt_lookup_generate(
+            model, prompt_input_ids, eos_token_id, max_new_tokens, logits_processor,
+            past_key_values=past_key_values, past_length=cached_length,
+            stopping_criteria=gen_kwargs.get("stopping_criteria"), num_draft_tokens=num_draft_tokens,
+            max_ngram_size=max_ngram_size, return_past_key_values=return_past_key_values, stats=speculation)
+    else:
+        token_stream = model.stream_generate(**inputs, eos_token_id=eos_token_id, past_key_values=past_key_values,
+                                             return_past_key_values=return_past_key_values, **gen_kwargs)
 
-            if stop_found:
-                break
+    def usage():
+        usage_info = {
+            "prompt_tokens": input_echo_len,
+            "completion_tokens": total_len - input_echo_len,
+            "total_tokens": total_len,
+        }
+        if speculation is not None:
+            usage_info["draft_acceptance_rate"] = speculation["accepted_tokens"] / max(speculation["draft_tokens"], 1)
+        return usage_info
+
+    detokenizer = IncrementalDetokenizer(tokenizer, prompt_ids if echo else None)
+    tool_call_detector = ToolCallDetector(tokenizer)
+    response = detokenizer.text
+    total_len = input_echo_len
+    start_time = time.perf_counter()
+    total_ids = None
+    for total_ids in token_stream:
+        if return_past_key_values:
+            total_ids, past_key_values = total_ids
+            if prefix_cache is not None and total_len == input_echo_len:
+                # After the first step the cache covers exactly the prompt.
+                prefix_cache.insert(prompt_ids, past_key_values)
+        if metrics is not None:
+            if total_len == input_echo_len:
+                metrics.observe_prefill(time.perf_counter() - start_time)
+            metrics.token()
+
+        # Only the newest token is read back, the text is extended incrementally.
+        total_len = cached_length + total_ids.shape[1]
+        token_id = int(total_ids[0, -1])
+        if token_id in eos_token_id:
+            continue
+        tool_call_detector.step(token_id)
+        delta = detokenizer.step(token_id)
+        if not delta:
+            continue
+
+        delta, stop = stop_matcher.feed(delta)
+        response += delta
+        if not delta and stop is None:
+            continue
+
+        yield {
+            "text": response,
+            "delta": delta,
+            "usage": usage(),
+            "finish_reason": "function_call" if stop == OBSERVATION else None,
+            "is_tool_call": tool_call_detector.is_tool_call,
+        }
+
+        if stop is not None:
+            break
 
     # Only last stream result contains finish_reason, we set finish_reason as stop
+    if session_id is not None and total_ids is not None:
+        # The last token was never fed to the model, the cache covers everything before it.
+        output_ids = total_ids[0, input_echo_len - cached_length:].tolist()
+        session_cache.update(session_id, prompt_ids + output_ids[:-1], past_key_values)
+    if metrics is not None and speculation is not None:
+        metrics.observe_speculation(speculation["draft_tokens"], speculation["accepted_tokens"])
+    # Text held back as the possible start of a stop string that never completed.
+    delta = stop_matcher.flush()
+    response += delta
     ret = {
         "text": response,
-        "usage": {
-            "prompt_tokens": input_echo_len,
-            "completion_tokens": total_len - input_echo_len,
-            "total_tokens": total_len,
-        },
+        "delta": delta,
+        "usage": usage(),
         "finish_reason": "stop",
+        "is_tool_call": tool_call_detector.is_tool_call,
     }
     yield ret
 
@@ -156,31 +490,171 @@ def process_chatglm_messages(messages, tools=None):
     return messages
 
 
-def generate_chatglm3(model: PreTrainedModel, tokenizer: PreTrainedTokenizer, params: dict):
-    for response in generate_stream_chatglm3(model, tokenizer, params):
+def build_chat_inputs(tokenizer: PreTrainedTokenizer, messages, tools=None):
+    """
+    Convert OpenAI-style messages (and optional tools) into ChatGLM3 model inputs.
+    """
+    messages = process_chatglm_messages(messages, tools=tools)
+    query, role = messages[-1]["content"], messages[-1]["role"]
+    return tokenizer.build_chat_input(query, history=messages[:-1], role=role)
+
+
+def generate_chatglm3(model: PreTrainedModel, tokenizer: PreTrainedTokenizer, params: dict,
+                      prefix_cache: Optional[PrefixCache] = None):
+    for response in generate_stream_chatglm3(model, tokenizer, params, prefix_cache):
         pass
     return response
 
 
-def apply_stopping_strings(reply, stop_strings) -> Tuple[str, bool]:
-    stop_found = False
-    for string in stop_strings:
-        idx = reply.find(string)
-        if idx != -1:
-            reply = reply[:idx]
-            stop_found = True
-            break
+def build_completion_inputs(tokenizer: PreTrainedTokenizer, prompt: str) -> List[int]:
+    """
+    Tokenize a raw prompt such as "<|user|>\n...\n<|assistant|>", with its special tokens, like
+    `cli_batch_request_demo.py` does.
+    """
+    encode_special_tokens = tokenizer.encode_special_tokens
+    tokenizer.encode_special_tokens = True
+    try:
+        return tokenizer([prompt])["input_ids"][0]
+    finally:
+        tokenizer.encode_special_tokens = encode_special_tokens
 
-    if not stop_found:
-        # If something like "\nYo" is generated just before "\nYou: is completed, trim it
-        for string in stop_strings:
-            for j in range(len(string) - 1, 0, -1):
-                if reply[-j:] == string[:j]:
-                    reply = reply[:-j]
-                    break
+
+def bucket_by_length(lengths: List[int], max_tokens_per_batch: int) -> List[List[int]]:
+    """
+    Group indices by length so that each group pads to at most `max_tokens_per_batch` tokens.
+    `basic_demo/cli_batch_request_demo.py` has its own copy, it runs without this package.
+    """
+    buckets, bucket = [], []
+    for index in sorted(range(len(lengths)), key=lambda i: lengths[i]):
+        # Sorted by length, the index being added is the longest of its bucket.
+        if bucket and (len(bucket) + 1) * lengths[index] > max_tokens_per_batch:
+            buckets.append(bucket)
+            bucket = []
+        bucket.append(index)
+    if bucket:
+        buckets.append(bucket)
+    return buckets
+
+
+@torch.inference_mode()
+def generate_batch_chatglm3(model: PreTrainedModel, tokenizer: PreTrainedTokenizer, prompt_ids: List[List[int]],
+                            params: dict, cancelled: Optional[threading.Event] = None,
+                            max_tokens_per_batch: int = 8192):
+    """
+    Generate a completion for every prompt with padded batches of prompts of similar length.
+
+    Yields the final output of each prompt, with its `index`, as soon as it is finished. Finished rows are
+    dropped from the batch, including their KV cache, so the other rows go on without them. A row finishes at
+    an EOS token, at a `stop` string (matched incrementally, as in the engine) or after `max_tokens` tokens.
+    """
+    temperature = float(params.get("temperature", 1.0))
+    repetition_penalty = float(params.get("repetition_penalty", 1.0))
+    top_p = float(params.get("top_p", 1.0))
+    max_new_tokens = int(params.get("max_tokens", 256))
+    stop = list(params.get("stop") or [])
+
+    logits_processor = LogitsProcessorList()
+    if repetition_penalty != 1.0:
+        logits_processor.append(RepetitionPenaltyLogitsProcessor(repetition_penalty))
+    logits_processor.append(InvalidScoreLogitsProcessor())
+    do_sample = temperature > 1e-5
+    if do_sample:
+        if temperature != 1.0:
+            logits_processor.append(TemperatureLogitsWarper(temperature))
+        if top_p < 1.0:
+            logits_processor.append(TopPLogitsWarper(top_p))
+    eos_token_id = [
+        tokenizer.eos_token_id,
+        tokenizer.get_command("<|user|>"),
+        tokenizer.get_command("<|observation|>"),
+    ]
+    eos_token_tensor = torch.tensor(eos_token_id, device=model.device)
+    activate_adapters(model, [None] * len(prompt_ids))
+
+    def output(row: int, token_ids: List[int]) -> dict:
+        # The EOS token counts as a completion token, as in `generate_stream_chatglm3`, but is not decoded.
+        if stop:
+            text = texts[row] + stop_matchers[row].flush()
+        else:
+            text = tokenizer.decode(token_ids[:-1] if token_ids[-1] in eos_token_id else token_ids)
+        return {
+            "text": text,
+            "usage": {
+                "prompt_tokens": len(prompt_ids[row]),
+                "completion_tokens": len(token_ids),
+                "total_tokens": len(prompt_ids[row]) + len(token_ids),
+            },
+            "finish_reason": "stop",
+            "index": row,
+        }
+
+    for bucket in bucket_by_length([len(ids) for ids in prompt_ids], max_tokens_per_batch):
+        length = max(len(prompt_ids[row]) for row in bucket)
+        input_ids = torch.tensor([[tokenizer.pad_token_id] * (length - len(prompt_ids[row])) + prompt_ids[row]
+                                  for row in bucket], dtype=torch.long, device=model.device)
+        attention_mask = torch.tensor([[0] * (length - len(prompt_ids[row])) + [1] * len(prompt_ids[row])
+                                       for row in bucket], dtype=torch.long, device=model.device)
+        # Left padding: every row counts its positions from its first prompt token.
+        position_ids = (attention_mask.cumsum(dim=-1) - 1).clamp(min=0)
+        rows = torch.tensor(bucket, dtype=torch.long, device=model.device)
+        prompt_length = length
+        if stop:
+            # Stop strings can end a row early, so its text is followed token by token.
+            detokenizers = {row: IncrementalDetokenizer(tokenizer) for row in bucket}
+            stop_matchers = {row: StopStringMatcher(stop) for row in bucket}
+            texts = {row: "" for row in bucket}
+        step_ids, past_key_values = input_ids, None
+
+        for step in range(max_new_tokens):
+            if cancelled is not None and cancelled.is_set():
+                return
+            outputs = model(
+                input_ids=step_ids,
+                position_ids=position_ids,
+                attention_mask=attention_mask,
+                past_key_values=past_key_values,
+                use_cache=True,
+                return_dict=True,
+            )
+            past_key_values = outputs.past_key_values
+            # The repetition penalty must not see the left padding, pad positions repeat the row's last token
+            # instead, which is penalized anyway.
+            penalty_ids = torch.where(attention_mask.bool(), input_ids, input_ids[:, -1:])
+            scores = logits_processor(penalty_ids, outputs.logits[:, -1, :].float())
+            if do_sample:
+                next_tokens = torch.multinomial(torch.softmax(scores, dim=-1), num_samples=1).squeeze(1)
             else:
-                continue
+                next_tokens = torch.argmax(scores, dim=-1)
+            input_ids = torch.cat((input_ids, next_tokens[:, None]), dim=1)
 
-            break
+            finished = torch.isin(next_tokens, eos_token_tensor)
+            if stop:
+                for position, (row, token) in enumerate(zip(rows.tolist(), next_tokens.tolist())):
+                    if token in eos_token_id:
+                        continue
+                    delta, stop_string = stop_matchers[row].feed(detokenizers[row].step(token))
+                    texts[row] += delta
+                    if stop_string is not None:
+                        finished[position] = True
+            if step == max_new_tokens - 1:
+                finished[:] = True
+            if finished.any():
+                for row, token_ids in zip(rows[finished].tolist(), input_ids[finished, prompt_length:].tolist()):
+                    yield output(row, token_ids)
+                keep = (~finished).nonzero().squeeze(1)
+                if len(keep) == 0:
+                    break
+                input_ids, attention_mask = input_ids[keep], attention_mask[keep]
+                position_ids, next_tokens, rows = position_ids[keep], next_tokens[keep], rows[keep]
+                # Columns that are padding in every remaining row can go too.
+                start = int(attention_mask.any(dim=0).nonzero()[0])
+                attention_mask, input_ids, prompt_length = attention_mask[:, start:], input_ids[:, start:], \
+                    prompt_length - start
+                past_key_values = tuple(
+                    tuple(tensor.index_select(KV_BATCH_DIM, keep)[start:] for tensor in layer)
+                    for layer in past_key_values
+                )
 
-    return reply, stop_found
+            step_ids = next_tokens[:, None]
+            position_ids = position_ids[:, -1:] + 1
+            attention_mask = torch.cat((attention_mask, attention_mask.new_ones((len(rows), 1))), dim=1)